@@ -0,0 +1,61 @@
+import os
+import re
+import subprocess
+import sys
+import argparse
+
+# Runs the TABLE-TOP experiment once for each precision of the saved features and reports the mAP delta with respect
+# to float32 features, together with the disk space used by the features directories.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--output_dir', action='store', type=str, default='feature_precision_benchmark', help='Set the directory where the output directory of each run is created.')
+parser.add_argument('--dtypes', action='store', type=str, nargs='+', default=['float32', 'float16', 'bfloat16', 'int8'], help='Set the precisions of the saved features to compare.')
+parser.add_argument('--in_memory_features_dtype', action='store', type=str, default=None, choices=['float32', 'float16'], help='Set the precision of the regressors\' and test features kept in memory.')
+parser.add_argument('--only_ood', action='store_true', help='Run only the online-object-detection experiment, i.e. without updating the RPN.')
+parser.add_argument('--CPU', action='store_true', help='Run FALKON and bbox regressors training in CPU')
+
+args = parser.parse_args()
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+if args.output_dir.startswith('/'):
+    output_dir = args.output_dir
+else:
+    output_dir = os.path.join(basedir, args.output_dir)
+if not os.path.exists(output_dir):
+    os.mkdir(output_dir)
+
+
+def directory_size(path):
+    if not os.path.exists(path):
+        return 0
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+results = {}
+for dtype in args.dtypes:
+    run_dir = os.path.join(output_dir, dtype)
+    command = [sys.executable, os.path.join(basedir, 'run_experiment_online_rpn_ood.py'), '--output_dir', run_dir, '--save_detector_features', '--feature_storage_dtype', dtype]
+    if not args.only_ood:
+        command.append('--save_RPN_features')
+    else:
+        command.append('--only_ood')
+    if args.in_memory_features_dtype:
+        command += ['--in_memory_features_dtype', args.in_memory_features_dtype]
+    if args.CPU:
+        command.append('--CPU')
+    print('Running:', ' '.join(command))
+    subprocess.check_call(command, cwd=basedir)
+
+    with open(os.path.join(run_dir, 'result.txt'), 'r') as f:
+        mAP = [float(m) for m in re.findall(r'Detection mAP50: ([0-9.]+)', f.read())]
+    features_size = directory_size(os.path.join(run_dir, 'features_detector')) + directory_size(os.path.join(run_dir, 'features_RPN'))
+    results[dtype] = (mAP[-1] if mAP else float('nan'), features_size)
+
+reference_mAP = results['float32'][0] if 'float32' in results else float('nan')
+result_str = '{:<10} {:>8} {:>10} {:>14}\n'.format('dtype', 'mAP50', 'delta', 'features (MB)')
+for dtype in args.dtypes:
+    mAP, features_size = results[dtype]
+    result_str += '{:<10} {:>8.4f} {:>+10.4f} {:>14.1f}\n'.format(dtype, mAP, mAP - reference_mAP, features_size / 2**20)
+print(result_str)
+with open(os.path.join(output_dir, 'result.txt'), 'w') as fid:
+    fid.write(result_str)
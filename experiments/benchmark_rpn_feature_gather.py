@@ -0,0 +1,63 @@
+import time
+import argparse
+
+import torch
+
+# Compares the extraction of the features of n anchors from an RPN features map with the previous index_select
+# diagonal trick, which builds an n x n x C tensor, and with the direct gather used by the RPN feature extraction.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_anchors', action='store', type=int, nargs='+', default=[10, 100, 1000], help='Set the numbers of anchors whose features are extracted.')
+parser.add_argument('--feat_size', action='store', type=int, default=1024, help='Set the number of channels of the features map.')
+parser.add_argument('--height', action='store', type=int, default=38, help='Set the height of the features map.')
+parser.add_argument('--width', action='store', type=int, default=50, help='Set the width of the features map.')
+parser.add_argument('--repetitions', action='store', type=int, default=20, help='Set the number of timed repetitions for each method.')
+parser.add_argument('--CPU', action='store_true', help='Run the benchmark in CPU')
+
+args = parser.parse_args()
+
+device = 'cpu' if args.CPU or not torch.cuda.is_available() else 'cuda'
+
+
+def synchronize():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def index_select_diagonal(features, ids):
+    n = ids.size()[0]
+    feat = torch.index_select(features, 1, ids[:, 0])
+    feat = torch.index_select(feat, 2, ids[:, 1]).permute(1, 2, 0).reshape(n**2, features.size()[0])
+    return feat[torch.arange(0, n**2, n+1, device=features.device)]
+
+
+def gather(features, ids):
+    return features[:, ids[:, 0], ids[:, 1]].t()
+
+
+def time_method(method, features, ids):
+    method(features, ids)
+    synchronize()
+    t = time.time()
+    for _ in range(args.repetitions):
+        method(features, ids)
+    synchronize()
+    return (time.time() - t) / args.repetitions
+
+
+features = torch.randn((args.feat_size, args.height, args.width), device=device)
+result_str = '{:>6} {:>18} {:>12} {:>9}\n'.format('n', 'index_select (ms)', 'gather (ms)', 'speedup')
+for n in args.num_anchors:
+    ids = torch.stack((torch.randint(args.height, (n,), device=device), torch.randint(args.width, (n,), device=device)), dim=1)
+    try:
+        assert torch.equal(index_select_diagonal(features, ids), gather(features, ids))
+        time_index_select = time_method(index_select_diagonal, features, ids)
+    except RuntimeError:
+        # The n x n x C tensor does not fit in memory
+        time_index_select = float('nan')
+        if device == 'cuda':
+            torch.cuda.empty_cache()
+    time_gather = time_method(gather, features, ids)
+    result_str += '{:>6} {:>18.3f} {:>12.3f} {:>8.1f}x\n'.format(n, time_index_select*1000, time_gather*1000, time_index_select/time_gather)
+print('Device: {}'.format(device))
+print(result_str)
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import argparse
+
+import yaml
+import numpy as np
+import torch
+from torchvision import transforms as T
+
+basedir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir, 'src', 'modules', 'feature-extractor')))
+
+from mrcnn_modified.data.tensor_transform import TensorTransform
+
+# Compares the previous test-time preprocessing, ToPILImage -> Resize -> ToTensor -> to BGR255 -> Normalize, with the
+# tensor-native transform shared by the feature extractors and the predictors, on random uint8 images.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', action='store', type=str, nargs='+', default=['640x480', '1280x720', '1920x1080'], help='Set the WIDTHxHEIGHT sizes of the input images.')
+parser.add_argument('--config_file', action='store', type=str, default=os.path.join(basedir, 'configs', 'config_detector_tabletop.yaml'), help='Set the configuration file whose INPUT.MIN_SIZE_TEST is used as size of the shorter side of the transformed images.')
+parser.add_argument('--min_size', action='store', type=int, default=None, help='Set the size of the shorter side of the transformed images, instead of reading it from the configuration file.')
+parser.add_argument('--repetitions', action='store', type=int, default=20, help='Set the number of timed repetitions for each method.')
+parser.add_argument('--to_rgb', action='store_true', help='Flip the channels to RGB in [0-1] range instead of converting to BGR255.')
+parser.add_argument('--channels_last', action='store_true', help='Return the transformed images in channels-last memory format.')
+
+args = parser.parse_args()
+if args.min_size is None:
+    with open(args.config_file) as f:
+        args.min_size = yaml.load(f, Loader=yaml.FullLoader)['INPUT']['MIN_SIZE_TEST']
+
+pixel_mean = [102.9801, 115.9465, 122.7717]
+pixel_std = [1., 1., 1.]
+if args.to_rgb:
+    pixel_mean = [0.485, 0.456, 0.406]
+    pixel_std = [0.229, 0.224, 0.225]
+
+
+def build_pil_transform():
+    if args.to_rgb:
+        to_bgr_transform = T.Lambda(lambda x: x[[2, 1, 0]])
+    else:
+        to_bgr_transform = T.Lambda(lambda x: x * 255)
+    return T.Compose(
+        [
+            T.ToPILImage(),
+            T.Resize(args.min_size),
+            T.ToTensor(),
+            to_bgr_transform,
+            T.Normalize(mean=pixel_mean, std=pixel_std),
+        ]
+    )
+
+
+def time_method(method, image):
+    method(image)
+    t = time.time()
+    for _ in range(args.repetitions):
+        method(image)
+    return (time.time() - t) / args.repetitions
+
+
+pil_transform = build_pil_transform()
+tensor_transform = TensorTransform(args.min_size, pixel_mean, pixel_std, to_bgr255=not args.to_rgb, channels_last=args.channels_last)
+# Differences are reported in pixel values, i.e. before the division by the standard deviation
+scale = 255 * torch.tensor(pixel_std).view(-1, 1, 1) if args.to_rgb else 1
+
+result_str = '{:>10} {:>10} {:>12} {:>12} {:>9} {:>14} {:>15}\n'.format('input', 'output', 'PIL (ms)', 'tensor (ms)', 'speedup', 'max abs diff', 'mean abs diff')
+for size in args.sizes:
+    width, height = [int(s) for s in size.split('x')]
+    image = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    out_pil = pil_transform(image)
+    out_tensor = tensor_transform(image)
+    assert out_pil.size() == out_tensor.size()
+    diff = (out_pil - out_tensor).abs() * scale
+    time_pil = time_method(pil_transform, image)
+    time_tensor = time_method(tensor_transform, image)
+    result_str += '{:>10} {:>10} {:>12.3f} {:>12.3f} {:>8.1f}x {:>14.3f} {:>15.4f}\n'.format(size, '{}x{}'.format(out_tensor.size()[2], out_tensor.size()[1]),
+                                                                                        time_pil*1000, time_tensor*1000, time_pil/time_tensor, diff.max().item(), diff.mean().item())
+print('Threads: {}'.format(torch.get_num_threads()))
+print(result_str)
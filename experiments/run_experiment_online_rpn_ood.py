@@ -17,7 +17,7 @@ from mrcnn_modified.config import cfg
 
 from region_refiner import RegionRefiner
 
-from py_od_utils import computeFeatStatistics_torch, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor
+from py_od_utils import computeFeatStatistics_torch, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor, log_peak_memory, load_feature_statistics
 
 import AccuracyEvaluator as ae
 
@@ -36,6 +36,12 @@ parser.add_argument('--save_RPN_features', action='store_true', help='Save, in t
 parser.add_argument('--save_detector_features', action='store_true', help='Save, in the features directory (in the output directory), detector\'s features.')
 parser.add_argument('--load_RPN_features', action='store_true', help='Load, from the features directory (in the output directory), RPN features.')
 parser.add_argument('--load_detector_features', action='store_true', help='Load, from the features directory (in the output directory), detector\'s features.')
+parser.add_argument('--feature_storage_dtype', action='store', type=str, default=None, choices=['float32', 'float16', 'bfloat16', 'int8'], help='Set the precision of the features saved in the features directory. Features are converted back to float32 when loaded.')
+parser.add_argument('--backbone_cache_dir', action='store', type=str, default=None, help='Set the directory where the backbone feature maps of the images are cached, so that later runs with the same feature extractor skip the backbone.')
+parser.add_argument('--shared_backbone', action='store_true', help='Extract RPN and detector\'s features of the training set with a single backbone pass per image. Detector\'s features are sampled from the proposals of the pretrained RPN, instead of the online RPN.')
+parser.add_argument('--in_memory_features_dtype', action='store', type=str, default=None, choices=['float32', 'float16'], help='Set the precision of the regressors\' and test features kept in memory.')
+parser.add_argument('--normalize_in_place', action='store_true', help='Normalize the training features of the online classifiers and regressors in place, without allocating a normalized copy of them.')
+parser.add_argument('--report_peak_memory', action='store_true', help='Report, in the output directory, the peak resident memory of the process after each stage of the experiment.')
 
 
 args = parser.parse_args()
@@ -89,24 +95,42 @@ if not os.path.exists(output_dir):
 
 # Initialize feature extractor
 feature_extractor = FeatureExtractor(cfg_target_task, cfg_rpn, train_in_cpu=args.CPU)
+feature_extractor.feature_store_dtype = args.feature_storage_dtype
+feature_extractor.in_memory_features_dtype = args.in_memory_features_dtype
+feature_extractor.backbone_cache_dir = args.backbone_cache_dir
+
+# Extract RPN and detector features for the training set in the same pass, if requested
+if args.shared_backbone:
+    if args.only_ood or args.load_RPN_models or args.load_detector_models or args.load_RPN_features or args.load_detector_features:
+        print('Unconsistency! Features extracted with a shared backbone cannot be used when only one of the two models is trained or when features are loaded. Quitting.')
+        quit()
+    rpn_features, detector_features = feature_extractor.extractRPNAndDetectorFeatures(output_dir=output_dir, save_RPN_features=args.save_RPN_features, save_detector_features=args.save_detector_features)
 
 # Train RPN
 if not args.only_ood and not args.load_RPN_models:
     # Extract RPN features for the training set
-    if not args.save_RPN_features and not args.load_RPN_features:
+    if args.shared_backbone and not args.save_RPN_features:
+        negatives, positives, COXY = rpn_features
+    elif not args.save_RPN_features and not args.load_RPN_features:
         negatives, positives, COXY = feature_extractor.extractRPNFeatures(is_train=True, output_dir=output_dir, save_features=args.save_RPN_features)
     else:
-        if args.save_RPN_features:
+        if args.save_RPN_features and not args.shared_backbone:
             feature_extractor.extractRPNFeatures(is_train=True, output_dir=output_dir, save_features=args.save_RPN_features)
         positives, negatives = load_features_classifier(features_dir = os.path.join(output_dir, 'features_RPN'))
-    stats_rpn = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU)
+    # The RPN model is not used anymore
+    feature_extractor.releaseModels('rpn')
+    # Statistics accumulated during the extraction, or saved with the features
+    feature_statistics_rpn = feature_extractor.feature_statistics_rpn if not args.load_RPN_features else load_feature_statistics(os.path.join(output_dir, 'features_RPN'))
+    stats_rpn = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU, feature_statistics=feature_statistics_rpn)
+    if args.report_peak_memory:
+        log_peak_memory('RPN feature extraction', output_dir, features=(negatives, positives, COXY if not (args.save_RPN_features or args.load_RPN_features) else None))
 
     # RPN Region Classifier initialization
     classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path, is_rpn=True)
     regionClassifier = ocr.OnlineRegionClassifier(classifier, positives, negatives, stats_rpn, cfg_path=cfg_online_path, is_rpn=True)
 
     # Train RPN region classifier
-    models_falkon_rpn = falkon_models_to_cuda(regionClassifier.trainRegionClassifier(opts={'is_rpn': True}, output_dir=output_dir))
+    models_falkon_rpn = falkon_models_to_cuda(regionClassifier.trainRegionClassifier(opts={'is_rpn': True, 'normalize_in_place': args.normalize_in_place}, output_dir=output_dir))
 
     # RPN Region Refiner initialization
     region_refiner = RegionRefiner(cfg_online_path, is_rpn=True)
@@ -114,7 +138,9 @@ if not args.only_ood and not args.load_RPN_models:
         COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_RPN'))
 
     # Train RPN region Refiner
-    models_reg_rpn = region_refiner.trainRegionRefiner(normalize_COXY(COXY, stats_rpn, args.CPU), output_dir=output_dir)
+    models_reg_rpn = region_refiner.trainRegionRefiner(normalize_COXY(COXY, stats_rpn, args.CPU, in_place=args.normalize_in_place), output_dir=output_dir)
+    if args.report_peak_memory:
+        log_peak_memory('RPN training', output_dir)
 
     # Set trained RPN models in the pipeline
     feature_extractor.falkon_rpn_models = models_falkon_rpn
@@ -129,6 +155,8 @@ if not args.only_ood and not args.load_RPN_models:
 
     # Delete already used data
     del negatives, positives, COXY
+    if args.shared_backbone:
+        del rpn_features
     torch.cuda.empty_cache()
 
 # Load trained RPN models and set them in the pipeline, if requested
@@ -153,30 +181,39 @@ if args.load_detector_models:
 
 else:
     # Extract detector features for the train set
-    if not args.save_detector_features and not args.load_detector_features:
+    if args.shared_backbone and not args.save_detector_features:
+        negatives, positives, COXY = detector_features
+        del detector_features
+    elif not args.save_detector_features and not args.load_detector_features:
         negatives, positives, COXY = feature_extractor.extractFeatures(is_train=True, output_dir=output_dir, save_features=args.save_detector_features)
     else:
-        if args.save_detector_features:
+        if args.save_detector_features and not args.shared_backbone:
             feature_extractor.extractFeatures(is_train=True, output_dir=output_dir, save_features=args.save_detector_features)
         positives, negatives = load_features_classifier(features_dir = os.path.join(output_dir, 'features_detector'))
-    stats = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU)
+    # Statistics accumulated during the extraction, or saved with the features
+    feature_statistics = feature_extractor.feature_statistics_detector if not args.load_detector_features else load_feature_statistics(os.path.join(output_dir, 'features_detector'))
+    stats = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU, feature_statistics=feature_statistics)
+    if args.report_peak_memory:
+        log_peak_memory('detector\'s feature extraction', output_dir, features=(negatives, positives, COXY if not (args.save_detector_features or args.load_detector_features) else None))
 
     # Detector Region Classifier initialization
     classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path)
     regionClassifier = ocr.OnlineRegionClassifier(classifier, positives, negatives, stats, cfg_path=cfg_online_path)
 
     # Train detector Region Classifier
-    model = falkon_models_to_cuda(regionClassifier.trainRegionClassifier(output_dir=output_dir))
+    model = falkon_models_to_cuda(regionClassifier.trainRegionClassifier(opts={'normalize_in_place': args.normalize_in_place}, output_dir=output_dir))
 
     # Detector Region Refiner initialization
     region_refiner = RegionRefiner(cfg_online_path)
     if args.save_detector_features or args.load_detector_features:
         COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
     if args.normalize_features_regressor_detector:
-        models = region_refiner.trainRegionRefiner(normalize_COXY(COXY, stats, args.CPU), output_dir=output_dir)
+        models = region_refiner.trainRegionRefiner(normalize_COXY(COXY, stats, args.CPU, in_place=args.normalize_in_place), output_dir=output_dir)
     else:
         # Train Detector Region Refiner
         models = region_refiner.trainRegionRefiner(COXY, output_dir=output_dir)
+    if args.report_peak_memory:
+        log_peak_memory('detector\'s training', output_dir)
 
     # Delete already used data
     del negatives, positives, COXY
@@ -191,6 +228,10 @@ if args.save_detector_models:
 # Test models
 print('Extracting features for the test set')
 test_boxes = feature_extractor.extractFeatures(is_train=False, output_dir=output_dir)
+# This is the last extraction, the models kept loaded are freed
+feature_extractor.releaseModels()
+if args.report_peak_memory:
+    log_peak_memory('test feature extraction', output_dir)
 
 # Compute classification predictions
 print('Computing classification predictions')
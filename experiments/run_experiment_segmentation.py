@@ -15,7 +15,7 @@ from feature_extractor import FeatureExtractor
 from accuracy_evaluator import AccuracyEvaluator
 from region_refiner import RegionRefiner
 
-from py_od_utils import computeFeatStatistics_torch, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor, load_positives_from_COXY
+from py_od_utils import computeFeatStatistics_torch, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor, load_positives_from_COXY, load_feature_statistics
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--output_dir', action='store', type=str, default='online_segmentation_experiment_ycbv', help='Set experiment\'s output directory. Default directory is segmentation_experiment_ycbv.')
@@ -33,6 +33,7 @@ parser.add_argument('--sampling_ratio_segmentation', action='store', type=float,
 parser.add_argument('--pos_fraction_feat_stats', action='store', type=float, default=0.8, help='Set the fraction of positives samples to be used to compute features statistics for data normalization')
 parser.add_argument('--config_file_feature_extraction', action='store', type=str, default="config_feature_extraction_segmentation_ycbv.yaml", help='Manually set configuration file for feature extraction, by default it is config_feature_extraction_segmentation_ycbv.yaml. If the specified path is not absolute, the config file will be searched in the experiments/configs directory')
 parser.add_argument('--config_file_online_detection_online_segmentation', action='store', type=str, default="config_online_detection_segmentation_ycbv.yaml", help='Manually set configuration file for online detection and segmentation, by default it is config_online_detection_segmentation_ycbv.yaml. If the specified path is not absolute, the config file will be searched in the experiments/configs directory')
+parser.add_argument('--backbone_cache_dir', action='store', type=str, default=None, help='Set the directory where the backbone feature maps of the images are cached, so that later runs with the same feature extractor skip the backbone.')
 parser.add_argument('--normalize_features_regressor_detector', action='store_true', help='Normalize features for bounding box regression of the online detection.')
 
 
@@ -72,6 +73,7 @@ if not os.path.exists(output_dir):
 
 # Initialize feature extractor
 feature_extractor = FeatureExtractor(cfg_target_task, train_in_cpu=args.CPU)
+feature_extractor.backbone_cache_dir = args.backbone_cache_dir
 
 # Load detector models if requested, else train them
 if args.load_detector_models:
@@ -83,6 +85,9 @@ else:
     # Extract detector features for the train set
     if not args.save_detector_features and not args.load_detector_features:
         negatives, positives, COXY, negatives_segmentation, positives_segmentation = feature_extractor.extractFeatures(is_train=True, output_dir=output_dir, save_features=args.save_detector_features, extract_features_segmentation=True, use_only_gt_positives_detection=args.use_only_gt_positives_detection)
+        # Statistics accumulated during the extraction. Positives taken from COXY are not included in them
+        feature_statistics = feature_extractor.feature_statistics_detector if args.use_only_gt_positives_detection else None
+        feature_statistics_segmentation = feature_extractor.feature_statistics_segmentation
         del feature_extractor
         torch.cuda.empty_cache()
 
@@ -103,7 +108,7 @@ else:
             torch.cuda.empty_cache()
 
         stats = computeFeatStatistics_torch(positives, negatives, features_dim=negatives[0][0].size()[1],
-                                            cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
+                                            cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats, feature_statistics=feature_statistics)
 
         # Detector Region Classifier initialization
         classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path)
@@ -137,13 +142,9 @@ else:
         region_refiner = RegionRefiner(cfg_online_path)
         # Load COXY only if regressor features do not need to be normalized or if they are required to compute positives for classification
         if not args.normalize_features_regressor_detector or not args.use_only_gt_positives_detection:
-            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
-
             # Features can be extracted in a device that does not correspond to the one used for training.
             # Convert them to the proper device.
-            COXY['C'] = COXY['C'].to(training_device)
-            COXY['X'] = COXY['X'].to(training_device)
-            COXY['Y'] = COXY['Y'].to(training_device)
+            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'), device=training_device)
 
         # Train Detector Region Refiner if regressor features do not need to be normalized
         if not args.normalize_features_regressor_detector:
@@ -155,7 +156,7 @@ else:
             del region_refiner, COXY
             torch.cuda.empty_cache()
 
-        positives, negatives = load_features_classifier(features_dir=os.path.join(output_dir, 'features_detector'))
+        positives, negatives = load_features_classifier(features_dir=os.path.join(output_dir, 'features_detector'), lazy_negatives=False)
 
         # Load positives from COXY if required
         if not args.use_only_gt_positives_detection:
@@ -172,7 +173,9 @@ else:
             for j in range(len(negatives[i])):
                 negatives[i][j] = negatives[i][j].to(training_device)
 
-        stats = computeFeatStatistics_torch(positives, negatives, features_dim=negatives[0][0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
+        # Statistics saved with the features. Positives taken from COXY are not included in them
+        feature_statistics = load_feature_statistics(os.path.join(output_dir, 'features_detector')) if args.use_only_gt_positives_detection else None
+        stats = computeFeatStatistics_torch(positives, negatives, features_dim=negatives[0][0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats, feature_statistics=feature_statistics)
 
         # Detector Region Classifier initialization
         classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path)
@@ -186,13 +189,9 @@ else:
         torch.cuda.empty_cache()
 
         if args.normalize_features_regressor_detector and args.use_only_gt_positives_detection:
-            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
-
             # Features can be extracted in a device that does not correspond to the one used for training.
             # Convert them to the proper device.
-            COXY['C'] = COXY['C'].to(training_device)
-            COXY['X'] = COXY['X'].to(training_device)
-            COXY['Y'] = COXY['Y'].to(training_device)
+            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'), device=training_device)
 
         # Train Detector Region Refiner if regressor features do not need to be normalized
         if args.normalize_features_regressor_detector:
@@ -212,6 +211,7 @@ if not args.load_segmentation_models:
     if args.load_segmentation_features or args.save_detector_features or args.load_detector_features or args.load_detector_models:
         # Train segmentation classifiers
         positives_segmentation, negatives_segmentation = load_features_classifier(features_dir=os.path.join(output_dir, 'features_segmentation'), is_segm=True, sample_ratio=args.sampling_ratio_segmentation)
+        feature_statistics_segmentation = load_feature_statistics(os.path.join(output_dir, 'features_segmentation'))
     if args.CPU:
         training_device = 'cpu'
     else:
@@ -221,7 +221,7 @@ if not args.load_segmentation_models:
     for i in range(len(positives_segmentation)):
         positives_segmentation[i] = positives_segmentation[i].to(training_device)
         negatives_segmentation[i] = [negatives_segmentation[i].to(training_device)]
-    stats_segm = computeFeatStatistics_torch(positives_segmentation, negatives_segmentation, features_dim=positives_segmentation[0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
+    stats_segm = computeFeatStatistics_torch(positives_segmentation, negatives_segmentation, features_dim=positives_segmentation[0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats, feature_statistics=feature_statistics_segmentation)
     # Per-pixel classifier initialization
     classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path, is_segmentation=True)
     regionClassifier = ocr.OnlineRegionClassifier(classifier, positives_segmentation, negatives_segmentation, stats_segm, cfg_path=cfg_online_path, is_segmentation=True)
@@ -239,6 +239,7 @@ if args.save_segmentation_models:
 
 # Initialize feature extractor
 accuracy_evaluator = AccuracyEvaluator(cfg_target_task, train_in_cpu=args.CPU)
+accuracy_evaluator.backbone_cache_dir = args.backbone_cache_dir
 
 # Set detector models in the pipeline
 accuracy_evaluator.falkon_detector_models = model
@@ -249,3 +250,4 @@ accuracy_evaluator.falkon_segmentation_models = model_segm
 accuracy_evaluator.stats_segmentation = stats_segm
 
 test_boxes = accuracy_evaluator.evaluateAccuracyDetection(is_train=False, output_dir=output_dir, eval_segm_with_gt_bboxes=args.eval_segm_with_gt_bboxes, normalize_features_regressors=args.normalize_features_regressor_detector)
+accuracy_evaluator.releaseModels()
@@ -22,10 +22,15 @@ class AccuracyEvaluator(AccuracyEvaluatorAbstract):
         self.stats_segmentation = None
         self.regions_post_nms = None
         self.train_in_cpu = train_in_cpu
+        self.backbone_cache_dir = None
+        # Model kept loaded across calls, with the configuration file it was built with
+        self.session = None
+        self.session_cfg_path = None
 
     def evaluateAccuracyDetection(self, is_train, output_dir=None, save_features=False, evaluate_segmentation=True, eval_segm_with_gt_bboxes=False, normalize_features_regressors=False):
         # call class to extract detector features:
-        accuracy_evaluator = AccuracyEvaluatorDetector(self.cfg_path_target_task)
+        session = self.session if self.session_cfg_path == self.cfg_path_target_task else None
+        accuracy_evaluator = AccuracyEvaluatorDetector(self.cfg_path_target_task, session=session)
         accuracy_evaluator.falkon_rpn_models = self.falkon_rpn_models
         accuracy_evaluator.regressors_rpn_models = self.regressors_rpn_models
         accuracy_evaluator.stats_rpn = self.stats_rpn
@@ -36,6 +41,17 @@ class AccuracyEvaluator(AccuracyEvaluatorAbstract):
         accuracy_evaluator.stats_segmentation = self.stats_segmentation
         if self.regions_post_nms is not None:
             accuracy_evaluator.cfg.MODEL.RPN.POST_NMS_TOP_N_TEST = self.regions_post_nms
+        if self.backbone_cache_dir is not None:
+            accuracy_evaluator.cfg.BACKBONE_CACHE.DIR = self.backbone_cache_dir
         features = accuracy_evaluator(is_train, output_dir=output_dir, train_in_cpu=self.train_in_cpu, save_features=save_features, evaluate_segmentation=evaluate_segmentation, eval_segm_with_gt_bboxes=eval_segm_with_gt_bboxes, normalize_features_regressors=normalize_features_regressors)
+        self.session = accuracy_evaluator.session
+        self.session_cfg_path = self.cfg_path_target_task
 
         return features
+
+    def releaseModels(self):
+        # Frees the model kept loaded across calls
+        import torch
+        self.session = None
+        self.session_cfg_path = None
+        torch.cuda.empty_cache()
@@ -22,6 +22,7 @@ from maskrcnn_benchmark.utils.logger import setup_logger
 from maskrcnn_benchmark.utils.miscellaneous import mkdir
 
 from mrcnn_modified.engine.inference import inference
+from mrcnn_modified.engine.detection_session import DetectionSession
 import copy
 import logging
 # See if we can use apex.DistributedDataParallel instead of the torch default,
@@ -32,7 +33,7 @@ except ImportError:
     raise ImportError('Use APEX for multi-precision via apex.amp')
 
 class AccuracyEvaluatorDetector:
-    def __init__(self, cfg_path_target_task=None, local_rank=0):
+    def __init__(self, cfg_path_target_task=None, local_rank=0, session=None):
 
         self.is_target_task = True
         self.config_file = cfg_path_target_task
@@ -40,6 +41,8 @@ class AccuracyEvaluatorDetector:
         self.distributed = self.num_gpus > 1
         self.local_rank = local_rank
         self.cfg = cfg.clone()
+        # Session of a previous stage, whose model is reused
+        self.session = session
         self.load_parameters()
 
         self.falkon_rpn_models = None
@@ -76,8 +79,9 @@ class AccuracyEvaluatorDetector:
             mkdir(self.cfg.OUTPUT_DIR)
         logger = setup_logger("maskrcnn_benchmark", self.cfg.OUTPUT_DIR, get_rank())
         logger.info("Using {} GPUs".format(self.num_gpus))
-        logger.info("Collecting env info (might take some time)")
-        logger.info("\n" + collect_env_info())
+        if self.session is None:
+            logger.info("Collecting env info (might take some time)")
+            logger.info("\n" + collect_env_info())
         logger.info("Loaded configuration file {}".format(self.config_file))
         with open(self.config_file, "r") as cf:
             config_str = "\n" + cf.read()
@@ -87,66 +91,21 @@ class AccuracyEvaluatorDetector:
 
     def train(self, is_train, result_dir=False, evaluate_segmentation=True, eval_segm_with_gt_bboxes=False, normalize_features_regressors=False):
 
-        model = build_detection_model(self.cfg)
-        device = torch.device(self.cfg.MODEL.DEVICE)
-        model.to(device)
-
-        optimizer = make_optimizer(self.cfg, model)
-        scheduler = make_lr_scheduler(self.cfg, optimizer)
-
-        # Initialize mixed-precision training
-        use_mixed_precision = self.cfg.DTYPE == "float16"
-        amp_opt_level = 'O1' if use_mixed_precision else 'O0'
-        model, optimizer = amp.initialize(model, optimizer, opt_level=amp_opt_level)
-
-        if self.distributed:
-            model = torch.nn.parallel.DistributedDataParallel(
-                model, device_ids=[self.local_rank], output_device=self.local_rank,
-                # this should be removed if we update BatchNorm stats
-                broadcast_buffers=False,
-            )
-
-        arguments = {}
-        arguments["iteration"] = 0
-
-        output_dir = self.cfg.OUTPUT_DIR
-
-        save_to_disk = get_rank() == 0
-        checkpointer = DetectronCheckpointer(
-            self.cfg, model, None, None, output_dir, save_to_disk
-        )
-
         if self.cfg.MODEL.WEIGHT.startswith('/') or 'catalog' in self.cfg.MODEL.WEIGHT:
             model_path = self.cfg.MODEL.WEIGHT
         else:
             model_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir, 'Data', 'pretrained_feature_extractors', self.cfg.MODEL.WEIGHT))
 
-        extra_checkpoint_data = checkpointer.load(model_path)
-
-        if self.falkon_rpn_models is not None:
-            model.rpn.head.classifiers = self.falkon_rpn_models            
-        if self.regressors_rpn_models is not None:
-            model.rpn.head.regressors = self.regressors_rpn_models
-        if self.stats_rpn is not None:
-            model.rpn.head.stats = self.stats_rpn
-
-        if self.falkon_detector_models is not None:
-            model.roi_heads.box.predictor.classifiers = self.falkon_detector_models
-        if self.regressors_detector_models is not None:
-            model.roi_heads.box.predictor.regressors = self.regressors_detector_models
-        if self.stats_detector is not None:
-            model.roi_heads.box.predictor.stats = self.stats_detector
+        # The model is built and loaded only the first time, then it is kept in the session
+        if self.session is None:
+            self.session = DetectionSession(self.cfg, build_detection_model, model_path)
+        else:
+            self.session.reset(self.cfg)
+        self.session.set_online_models(falkon_rpn_models=self.falkon_rpn_models, regressors_rpn_models=self.regressors_rpn_models, stats_rpn=self.stats_rpn, falkon_detector_models=self.falkon_detector_models, regressors_detector_models=self.regressors_detector_models, stats_detector=self.stats_detector, falkon_segmentation_models=self.falkon_segmentation_models, stats_segmentation=self.stats_segmentation)
+        model = self.session.model
 
         model.roi_heads.box.predictor.normalize_features_regressors = normalize_features_regressors
 
-        if self.falkon_segmentation_models is not None:
-            model.roi_heads.mask.predictor.classifiers = self.falkon_segmentation_models
-        if self.stats_segmentation is not None:
-            model.roi_heads.mask.predictor.stats = self.stats_segmentation
-
-        if self.distributed:
-            model = model.module
-
         iou_types = ("bbox",)
         torch.cuda.empty_cache()  # TODO check if it helps
 
@@ -20,19 +20,33 @@ class FeatureExtractor(FeatureExtractorAbstract):
         self.stats_detector = None
         self.regions_post_nms = None
         self.train_in_cpu = train_in_cpu
+        self.feature_store_dtype = None
+        self.in_memory_features_dtype = None
+        self.backbone_cache_dir = None
+        # Models kept loaded across calls, by extractor and configuration file
+        self.sessions = {}
+        # Statistics of the last extracted training features
+        self.feature_statistics_rpn = None
+        self.feature_statistics_detector = None
+        self.feature_statistics_segmentation = None
 
     def extractRPNFeatures(self, is_train, output_dir=None, save_features=False):
         from feature_extractor_RPN import FeatureExtractorRPN
         # call class to extract rpn features:
-        feature_extractor = FeatureExtractorRPN(self.cfg_path_RPN)
+        feature_extractor = FeatureExtractorRPN(self.cfg_path_RPN, session=self.sessions.get(('rpn', self.cfg_path_RPN)))
+        self.set_features_precision(feature_extractor.cfg)
+        self.set_backbone_cache(feature_extractor.cfg)
         features = feature_extractor(is_train, output_dir=output_dir, train_in_cpu=self.train_in_cpu, save_features=save_features)
+        self.sessions[('rpn', self.cfg_path_RPN)] = feature_extractor.session
+        if is_train:
+            self.feature_statistics_rpn = feature_extractor.feature_statistics
 
         return features
 
     def extractFeatures(self, is_train, output_dir=None, save_features=False, extract_features_segmentation=False, use_only_gt_positives_detection=True):
         from feature_extractor_detector import FeatureExtractorDetector
         # call class to extract detector features:
-        feature_extractor = FeatureExtractorDetector(self.cfg_path_target_task)
+        feature_extractor = FeatureExtractorDetector(self.cfg_path_target_task, session=self.sessions.get(('detector', self.cfg_path_target_task)))
         feature_extractor.falkon_rpn_models = self.falkon_rpn_models
         feature_extractor.regressors_rpn_models = self.regressors_rpn_models
         feature_extractor.stats_rpn = self.stats_rpn
@@ -41,10 +55,49 @@ class FeatureExtractor(FeatureExtractorAbstract):
         feature_extractor.stats_detector = self.stats_detector
         if self.regions_post_nms is not None:
             feature_extractor.cfg.MODEL.RPN.POST_NMS_TOP_N_TEST = self.regions_post_nms
+        self.set_features_precision(feature_extractor.cfg)
+        self.set_backbone_cache(feature_extractor.cfg)
         features = feature_extractor(is_train, output_dir=output_dir, train_in_cpu=self.train_in_cpu, save_features=save_features, extract_features_segmentation=extract_features_segmentation, use_only_gt_positives_detection=use_only_gt_positives_detection)
+        self.sessions[('detector', self.cfg_path_target_task)] = feature_extractor.session
+        if is_train:
+            self.feature_statistics_detector = feature_extractor.feature_statistics
+            self.feature_statistics_segmentation = feature_extractor.feature_statistics_segmentation
 
         return features
 
+    def extractRPNAndDetectorFeatures(self, output_dir=None, save_RPN_features=False, save_detector_features=False, extract_features_segmentation=False):
+        from feature_extractor_shared import FeatureExtractorShared
+        # call class to extract rpn and detector features of the training set with a single backbone pass:
+        feature_extractor = FeatureExtractorShared(self.cfg_path_target_task, self.cfg_path_RPN)
+        if self.regions_post_nms is not None:
+            feature_extractor.cfg.MODEL.RPN.POST_NMS_TOP_N_TEST = self.regions_post_nms
+        self.set_features_precision(feature_extractor.cfg)
+        self.set_backbone_cache(feature_extractor.cfg)
+        self.set_features_precision(feature_extractor.cfg_rpn)
+        self.set_backbone_cache(feature_extractor.cfg_rpn)
+        rpn_features, detector_features = feature_extractor(output_dir=output_dir, train_in_cpu=self.train_in_cpu, save_RPN_features=save_RPN_features, save_detector_features=save_detector_features, extract_features_segmentation=extract_features_segmentation)
+        self.feature_statistics_rpn = feature_extractor.feature_statistics_rpn
+        self.feature_statistics_detector = feature_extractor.feature_statistics_detector
+        self.feature_statistics_segmentation = feature_extractor.feature_statistics_segmentation
+
+        return rpn_features, detector_features
+
+    def releaseModels(self, extractor=None):
+        # Frees the models kept loaded across calls, only those of extractor ('rpn' or 'detector') if given
+        import torch
+        self.sessions = {key: session for key, session in self.sessions.items() if extractor is not None and key[0] != extractor}
+        torch.cuda.empty_cache()
+
+    def set_features_precision(self, cfg):
+        if self.feature_store_dtype is not None:
+            cfg.FEATURE_STORE.DTYPE = self.feature_store_dtype
+        if self.in_memory_features_dtype is not None:
+            cfg.FEATURE_STORE.IN_MEMORY_DTYPE = self.in_memory_features_dtype
+
+    def set_backbone_cache(self, cfg):
+        if self.backbone_cache_dir is not None:
+            cfg.BACKBONE_CACHE.DIR = self.backbone_cache_dir
+
     def trainFeatureExtractor(self, output_dir=None, fine_tune_last_layers=False, fine_tune_rpn=False):
         from feature_extractor_trainer import TrainerFeatureTask
         # call class to train from scratch a model on the feature task
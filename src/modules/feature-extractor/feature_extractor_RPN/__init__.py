@@ -1 +1 @@
-from .extract_features_RPN import FeatureExtractorRPN
+from .extract_features_RPN import FeatureExtractorRPN, collect_rpn_features
@@ -22,7 +22,11 @@ from maskrcnn_benchmark.utils.logger import setup_logger
 from maskrcnn_benchmark.utils.miscellaneous import mkdir
 
 from mrcnn_modified.engine.feature_proposal_extractor import inference
-import copy
+from mrcnn_modified.engine.detection_session import DetectionSession
+from mrcnn_modified.utils.feature_store import FeatureStoreWriter
+from mrcnn_modified.utils.feature_buffer import buffer_views
+from mrcnn_modified.utils.regression_statistics import STATISTICS_FILE_NAME
+from mrcnn_modified.utils.feature_statistics import FEATURE_STATISTICS_FILE_NAME
 import logging
 # See if we can use apex.DistributedDataParallel instead of the torch default,
 # and enable mixed-precision via apex.amp
@@ -32,7 +36,7 @@ except ImportError:
     raise ImportError('Use APEX for multi-precision via apex.amp')
 
 class FeatureExtractorRPN:
-    def __init__(self, cfg_path_RPN=None, local_rank=0):
+    def __init__(self, cfg_path_RPN=None, local_rank=0, session=None):
 
         self.is_target_task = True
         self.config_file = cfg_path_RPN
@@ -40,6 +44,10 @@ class FeatureExtractorRPN:
         self.distributed = self.num_gpus > 1
         self.local_rank = local_rank
         self.cfg = cfg.clone()
+        # Session of a previous stage, whose model is reused
+        self.session = session
+        # Statistics of the extracted features, set after the extraction
+        self.feature_statistics = None
         self.load_parameters()
 
     def __call__(self, is_train, output_dir=None, train_in_cpu=False, save_features=False):
@@ -71,8 +79,9 @@ class FeatureExtractorRPN:
 
         logger = setup_logger("maskrcnn_benchmark", self.cfg.OUTPUT_DIR, get_rank())
         logger.info("Using {} GPUs".format(self.num_gpus))
-        logger.info("Collecting env info (might take some time)")
-        logger.info("\n" + collect_env_info())
+        if self.session is None:
+            logger.info("Collecting env info (might take some time)")
+            logger.info("\n" + collect_env_info())
         logger.info("Loaded configuration file {}".format(self.config_file))
         with open(self.config_file, "r") as cf:
             config_str = "\n" + cf.read()
@@ -81,45 +90,21 @@ class FeatureExtractorRPN:
 
 
     def train(self, is_train, result_dir=None):
-        model = build_detection_model(self.cfg)
-        device = torch.device(self.cfg.MODEL.DEVICE)
-        model.to(device)
-
-        optimizer = make_optimizer(self.cfg, model)
-        scheduler = make_lr_scheduler(self.cfg, optimizer)
-
-        # Initialize mixed-precision training
-        use_mixed_precision = self.cfg.DTYPE == "float16"
-        amp_opt_level = 'O1' if use_mixed_precision else 'O0'
-        model, optimizer = amp.initialize(model, optimizer, opt_level=amp_opt_level)
-
-        if self.distributed:
-            model = torch.nn.parallel.DistributedDataParallel(
-                model, device_ids=[self.local_rank], output_device=self.local_rank,
-                # this should be removed if we update BatchNorm stats
-                broadcast_buffers=False,
-            )
-
-        arguments = {}
-        arguments["iteration"] = 0
-
-        output_dir = self.cfg.OUTPUT_DIR
-
-        save_to_disk = get_rank() == 0
-        checkpointer = DetectronCheckpointer(
-            self.cfg, model, optimizer, scheduler, output_dir, save_to_disk
-        )
         # Load rpn
         if self.cfg.MODEL.WEIGHT.startswith('/') or 'catalog' in self.cfg.MODEL.WEIGHT:
             model_path = self.cfg.MODEL.WEIGHT
         else:
             model_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir, 'Data', 'pretrained_feature_extractors', self.cfg.MODEL.WEIGHT))
 
-        checkpointer = DetectronCheckpointer(cfg, model, save_dir=result_dir)
-        _ = checkpointer.load(model_path)
+        # The model is built and loaded only the first time, then it is kept in the session
+        if self.session is None:
+            self.session = DetectionSession(self.cfg, build_detection_model, model_path)
+        else:
+            self.session.reset(self.cfg)
+        model = self.session.model
 
-        if self.distributed:
-            model = model.module
+        if self.cfg.SAVE_FEATURES_RPN:
+            model.rpn.feature_writer = FeatureStoreWriter(os.path.join(result_dir, 'features_RPN'), async_write=self.cfg.FEATURE_STORE.ASYNC_WRITER, max_pending_batches=self.cfg.FEATURE_STORE.MAX_PENDING_BATCHES, storage_dtype=self.cfg.FEATURE_STORE.DTYPE)
 
         iou_types = ("bbox",)
         torch.cuda.empty_cache()  # TODO check if it helps
@@ -159,42 +144,55 @@ class FeatureExtractorRPN:
             synchronize()
         logger = logging.getLogger("maskrcnn_benchmark")
         logger.handlers=[]
-        if self.cfg.SAVE_FEATURES_RPN:
-            # Save features still not saved
-            for clss in model.rpn.anchors_ids:
-                # Save negatives batches
-                for batch in range(len(model.rpn.negatives[clss])):
-                    if model.rpn.negatives[clss][batch].size()[0] > 0:
-                        path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(clss, batch))
-                        torch.save(model.rpn.negatives[clss][batch], path_to_save)
-                # If a class does not have positive examples, save an empty tensor
-                if model.rpn.positives[clss][0].size()[0] == 0 and len(model.rpn.positives[clss]) == 1:
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(clss, 0))
-                    torch.save(torch.empty((0, model.rpn.feat_size), device=model.rpn.negatives[clss][0].device), path_to_save)
-                else:
-                    for batch in range(len(model.rpn.positives[clss])):
-                        if model.rpn.positives[clss][batch].size()[0] > 0:
-                            path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(clss, batch))
-                            torch.save(model.rpn.positives[clss][batch], path_to_save)
-
-            for i in range(len(model.rpn.X)):
-                if model.rpn.X[i].size()[0] > 0:
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_x_batch_{}'.format(i))
-                    torch.save(model.rpn.X[i], path_to_save)
-
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_c_batch_{}'.format(i))
-                    torch.save(model.rpn.C[i], path_to_save)
-
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_y_batch_{}'.format(i))
-                    torch.save(model.rpn.Y[i], path_to_save)
-            return
+        self.feature_statistics = model.rpn.feature_statistics
+        features = collect_rpn_features(self.cfg, model.rpn, result_dir)
+        # Sampled features are not kept in the resident model
+        self.session.release()
+        return features
+
+
+def collect_rpn_features(cfg, rpn, result_dir=None):
+    """
+    Saves the features still in the buffers of the RPN sampler rpn, if cfg.SAVE_FEATURES_RPN is set, else returns
+    its negatives, positives and regression data. In both cases rpn releases its buffers, so that the returned
+    features are owned only by the caller.
+    """
+    if cfg.SAVE_FEATURES_RPN:
+        # Save features still not saved
+        feature_writer = rpn.feature_writer
+        for clss in rpn.anchors_ids:
+            # Save negatives batches
+            for batch in range(len(rpn.negatives[clss])):
+                feature_writer.append('negatives_cl_{}'.format(clss), rpn.negatives[clss][batch].view())
+            # Classes without positive examples are saved as empty entries
+            for batch in range(len(rpn.positives[clss])):
+                feature_writer.append('positives_cl_{}'.format(clss), rpn.positives[clss][batch].view())
+
+        for i in range(len(rpn.X)):
+            if len(rpn.X[i]) > 0:
+                feature_writer.append('reg_x', rpn.X[i].view())
+                feature_writer.append('reg_c', rpn.C[i].view())
+                feature_writer.append('reg_y', rpn.Y[i].view())
+        if rpn.regression_statistics is not None:
+            rpn.regression_statistics.save(os.path.join(result_dir, 'features_RPN', STATISTICS_FILE_NAME))
+        if rpn.feature_statistics is not None:
+            rpn.feature_statistics.save(os.path.join(result_dir, 'features_RPN', FEATURE_STATISTICS_FILE_NAME))
+        feature_writer.close()
+        rpn.release_online_state()
+        return
+    else:
+        if rpn.regression_statistics is not None:
+            # Regressors are trained from their sufficient statistics
+            COXY = rpn.regression_statistics
         else:
-            COXY = {'C': torch.cat(model.rpn.C),
-                    'O': model.rpn.O,
-                    'X': torch.cat(model.rpn.X),
-                    'Y': torch.cat(model.rpn.Y)
+            COXY = {'C': torch.cat(buffer_views(rpn.C)),
+                    'O': rpn.O,
+                    'X': torch.cat(buffer_views(rpn.X)).to(getattr(torch, cfg.FEATURE_STORE.IN_MEMORY_DTYPE)),
+                    'Y': torch.cat(buffer_views(rpn.Y))
                     }
-            for i in range(self.cfg.MINIBOOTSTRAP.RPN.NUM_CLASSES):
-                model.rpn.positives[i] = torch.cat(model.rpn.positives[i])
+        for i in range(cfg.MINIBOOTSTRAP.RPN.NUM_CLASSES):
+            rpn.positives[i] = torch.cat(buffer_views(rpn.positives[i]))
+        features = buffer_views(rpn.negatives), rpn.positives, COXY
+        rpn.release_online_state()
 
-            return copy.deepcopy(model.rpn.negatives), copy.deepcopy(model.rpn.positives), copy.deepcopy(COXY)
+        return features
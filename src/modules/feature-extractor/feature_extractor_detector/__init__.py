@@ -1 +1 @@
-from .extract_features_detector import FeatureExtractorDetector
+from .extract_features_detector import FeatureExtractorDetector, collect_detector_features
@@ -22,7 +22,11 @@ from maskrcnn_benchmark.utils.logger import setup_logger
 from maskrcnn_benchmark.utils.miscellaneous import mkdir
 
 from mrcnn_modified.engine.feature_proposal_extractor import inference
-import copy
+from mrcnn_modified.engine.detection_session import DetectionSession
+from mrcnn_modified.utils.feature_store import FeatureStoreWriter
+from mrcnn_modified.utils.feature_buffer import buffer_views
+from mrcnn_modified.utils.regression_statistics import STATISTICS_FILE_NAME
+from mrcnn_modified.utils.feature_statistics import FEATURE_STATISTICS_FILE_NAME
 import logging
 # See if we can use apex.DistributedDataParallel instead of the torch default,
 # and enable mixed-precision via apex.amp
@@ -32,7 +36,7 @@ except ImportError:
     raise ImportError('Use APEX for multi-precision via apex.amp')
 
 class FeatureExtractorDetector:
-    def __init__(self, cfg_path_target_task=None, local_rank=0):
+    def __init__(self, cfg_path_target_task=None, local_rank=0, session=None):
 
         self.is_target_task = True
         self.config_file = cfg_path_target_task
@@ -40,6 +44,11 @@ class FeatureExtractorDetector:
         self.distributed = self.num_gpus > 1
         self.local_rank = local_rank
         self.cfg = cfg.clone()
+        # Session of a previous stage, whose model is reused
+        self.session = session
+        # Statistics of the extracted training features, set after the extraction
+        self.feature_statistics = None
+        self.feature_statistics_segmentation = None
         self.load_parameters()
 
         self.falkon_rpn_models = None
@@ -50,6 +59,9 @@ class FeatureExtractorDetector:
         self.cfg.TRAIN_FALKON_REGRESSORS_DEVICE = 'cpu' if train_in_cpu else 'cuda'
         self.cfg.SAVE_FEATURES_DETECTOR = save_features
         self.cfg.MINIBOOTSTRAP.DETECTOR.EXTRACT_ONLY_GT_POSITIVES = use_only_gt_positives_detection
+        if not use_only_gt_positives_detection and self.cfg.REGRESSORS.SUFFICIENT_STATISTICS:
+            print('Regressor features are required to compute the positives for classification. Regressor sufficient statistics will not be used.')
+            self.cfg.REGRESSORS.SUFFICIENT_STATISTICS = False
         if save_features:
             if output_dir:
                 features_path = os.path.join(output_dir, 'features_detector')
@@ -77,8 +89,9 @@ class FeatureExtractorDetector:
             mkdir(self.cfg.OUTPUT_DIR)
         logger = setup_logger("maskrcnn_benchmark", self.cfg.OUTPUT_DIR, get_rank())
         logger.info("Using {} GPUs".format(self.num_gpus))
-        logger.info("Collecting env info (might take some time)")
-        logger.info("\n" + collect_env_info())
+        if self.session is None:
+            logger.info("Collecting env info (might take some time)")
+            logger.info("\n" + collect_env_info())
         logger.info("Loaded configuration file {}".format(self.config_file))
         with open(self.config_file, "r") as cf:
             config_str = "\n" + cf.read()
@@ -87,58 +100,23 @@ class FeatureExtractorDetector:
 
 
     def train(self, is_train, result_dir=False, extract_features_segmentation=False, use_only_gt_positives_detection=True):
-        model = build_detection_model(self.cfg)
-        device = torch.device(self.cfg.MODEL.DEVICE)
-        model.to(device)
-
-        optimizer = make_optimizer(self.cfg, model)
-        scheduler = make_lr_scheduler(self.cfg, optimizer)
-
-        # Initialize mixed-precision training
-        use_mixed_precision = self.cfg.DTYPE == "float16"
-        amp_opt_level = 'O1' if use_mixed_precision else 'O0'
-        model, optimizer = amp.initialize(model, optimizer, opt_level=amp_opt_level)
-
-        if self.distributed:
-            model = torch.nn.parallel.DistributedDataParallel(
-                model, device_ids=[self.local_rank], output_device=self.local_rank,
-                # this should be removed if we update BatchNorm stats
-                broadcast_buffers=False,
-            )
-
-        arguments = {}
-        arguments["iteration"] = 0
-
-        output_dir = self.cfg.OUTPUT_DIR
-
-        save_to_disk = get_rank() == 0
-        checkpointer = DetectronCheckpointer(
-            self.cfg, model, optimizer, scheduler, output_dir, save_to_disk
-        )
-
         if self.cfg.MODEL.WEIGHT.startswith('/') or 'catalog' in self.cfg.MODEL.WEIGHT:
             model_path = self.cfg.MODEL.WEIGHT
         else:
             model_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir, 'Data', 'pretrained_feature_extractors', self.cfg.MODEL.WEIGHT))
 
-        extra_checkpoint_data = checkpointer.load(model_path)
-
-        if self.falkon_rpn_models is not None:
-            model.rpn.head.classifiers = self.falkon_rpn_models            
-        if self.regressors_rpn_models is not None:
-            model.rpn.head.regressors = self.regressors_rpn_models
-        if self.stats_rpn is not None:
-            model.rpn.head.stats = self.stats_rpn
-
-        if self.falkon_detector_models is not None:
-            model.roi_heads.box.predictor.classifiers = self.falkon_detector_models
-        if self.regressors_detector_models is not None:
-            model.roi_heads.box.predictor.regressors = self.regressors_detector_models
-        if self.stats_detector is not None:
-            model.roi_heads.box.predictor.stats = self.stats_detector
+        # The model is built and loaded only the first time, then it is kept in the session
+        if self.session is None:
+            self.session = DetectionSession(self.cfg, build_detection_model, model_path)
+        else:
+            self.session.reset(self.cfg)
+        self.session.set_online_models(falkon_rpn_models=self.falkon_rpn_models, regressors_rpn_models=self.regressors_rpn_models, stats_rpn=self.stats_rpn, falkon_detector_models=self.falkon_detector_models, regressors_detector_models=self.regressors_detector_models, stats_detector=self.stats_detector)
+        model = self.session.model
 
-        if self.distributed:
-            model = model.module
+        if self.cfg.SAVE_FEATURES_DETECTOR and is_train:
+            model.roi_heads.box.feature_writer = FeatureStoreWriter(os.path.join(result_dir, 'features_detector'), async_write=self.cfg.FEATURE_STORE.ASYNC_WRITER, max_pending_batches=self.cfg.FEATURE_STORE.MAX_PENDING_BATCHES, storage_dtype=self.cfg.FEATURE_STORE.DTYPE)
+            if extract_features_segmentation:
+                model.roi_heads.mask.feature_writer = FeatureStoreWriter(os.path.join(result_dir, 'features_segmentation'), async_write=self.cfg.FEATURE_STORE.ASYNC_WRITER, max_pending_batches=self.cfg.FEATURE_STORE.MAX_PENDING_BATCHES, storage_dtype=self.cfg.FEATURE_STORE.DTYPE)
 
         iou_types = ("bbox",)
         torch.cuda.empty_cache()  # TODO check if it helps
@@ -180,95 +158,86 @@ class FeatureExtractorDetector:
             if is_train:
                 logger = logging.getLogger("maskrcnn_benchmark")
                 logger.handlers=[]
-
-                if self.cfg.SAVE_FEATURES_DETECTOR:
-                    # Save features still not saved
-                    for clss in range(len(model.roi_heads.box.negatives)):
-                        for batch in range(len(model.roi_heads.box.negatives[clss])):
-                            if model.roi_heads.box.negatives[clss][batch].size()[0] > 0:
-                                path_to_save = os.path.join(result_dir, 'features_detector', 'negatives_cl_{}_batch_{}'.format(clss, batch))
-                                torch.save(model.roi_heads.box.negatives[clss][batch], path_to_save)
-                        if use_only_gt_positives_detection:
-                            # If a class does not have positive examples, save an empty tensor
-                            if model.roi_heads.box.positives[clss][0].size()[0] == 0 and len(model.roi_heads.box.positives[clss]) == 1:
-                                path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(clss, 0))
-                                torch.save(torch.empty((0, model.roi_heads.box.feat_size), device=model.roi_heads.box.negatives[clss][0].device), path_to_save)
-                            else:
-                                for batch in range(len(model.roi_heads.box.positives[clss])):
-                                    if model.roi_heads.box.positives[clss][batch].size()[0] > 0:
-                                        path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(clss, batch))
-                                        torch.save(model.roi_heads.box.positives[clss][batch], path_to_save)
-
-                        if extract_features_segmentation:
-                            # If a class does not have positive examples, save an empty tensor
-                            if model.roi_heads.mask.positives[clss][0].size()[0] == 0 and len(
-                                    model.roi_heads.mask.positives[clss]) == 1:
-                                path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                            'positives_cl_{}_batch_{}'.format(clss, 0))
-                                torch.save(torch.empty((0, model.roi_heads.mask.feat_size),
-                                                       device=model.roi_heads.mask.negatives[clss][0].device),
-                                           path_to_save)
-                            else:
-                                for batch in range(len(model.roi_heads.mask.positives[clss])):
-                                    if model.roi_heads.mask.positives[clss][batch].size()[0] > 0:
-                                        path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                                    'positives_cl_{}_batch_{}'.format(clss, batch))
-                                        torch.save(model.roi_heads.mask.positives[clss][batch], path_to_save)
-
-                            # If a class does not have positive examples, save an empty tensor
-                            if model.roi_heads.mask.negatives[clss][0].size()[0] == 0 and len(
-                                    model.roi_heads.mask.negatives[clss]) == 1:
-                                path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                            'negatives_cl_{}_batch_{}'.format(clss, 0))
-                                torch.save(torch.empty((0, model.roi_heads.mask.feat_size),
-                                                       device=model.roi_heads.mask.negatives[clss][0].device),
-                                           path_to_save)
-                            else:
-                                for batch in range(len(model.roi_heads.mask.negatives[clss])):
-                                    if model.roi_heads.mask.negatives[clss][batch].size()[0] > 0:
-                                        path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                                    'negatives_cl_{}_batch_{}'.format(clss, batch))
-                                        torch.save(model.roi_heads.mask.negatives[clss][batch], path_to_save)
-
-                    for i in range(len(model.roi_heads.box.X)):
-                        if model.roi_heads.box.X[i].size()[0] > 0:
-                            path_to_save = os.path.join(result_dir, 'features_detector', 'reg_x_batch_{}'.format(i))
-                            torch.save(model.roi_heads.box.X[i], path_to_save)
-
-                            path_to_save = os.path.join(result_dir, 'features_detector', 'reg_c_batch_{}'.format(i))
-                            torch.save(model.roi_heads.box.C[i], path_to_save)
-
-                            path_to_save = os.path.join(result_dir, 'features_detector', 'reg_y_batch_{}'.format(i))
-                            torch.save(model.roi_heads.box.Y[i], path_to_save)
-                    return
-                else:
-                    COXY = {'C': torch.cat(model.roi_heads.box.C),
-                            'O': model.roi_heads.box.O,
-                            'X': torch.cat(model.roi_heads.box.X),
-                            'Y': torch.cat(model.roi_heads.box.Y)
-                            }
-                    for i in range(self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES):
-                        if use_only_gt_positives_detection:
-                            model.roi_heads.box.positives[i] = torch.cat(model.roi_heads.box.positives[i])
-                        if extract_features_segmentation:
-                            if self.cfg.SEGMENTATION.FEATURES_DEVICE == 'cpu':
-                                model.roi_heads.mask.negatives[i][len(model.roi_heads.mask.negatives[i])-1] = model.roi_heads.mask.negatives[i][len(model.roi_heads.mask.negatives[i])-1].to('cpu')
-                            model.roi_heads.mask.negatives[i] = torch.cat(model.roi_heads.mask.negatives[i])
-                            if self.cfg.SEGMENTATION.FEATURES_DEVICE == 'cpu':
-                                model.roi_heads.mask.positives[i][len(model.roi_heads.mask.positives[i])-1] = model.roi_heads.mask.positives[i][len(model.roi_heads.mask.positives[i])-1].to('cpu')
-                            model.roi_heads.mask.positives[i] = torch.cat(model.roi_heads.mask.positives[i])
-                    if extract_features_segmentation:
-                        if use_only_gt_positives_detection:
-                            return copy.deepcopy(model.roi_heads.box.negatives), copy.deepcopy(model.roi_heads.box.positives), copy.deepcopy(COXY), copy.deepcopy(model.roi_heads.mask.negatives), copy.deepcopy(model.roi_heads.mask.positives)
-                        else:
-                            return copy.deepcopy(model.roi_heads.box.negatives), None, copy.deepcopy(COXY), copy.deepcopy(model.roi_heads.mask.negatives), copy.deepcopy(model.roi_heads.mask.positives)
-
-                    else:
-                        if use_only_gt_positives_detection:
-                            return copy.deepcopy(model.roi_heads.box.negatives), copy.deepcopy(model.roi_heads.box.positives), copy.deepcopy(COXY)
-                        else:
-                            return copy.deepcopy(model.roi_heads.box.negatives), None, copy.deepcopy(COXY)
+                self.feature_statistics = model.roi_heads.box.feature_statistics
+                if extract_features_segmentation:
+                    self.feature_statistics_segmentation = model.roi_heads.mask.feature_statistics
+                features = collect_detector_features(self.cfg, model.roi_heads, result_dir, extract_features_segmentation=extract_features_segmentation, use_only_gt_positives_detection=use_only_gt_positives_detection)
             else:
                 logger = logging.getLogger("maskrcnn_benchmark")
                 logger.handlers=[]
-                return copy.deepcopy(model.roi_heads.box.test_boxes)
+                features = model.roi_heads.box.test_boxes
+            # Sampled features are not kept in the resident model, the caller becomes their only owner
+            self.session.release()
+            return features
+
+
+def collect_detector_features(cfg, roi_heads, result_dir=None, extract_features_segmentation=False, use_only_gt_positives_detection=True):
+    """
+    Saves the features still in the buffers of the box (and mask) samplers of roi_heads, if cfg.SAVE_FEATURES_DETECTOR
+    is set, else returns their negatives, positives and regression data. In both cases the samplers release their
+    buffers, so that the returned features are owned only by the caller.
+    """
+    if cfg.SAVE_FEATURES_DETECTOR:
+        # Save features still not saved
+        feature_writer = roi_heads.box.feature_writer
+        if extract_features_segmentation:
+            feature_writer_segm = roi_heads.mask.feature_writer
+        for clss in range(len(roi_heads.box.negatives)):
+            for batch in range(len(roi_heads.box.negatives[clss])):
+                feature_writer.append('negatives_cl_{}'.format(clss), roi_heads.box.negatives[clss][batch].view())
+            if use_only_gt_positives_detection:
+                # Classes without positive examples are saved as empty entries
+                for batch in range(len(roi_heads.box.positives[clss])):
+                    feature_writer.append('positives_cl_{}'.format(clss), roi_heads.box.positives[clss][batch].view())
+
+            if extract_features_segmentation:
+                for batch in range(len(roi_heads.mask.positives[clss])):
+                    feature_writer_segm.append('positives_cl_{}'.format(clss), roi_heads.mask.positives[clss][batch].view())
+                for batch in range(len(roi_heads.mask.negatives[clss])):
+                    feature_writer_segm.append('negatives_cl_{}'.format(clss), roi_heads.mask.negatives[clss][batch].view())
+
+        for i in range(len(roi_heads.box.X)):
+            if len(roi_heads.box.X[i]) > 0:
+                feature_writer.append('reg_x', roi_heads.box.X[i].view())
+                feature_writer.append('reg_c', roi_heads.box.C[i].view())
+                feature_writer.append('reg_y', roi_heads.box.Y[i].view())
+        if roi_heads.box.regression_statistics is not None:
+            roi_heads.box.regression_statistics.save(os.path.join(result_dir, 'features_detector', STATISTICS_FILE_NAME))
+        roi_heads.box.feature_statistics.save(os.path.join(result_dir, 'features_detector', FEATURE_STATISTICS_FILE_NAME))
+        if extract_features_segmentation:
+            roi_heads.mask.feature_statistics.save(os.path.join(result_dir, 'features_segmentation', FEATURE_STATISTICS_FILE_NAME))
+        feature_writer.close()
+        if extract_features_segmentation:
+            feature_writer_segm.close()
+        release_detector_features(roi_heads)
+        return
+    else:
+        if roi_heads.box.regression_statistics is not None:
+            # Regressors are trained from their sufficient statistics
+            COXY = roi_heads.box.regression_statistics
+        else:
+            COXY = {'C': torch.cat(buffer_views(roi_heads.box.C)),
+                    'O': roi_heads.box.O,
+                    'X': torch.cat(buffer_views(roi_heads.box.X)).to(getattr(torch, cfg.FEATURE_STORE.IN_MEMORY_DTYPE)),
+                    'Y': torch.cat(buffer_views(roi_heads.box.Y))
+                    }
+        negatives = buffer_views(roi_heads.box.negatives)
+        for i in range(cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES):
+            if use_only_gt_positives_detection:
+                roi_heads.box.positives[i] = torch.cat(buffer_views(roi_heads.box.positives[i]))
+            if extract_features_segmentation:
+                # Segmentation buffers are already on SEGMENTATION.FEATURES_DEVICE
+                roi_heads.mask.negatives[i] = torch.cat(buffer_views(roi_heads.mask.negatives[i]))
+                roi_heads.mask.positives[i] = torch.cat(buffer_views(roi_heads.mask.positives[i]))
+        features = negatives, roi_heads.box.positives if use_only_gt_positives_detection else None, COXY
+        if extract_features_segmentation:
+            features += roi_heads.mask.negatives, roi_heads.mask.positives
+        release_detector_features(roi_heads)
+        return features
+
+
+def release_detector_features(roi_heads):
+    # The samplers drop their references to the features, which are then owned only by the caller
+    roi_heads.box.release_online_state()
+    if hasattr(roi_heads, 'mask'):
+        roi_heads.mask.release_online_state()
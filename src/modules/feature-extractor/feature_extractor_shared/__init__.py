@@ -0,0 +1 @@
+from .extract_features_shared import FeatureExtractorShared
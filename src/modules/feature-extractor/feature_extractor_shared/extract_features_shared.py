@@ -0,0 +1,194 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+r"""
+Extraction of RPN and detector features on the training set with a single backbone pass per image
+"""
+
+import os
+
+import torch
+from mrcnn_modified.config import cfg
+
+from mrcnn_modified.data import make_data_loader
+
+from maskrcnn_benchmark.solver import make_lr_scheduler
+from maskrcnn_benchmark.solver import make_optimizer
+
+from mrcnn_modified.modeling.detector.detectors_shared_backbone import build_detection_model
+from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
+from maskrcnn_benchmark.utils.collect_env import collect_env_info
+from maskrcnn_benchmark.utils.comm import synchronize, get_rank
+from maskrcnn_benchmark.utils.logger import setup_logger
+from maskrcnn_benchmark.utils.miscellaneous import mkdir
+
+from mrcnn_modified.engine.feature_proposal_extractor import inference
+from mrcnn_modified.utils.feature_store import FeatureStoreWriter
+from feature_extractor_RPN import collect_rpn_features
+from feature_extractor_detector import collect_detector_features
+import logging
+# See if we can use apex.DistributedDataParallel instead of the torch default,
+# and enable mixed-precision via apex.amp
+try:
+    from apex import amp
+except ImportError:
+    raise ImportError('Use APEX for multi-precision via apex.amp')
+
+class FeatureExtractorShared:
+    """
+    Extracts the features of the online RPN and of the online detector from the same backbone features, loading the
+    model once and iterating the training set once. Detector features are sampled from the proposals of the pretrained
+    RPN, since the online RPN is trained on the features extracted in the same pass.
+    """
+
+    def __init__(self, cfg_path_target_task=None, cfg_path_RPN=None, local_rank=0):
+
+        self.is_target_task = True
+        self.config_file = cfg_path_target_task
+        self.config_file_RPN = cfg_path_RPN
+        self.num_gpus = int(os.environ["WORLD_SIZE"]) if "WORLD_SIZE" in os.environ else 1
+        self.distributed = self.num_gpus > 1
+        self.local_rank = local_rank
+        self.cfg = cfg.clone()
+        self.cfg_rpn = cfg.clone()
+        # Statistics of the extracted features, set after the extraction
+        self.feature_statistics_rpn = None
+        self.feature_statistics_detector = None
+        self.feature_statistics_segmentation = None
+        self.load_parameters()
+
+    def __call__(self, output_dir=None, train_in_cpu=False, save_RPN_features=False, save_detector_features=False, extract_features_segmentation=False):
+        for c in (self.cfg, self.cfg_rpn):
+            c.TRAIN_FALKON_REGRESSORS_DEVICE = 'cpu' if train_in_cpu else 'cuda'
+        self.cfg_rpn.SAVE_FEATURES_RPN = save_RPN_features
+        self.cfg.SAVE_FEATURES_DETECTOR = save_detector_features
+        self.cfg.MINIBOOTSTRAP.DETECTOR.EXTRACT_ONLY_GT_POSITIVES = True
+        features_dirs = []
+        if save_RPN_features:
+            features_dirs.append('features_RPN')
+        if save_detector_features:
+            features_dirs.append('features_detector')
+            if extract_features_segmentation:
+                features_dirs.append('features_segmentation')
+        if features_dirs:
+            if output_dir:
+                for features_dir in features_dirs:
+                    features_path = os.path.join(output_dir, features_dir)
+                    if not os.path.exists(features_path):
+                        os.mkdir(features_path)
+            else:
+                print('Output directory must be specified. Quitting.')
+                quit()
+        return self.train(result_dir=output_dir, extract_features_segmentation=extract_features_segmentation)
+
+    def load_parameters(self):
+        if self.distributed:
+            torch.cuda.set_device(self.local_rank)
+            torch.distributed.init_process_group(
+                backend="nccl", init_method="env://"
+            )
+            synchronize()
+        self.cfg.merge_from_file(self.config_file)
+        self.cfg_rpn.merge_from_file(self.config_file_RPN)
+        # Both the models are computed from the same backbone features
+        for key in ('MODEL.WEIGHT', 'MODEL.BACKBONE.CONV_BODY', 'INPUT.MIN_SIZE_TEST', 'INPUT.MAX_SIZE_TEST', 'DATASETS.TRAIN'):
+            value, value_rpn = self.cfg, self.cfg_rpn
+            for k in key.split('.'):
+                value, value_rpn = value[k], value_rpn[k]
+            if value != value_rpn:
+                print('Unconsistency! {} differs between {} and {}. Features cannot be extracted with a shared backbone. Quitting.'.format(key, self.config_file, self.config_file_RPN))
+                quit()
+        self.icwt_21_objs = True if str(21) in self.cfg.DATASETS.TRAIN[0] else False
+        if self.cfg.OUTPUT_DIR:
+            mkdir(self.cfg.OUTPUT_DIR)
+        logger = setup_logger("maskrcnn_benchmark", self.cfg.OUTPUT_DIR, get_rank())
+        logger.info("Using {} GPUs".format(self.num_gpus))
+        logger.info("Collecting env info (might take some time)")
+        logger.info("\n" + collect_env_info())
+        for config_file in (self.config_file, self.config_file_RPN):
+            logger.info("Loaded configuration file {}".format(config_file))
+            with open(config_file, "r") as cf:
+                config_str = "\n" + cf.read()
+                logger.info(config_str)
+        logger.info("Running with config:\n{}".format(self.cfg))
+
+
+    def train(self, result_dir=None, extract_features_segmentation=False):
+        model = build_detection_model(self.cfg, self.cfg_rpn)
+        device = torch.device(self.cfg.MODEL.DEVICE)
+        model.to(device)
+
+        optimizer = make_optimizer(self.cfg, model)
+        scheduler = make_lr_scheduler(self.cfg, optimizer)
+
+        # Initialize mixed-precision training
+        use_mixed_precision = self.cfg.DTYPE == "float16"
+        amp_opt_level = 'O1' if use_mixed_precision else 'O0'
+        model, optimizer = amp.initialize(model, optimizer, opt_level=amp_opt_level)
+
+        if self.distributed:
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=[self.local_rank], output_device=self.local_rank,
+                # this should be removed if we update BatchNorm stats
+                broadcast_buffers=False,
+            )
+
+        output_dir = self.cfg.OUTPUT_DIR
+
+        save_to_disk = get_rank() == 0
+        checkpointer = DetectronCheckpointer(
+            self.cfg, model, optimizer, scheduler, output_dir, save_to_disk
+        )
+
+        if self.cfg.MODEL.WEIGHT.startswith('/') or 'catalog' in self.cfg.MODEL.WEIGHT:
+            model_path = self.cfg.MODEL.WEIGHT
+        else:
+            model_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir, 'Data', 'pretrained_feature_extractors', self.cfg.MODEL.WEIGHT))
+
+        extra_checkpoint_data = checkpointer.load(model_path)
+
+        if self.distributed:
+            model = model.module
+
+        if self.cfg_rpn.SAVE_FEATURES_RPN:
+            model.rpn_sampler.feature_writer = FeatureStoreWriter(os.path.join(result_dir, 'features_RPN'), async_write=self.cfg_rpn.FEATURE_STORE.ASYNC_WRITER, max_pending_batches=self.cfg_rpn.FEATURE_STORE.MAX_PENDING_BATCHES, storage_dtype=self.cfg_rpn.FEATURE_STORE.DTYPE)
+        if self.cfg.SAVE_FEATURES_DETECTOR:
+            model.roi_heads.box.feature_writer = FeatureStoreWriter(os.path.join(result_dir, 'features_detector'), async_write=self.cfg.FEATURE_STORE.ASYNC_WRITER, max_pending_batches=self.cfg.FEATURE_STORE.MAX_PENDING_BATCHES, storage_dtype=self.cfg.FEATURE_STORE.DTYPE)
+            if extract_features_segmentation:
+                model.roi_heads.mask.feature_writer = FeatureStoreWriter(os.path.join(result_dir, 'features_segmentation'), async_write=self.cfg.FEATURE_STORE.ASYNC_WRITER, max_pending_batches=self.cfg.FEATURE_STORE.MAX_PENDING_BATCHES, storage_dtype=self.cfg.FEATURE_STORE.DTYPE)
+
+        iou_types = ("bbox",)
+        torch.cuda.empty_cache()
+
+        if self.cfg.OUTPUT_DIR:
+            mkdir(os.path.join(self.cfg.OUTPUT_DIR, 'train'))
+
+        data_loader = make_data_loader(self.cfg, is_train=True, is_distributed=self.distributed, is_final_test=True, is_target_task=self.is_target_task, icwt_21_objs=self.icwt_21_objs)[0]
+
+        feat_extraction_time = inference(self.cfg,
+                                         model,
+                                         data_loader,
+                                         dataset_name='train',
+                                         iou_types=iou_types,
+                                         box_only=False if self.cfg.MODEL.RETINANET_ON else self.cfg.MODEL.RPN_ONLY,
+                                         device=cfg.MODEL.DEVICE,
+                                         is_target_task=self.is_target_task,
+                                         icwt_21_objs=self.icwt_21_objs,
+                                         is_train=True,
+                                         result_dir=result_dir,
+                                         extract_features_segmentation=extract_features_segmentation
+                                        )
+
+        if result_dir:
+            with open(os.path.join(result_dir, "result.txt"), "a") as fid:
+                fid.write("RPN's and detector's feature extraction time: {}min:{}s \n".format(int(feat_extraction_time/60), round(feat_extraction_time%60)))
+
+        synchronize()
+        logger = logging.getLogger("maskrcnn_benchmark")
+        logger.handlers=[]
+
+        self.feature_statistics_rpn = model.rpn_sampler.feature_statistics
+        self.feature_statistics_detector = model.roi_heads.box.feature_statistics
+        if extract_features_segmentation:
+            self.feature_statistics_segmentation = model.roi_heads.mask.feature_statistics
+        rpn_features = collect_rpn_features(self.cfg_rpn, model.rpn_sampler, result_dir)
+        detector_features = collect_detector_features(self.cfg, model.roi_heads, result_dir, extract_features_segmentation=extract_features_segmentation)
+        return rpn_features, detector_features
@@ -86,6 +86,9 @@ _C.DATALOADER.SIZE_DIVISIBILITY = 0
 # is compatible. This groups portrait images together, and landscape images
 # are not batched with portrait images.
 _C.DATALOADER.ASPECT_RATIO_GROUPING = True
+# Number of worker processes decoding and transforming the images of feature extraction and evaluation ahead of the
+# model, 0 to load them in the main process
+_C.DATALOADER.PREFETCH_WORKERS = 4
 
 
 # ---------------------------------------------------------------------------- #
@@ -171,6 +174,8 @@ _C.MODEL.RPN.FPN_POST_NMS_TOP_N_TEST = 2000
 _C.MODEL.RPN.FPN_POST_NMS_PER_BATCH = True
 # Custom rpn head, empty to use default conv or separable conv
 _C.MODEL.RPN.RPN_HEAD = "SingleConvRPNHead"
+# Number of (image size, features map size) pairs whose anchors are kept in the RPN anchors cache
+_C.MODEL.RPN.ANCHORS_CACHE_SIZE = 8
 
 
 # ---------------------------------------------------------------------------- #
@@ -497,6 +502,9 @@ _C.MINIBOOTSTRAP.DETECTOR.EXTRACT_ONLY_GT_POSITIVES = True
 # ---------------------------------------------------------------------------- #
 _C.REGRESSORS = CN()
 _C.REGRESSORS.MIN_OVERLAP = 0.6
+# Accumulate per-class sufficient statistics (X'X, X'Y, Y'Y) of the regressors during feature extraction, instead of
+# keeping the regression features
+_C.REGRESSORS.SUFFICIENT_STATISTICS = False
 
 # ---------------------------------------------------------------------------- #
 # Segmentation parameters
@@ -511,4 +519,25 @@ _C.SEGMENTATION.FEATURES_DEVICE = 'cuda'
 # ---------------------------------------------------------------------------- #
 _C.EVALUATION = CN()
 _C.EVALUATION.IOU_THRESHOLDS = (0.5,)
-_C.EVALUATION.USE_VOC07_METRIC = True
\ No newline at end of file
+_C.EVALUATION.USE_VOC07_METRIC = True
+# ---------------------------------------------------------------------------- #
+# Saved features parameters
+# ---------------------------------------------------------------------------- #
+_C.FEATURE_STORE = CN()
+# Write full batches of features to disk from a background thread
+_C.FEATURE_STORE.ASYNC_WRITER = True
+# Maximum number of batches waiting to be written, before the extraction blocks
+_C.FEATURE_STORE.MAX_PENDING_BATCHES = 8
+# Precision of the features saved on disk: float32, float16, bfloat16 or int8 (with a per-channel offset and scale for
+# each entry, derived from the statistics of the sampled features)
+_C.FEATURE_STORE.DTYPE = 'float32'
+# Precision of the features kept in memory for the regressors and for the test set: float32 or float16
+_C.FEATURE_STORE.IN_MEMORY_DTYPE = 'float32'
+# ---------------------------------------------------------------------------- #
+# Backbone feature maps cache parameters
+# ---------------------------------------------------------------------------- #
+_C.BACKBONE_CACHE = CN()
+# Directory where the backbone feature maps of the images are cached on disk. The cache is disabled if empty
+_C.BACKBONE_CACHE.DIR = ''
+# Maximum size of the cache in GB, beyond which the least recently used feature maps are removed. 0 means no limit
+_C.BACKBONE_CACHE.MAX_SIZE_GB = 50.0
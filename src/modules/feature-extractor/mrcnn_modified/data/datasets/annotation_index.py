@@ -0,0 +1,176 @@
+import glob
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+if sys.version_info[0] == 2:
+    import xml.etree.cElementTree as ET
+else:
+    import xml.etree.ElementTree as ET
+
+# Bump to invalidate the indices saved with a different format
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.annotation_index.npz'
+
+
+def index_key(imgset_path, annotation_files, *params):
+    """
+    Hash of the contents of a split file, of the modification time and size of the annotation files of its images and
+    of the parameters used to build its index. annotation_files(img_id) returns the annotation files of an image.
+    """
+    sha1 = hashlib.sha1()
+    with open(imgset_path, 'rb') as f:
+        contents = f.read()
+    sha1.update(contents)
+    visited = set()
+    for img_id in contents.decode('utf-8').splitlines():
+        if not img_id.strip():
+            continue
+        for path in annotation_files(img_id):
+            if path in visited:
+                continue
+            visited.add(path)
+            # Missing files are hashed too, so that adding them invalidates the index
+            try:
+                stat = os.stat(path)
+                sha1.update(repr((path, stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+            except OSError:
+                sha1.update(repr((path, None)).encode('utf-8'))
+    sha1.update(repr((INDEX_VERSION,) + params).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class AnnotationIndex(object):
+    """
+    Annotations of all the images of a dataset split, in the order of the split file. Per-object arrays (boxes,
+    names, labels, difficult flags and mask paths) are concatenated, and the objects of image i are the rows between
+    offsets[i] and offsets[i+1]. Boxes are kept as written in the annotations, names are empty and labels are -1 when
+    the annotations do not provide them, difficult is -1 when the flag is missing.
+    """
+
+    FIELDS = ('ids', 'sizes', 'offsets', 'boxes', 'names', 'labels', 'difficult', 'mask_paths')
+
+    def __init__(self, key, **arrays):
+        self.key = key
+        for field in AnnotationIndex.FIELDS:
+            setattr(self, field, arrays[field])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def image(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {'id': str(self.ids[i]),
+                'height': int(self.sizes[i, 0]),
+                'width': int(self.sizes[i, 1]),
+                'boxes': self.boxes[start:end],
+                'names': self.names[start:end],
+                'labels': self.labels[start:end],
+                'difficult': self.difficult[start:end],
+                'mask_paths': self.mask_paths[start:end]}
+
+    def save(self, path):
+        # Write to a temporary file first, so that an interrupted save does not leave a truncated index
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=np.array(self.key), **{field: getattr(self, field) for field in AnnotationIndex.FIELDS})
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, key):
+        # Returns None if the index does not exist or it has been built for different contents
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data['key']) != key:
+                    return None
+                return AnnotationIndex(key, **{field: data[field] for field in AnnotationIndex.FIELDS})
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def from_lists(key, ids, sizes, objects):
+        # objects[i] is the list of (box, name, label, difficult, mask_path) of image i
+        flat = [o for objects_i in objects for o in objects_i]
+        return AnnotationIndex(key,
+                               ids=np.array(ids, dtype=str),
+                               sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2),
+                               offsets=np.cumsum([0] + [len(o) for o in objects]).astype(np.int64),
+                               boxes=np.array([o[0] for o in flat], dtype=np.float32).reshape(-1, 4),
+                               names=np.array([o[1] for o in flat], dtype=str),
+                               labels=np.array([o[2] for o in flat], dtype=np.int64),
+                               difficult=np.array([o[3] for o in flat], dtype=np.int8),
+                               mask_paths=np.array([o[4] for o in flat], dtype=str))
+
+
+def load_or_build_index(imgset_path, key, build):
+    """
+    Loads the index saved next to the split file, or builds it with build(key) and saves it. If the split directory is
+    not writable, the index is rebuilt the next time.
+    """
+    index_path = imgset_path + INDEX_SUFFIX
+    index = AnnotationIndex.load(index_path, key)
+    if index is not None:
+        return index
+    print('Building annotation index of {}'.format(imgset_path))
+    index = build(key)
+    try:
+        index.save(index_path)
+    except OSError:
+        print('Could not write the annotation index of {}. It will be rebuilt the next time.'.format(imgset_path))
+    return index
+
+
+def build_icwt_index(key, imgset_path, annopath, maskpath):
+    with open(imgset_path) as f:
+        ids = [x.strip('\n') for x in f.readlines()]
+    sizes = []
+    objects = []
+    for img_id in ids:
+        root = ET.parse(annopath % img_id, ET.XMLParser(encoding='utf-8')).getroot()
+        size = root.find('size')
+        sizes.append((int(size.find('height').text), int(size.find('width').text)))
+        mask_path = maskpath % img_id if os.path.exists(maskpath % img_id) else ''
+        objects_i = []
+        for obj in root.iter('object'):
+            name = obj.find('name')
+            name = name.text if name is not None and name.text is not None else ''
+            try:
+                difficult = int(int(obj.find('difficult').text) == 1)
+            except:
+                difficult = -1
+            bb = obj.find('bndbox')
+            box = [float(bb.find(coord).text) for coord in ('xmin', 'ymin', 'xmax', 'ymax')]
+            objects_i.append((box, name, -1, difficult, mask_path))
+        objects.append(objects_i)
+    return AnnotationIndex.from_lists(key, ids, sizes, objects)
+
+
+def build_ycbv_index(key, imgset_path, imgpath, maskpath, scene_gt_path, scene_gt_info_path):
+    with open(imgset_path) as f:
+        ids = [x.strip('\n') for x in f.readlines()]
+    scene_gts = {}
+    scene_gt_infos = {}
+    sizes = []
+    objects = []
+    for img_id in ids:
+        folder, img = img_id.split()[:2]
+        if folder not in scene_gts:
+            with open(scene_gt_path % folder) as f:
+                scene_gts[folder] = json.load(f)
+            with open(scene_gt_info_path % folder) as f:
+                scene_gt_infos[folder] = json.load(f)
+        scene_gt = scene_gts[folder][str(int(img))]
+        scene_gt_info = scene_gt_infos[folder][str(int(img))]
+        # Only the image header is read
+        width, height = Image.open(imgpath % (folder, img)).size
+        sizes.append((height, width))
+        # Boxes are in xywh format, as in the scene_gt_info files
+        masks_paths = sorted(glob.glob(maskpath % (folder, img + '*')))
+        objects.append([(scene_gt_info[j]['bbox_visib'], '', scene_gt[j]['obj_id'], 0, masks_paths[j]) for j in range(len(masks_paths))])
+    return AnnotationIndex.from_lists(key, ids, sizes, objects)
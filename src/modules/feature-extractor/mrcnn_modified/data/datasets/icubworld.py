@@ -3,15 +3,10 @@ import os
 import torch
 import torch.utils.data
 from PIL import Image
-import sys
-
-if sys.version_info[0] == 2:
-    import xml.etree.cElementTree as ET
-else:
-    import xml.etree.ElementTree as ET
-
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
+from .annotation_index import load_or_build_index, index_key, build_icwt_index
+import numpy as np
 
 
 def _has_only_empty_bbox(anno):
@@ -135,9 +130,13 @@ class iCubWorldDataset(torch.utils.data.Dataset):
                 
         self._imgsetpath = os.path.join(self.root, "ImageSets", self.image_set, self.split + ".txt")
 
-        with open(self._imgsetpath) as f:
-            self.ids = f.readlines()
-        self.ids = [x.strip("\n") for x in self.ids]
+        # Annotations of the split are parsed once and cached next to the split file. Masks are part of the key, since
+        # whether they exist is stored in the index
+        self.annotation_index = load_or_build_index(self._imgsetpath, index_key(self._imgsetpath, lambda img_id: [self._annopath % img_id, self._maskpath % img_id], 'icwt', self._annopath, self._maskpath),
+                                                    lambda key: build_icwt_index(key, self._imgsetpath, self._annopath, self._maskpath))
+        self.ids = [str(x) for x in self.annotation_index.ids]
+        # Rows of the annotation index of the dataset images
+        self.index_rows = list(range(len(self.ids)))
 
         if 'ycbv' in data_dir:
             cls = iCubWorldDataset.CLASSES_YCBV_IN_HAND
@@ -157,14 +156,16 @@ class iCubWorldDataset(torch.utils.data.Dataset):
         remove_images_without_annotations = True
         if remove_images_without_annotations:
             ids = []
-            for img_id in self.ids:
-                anno = ET.parse(self._annopath % img_id).getroot()
-                anno = self._preprocess_annotation(anno)
+            index_rows = []
+            for row, img_id in enumerate(self.ids):
+                anno = self._preprocess_annotation(row)
                 if has_valid_annotation(anno):
                     ids.append(img_id)
+                    index_rows.append(row)
                 else:
                     print("Image id {} doesn't have annotations!".format(img_id))
             self.ids = ids
+            self.index_rows = index_rows
 
         self.id_to_img_map = {k: v for k, v in enumerate(self.ids)}
 
@@ -187,9 +188,7 @@ class iCubWorldDataset(torch.utils.data.Dataset):
         return len(self.ids)
 
     def get_groundtruth(self, index):
-        img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
-        anno = self._preprocess_annotation(anno)
+        anno = self._preprocess_annotation(self.index_rows[index])
 
         height, width = anno["im_info"]
 
@@ -198,55 +197,31 @@ class iCubWorldDataset(torch.utils.data.Dataset):
         target.add_field("difficult", anno["difficult"])
         return target
 
-    def _preprocess_annotation(self, target):
-        boxes = []
-        gt_classes = []
-        difficult_boxes = []
-        masks = []
+    def _preprocess_annotation(self, row):
+        anno = self.annotation_index.image(row)
         TO_REMOVE = 1
-        
-        for obj in target.iter("object"):
-            try:
-                difficult = int(obj.find("difficult").text) == 1
-            except:
-                continue
-            if not self.keep_difficult and difficult:
-                continue
-            name = obj.find("name").text.lower().strip()
-            bb = obj.find("bndbox")
-            # Make pixel indexes 0-based
-            # Refer to "https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/datasets/pascal_voc.py#L208-L211"
-            box = [
-                bb.find("xmin").text, 
-                bb.find("ymin").text, 
-                bb.find("xmax").text, 
-                bb.find("ymax").text,
-            ]
-            bndbox = tuple(
-                map(lambda x: x - TO_REMOVE, list(map(int, box)))          
-            )
-
-            boxes.append(bndbox)
-            gt_classes.append(self.class_to_ind[name])
-            difficult_boxes.append(difficult)
-
-        size = target.find("size")
-        im_info = tuple(map(int, (size.find("height").text, size.find("width").text)))
+
+        # Objects without the difficult flag are skipped
+        keep = anno["difficult"] >= 0
+        if not self.keep_difficult:
+            keep &= anno["difficult"] == 0
+        # Make pixel indexes 0-based
+        # Refer to "https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/datasets/pascal_voc.py#L208-L211"
+        boxes = anno["boxes"][keep].astype(np.int64) - TO_REMOVE
+        gt_classes = [self.class_to_ind[name.lower().strip()] for name in anno["names"][keep]]
+        difficult_boxes = (anno["difficult"][keep] == 1).tolist()
 
         res = {
             "boxes": torch.tensor(boxes, dtype=torch.float32),
-            "labels": torch.tensor(gt_classes),
-            "difficult": torch.tensor(difficult_boxes),
-            "im_info": im_info,
+            "labels": torch.tensor(gt_classes, dtype=torch.int64),
+            "difficult": torch.tensor(difficult_boxes, dtype=torch.bool),
+            "im_info": (anno["height"], anno["width"]),
         }
         return res
 
     def get_img_info(self, index):
-        img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
-        size = anno.find("size")
-        im_info = tuple(map(int, (size.find("height").text, size.find("width").text)))
-        return {"height": im_info[0], "width": im_info[1]}
+        anno = self.annotation_index.image(self.index_rows[index])
+        return {"height": anno["height"], "width": anno["width"]}
 
     def map_class_id_to_class_name(self, class_id, is_target_task=False, icwt_21_objs=False):
         if is_target_task is False:
@@ -4,14 +4,14 @@ import torch
 import torch.utils.data
 from PIL import Image
 import sys
-import json
 
 from torchvision import transforms as T
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.structures.segmentation_mask import SegmentationMask
+from .annotation_index import load_or_build_index, index_key, build_ycbv_index
 
-import glob
+import numpy as np
 
 def _has_only_empty_bbox(anno):
     try:
@@ -89,31 +89,10 @@ class YCBVideoDataset(torch.utils.data.Dataset):
 
         self._imgsetpath = os.path.join(self.root, self.split + ".txt")
 
-        imset = open(self._imgsetpath, "r")
-        folder_list = []
-        folder_list_int = []
-        for line in imset.readlines():
-            folder_num = line.split()[0]
-            if folder_num not in folder_list:
-                folder_list.append(folder_num)
-                folder_list_int.append(int(folder_num))
-        folder_list = sorted(folder_list)
-
-        self.scene_gts = [None] * (max(folder_list_int)+1)
-        self.scene_gt_infos = [None] * (max(folder_list_int)+1)
-        for i in range(len(folder_list)):
-            f = open(self._scene_gt_path % folder_list[i])
-            scene_gt = json.load(f)
-            f.close()
-            self.scene_gts[int(folder_list[i])] = scene_gt
-            f = open(self._scene_gt_info_path % folder_list[i])
-            scene_gt_info = json.load(f)
-            f.close()
-            self.scene_gt_infos[int(folder_list[i])] = scene_gt_info
-
-        with open(self._imgsetpath) as f:
-            self.ids = f.readlines()
-        self.ids = [x.strip("\n") for x in self.ids]
+        # Annotations of the split are read once and cached next to the split file
+        self.annotation_index = load_or_build_index(self._imgsetpath, index_key(self._imgsetpath, lambda img_id: [p % img_id.split()[0] for p in (self._scene_gt_path, self._scene_gt_info_path)], 'ycbv', self._imgpath, self._maskpath),
+                                                    lambda key: build_ycbv_index(key, self._imgsetpath, self._imgpath, self._maskpath, self._scene_gt_path, self._scene_gt_info_path))
+        self.ids = [str(x) for x in self.annotation_index.ids]
 
     def __getitem__(self, index):
 
@@ -132,55 +111,29 @@ class YCBVideoDataset(torch.utils.data.Dataset):
         return img, target, index
 
     def __len__(self):
-        with open(self._imgsetpath) as f:
-            self.ids = f.readlines()
         return len(self.ids)
 
     def get_groundtruth(self, index):
+        anno = self.annotation_index.image(index)
+        width, height = anno["width"], anno["height"]
 
-        img_dir = self._imgpath
-        imgset_path = self._imgsetpath
-        mask_dir = self._maskpath
-
-        imset = open(imgset_path, "r")
-
-        img_path = imset.readlines()[index].strip('\n').split()
-
-        filename_path = img_dir % (img_path[0], img_path[1])
-        scene_gt_path = self._scene_gt_path % img_path[0]
-
-        scene_gt = self.scene_gts[int(img_path[0])]
-        scene_gt_info = self.scene_gt_infos[int(img_path[0])]
-
-        img_RGB = Image.open(filename_path)
-        # get image size such that later the boxes can be resized to the correct size
-        width, height = img_RGB.size
-        masks_paths = sorted(glob.glob(mask_dir % (img_path[0], img_path[1] + '*')))
-
-        gt_labels = []
-        gt_bboxes_list = []
-        masks = []
-        difficult_boxes = []
-
-        for j in range(len(masks_paths)):
-            bbox = scene_gt_info[str(int(img_path[1]))][j]["bbox_visib"]
-            if bbox == [-1, -1, -1, -1]:
-                continue
-            gt_bboxes_list.append([bbox[0], bbox[1], bbox[0] + bbox[2] -1, bbox[1] + bbox[3] -1])
-            gt_labels.append(scene_gt[str(int(img_path[1]))][j]["obj_id"])
-            masks.append(T.ToTensor()(Image.open(masks_paths[j])))
-            difficult_boxes.append(False)
+        # Objects without a visible box are skipped. Boxes are converted from xywh to xyxy
+        keep = ~np.all(anno["boxes"] == -1, axis=1)
+        boxes = anno["boxes"][keep]
+        gt_bboxes_list = np.concatenate((boxes[:, :2], boxes[:, :2] + boxes[:, 2:] - 1), axis=1)
+        masks = [T.ToTensor()(Image.open(mask_path)) for mask_path in anno["mask_paths"][keep]]
 
         target = BoxList(torch.tensor(gt_bboxes_list), (width, height), mode="xyxy")
         masks = SegmentationMask(torch.cat(masks), (width, height), mode="mask")
-        target.add_field("labels", torch.tensor(gt_labels))
+        target.add_field("labels", torch.tensor(anno["labels"][keep]))
         target.add_field("masks", masks)
-        target.add_field("difficult", torch.tensor(difficult_boxes))
+        target.add_field("difficult", torch.zeros((len(gt_bboxes_list),), dtype=torch.bool))
 
         return target
 
     def get_img_info(self, index):
-        return {"height": 480, "width": 640}
+        anno = self.annotation_index.image(index)
+        return {"height": anno["height"], "width": anno["width"]}
 
     def map_class_id_to_class_name(self, class_id):
         return YCBVideoDataset.CLASSES[class_id]
@@ -0,0 +1,41 @@
+import torch
+import torch.utils.data
+
+
+class GroundTruthImages(torch.utils.data.Dataset):
+    """
+    Images of a dataset split, in the order of the split file, with their ground truth. Each item is
+    (index, transformed image, [N, 4] gt boxes, [N, H, W] masks or None, gt labels, image size), with all the tensors
+    on CPU, so that items can be produced by worker processes.
+    """
+
+    def __init__(self, dataset, transforms, compute_gts):
+        self.dataset = dataset
+        self.transforms = transforms
+        # compute_gts(dataset, i) returns image, gt_bboxes_list, masks, gt_labels, img_sizes of the i-th image
+        self.compute_gts = compute_gts
+
+    def __len__(self):
+        return len(self.dataset.ids)
+
+    def __getitem__(self, i):
+        image, gt_bboxes_list, masks, gt_labels, img_sizes = self.compute_gts(self.dataset, i)
+        image = self.transforms(image)
+        gt_bboxes = torch.tensor(gt_bboxes_list, dtype=torch.float32).view(-1, 4)
+        masks = torch.cat(masks) if len(masks) > 0 else None
+        return i, image, gt_bboxes, masks, gt_labels, img_sizes
+
+
+def make_prefetch_loader(dataset, transforms, compute_gts, num_workers=0):
+    """
+    Loads the images of dataset in order, with num_workers processes decoding and transforming them ahead of the
+    consumer into pinned memory. The sequential sampler keeps the order of the split file, so that the sampling
+    performed while consuming the images is reproducible.
+    """
+    return torch.utils.data.DataLoader(
+        GroundTruthImages(dataset, transforms, compute_gts),
+        batch_size=None,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+    )
@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def resample_coefficients(in_size, out_size):
+    """
+    Input taps and weights of each of the out_size outputs of PIL's bilinear resampling, i.e. a triangle filter whose
+    support grows with the downscaling factor, so that downscaled images are antialiased as PIL does.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    center = (torch.arange(out_size, dtype=torch.float64) + 0.5) * scale
+    xmin = torch.floor(center - filterscale + 0.5).clamp(min=0)
+    xmax = torch.floor(center + filterscale + 0.5).clamp(max=in_size)
+    num_taps = int((xmax - xmin).max().item())
+    taps = xmin.unsqueeze(1) + torch.arange(num_taps, dtype=torch.float64)
+    weights = (1 - torch.abs((taps - center.unsqueeze(1) + 0.5) / filterscale)).clamp(min=0)
+    weights[taps >= xmax.unsqueeze(1)] = 0
+    weights = weights / weights.sum(dim=1, keepdim=True)
+    return taps.clamp(max=in_size - 1).long(), weights.to(torch.float32)
+
+
+def resample(x, dim, taps, weights):
+    # Weighted sum of the taps of x along dim, one tap at a time
+    shape = [1] * x.dim()
+    shape[dim] = -1
+    out = x.index_select(dim, taps[:, 0]) * weights[:, 0].view(shape)
+    for k in range(1, taps.size()[1]):
+        out += x.index_select(dim, taps[:, k]) * weights[:, k].view(shape)
+    return out
+
+
+class TensorTransform(object):
+    """
+    Test-time preprocessing of a uint8 HWC image (numpy array or tensor, with channels in BGR order as returned by
+    OpenCV) into a normalized float CHW tensor, without the PIL round trip of ToPILImage -> Resize -> ToTensor. The
+    shorter side is resized to min_size with bilinear interpolation, rounding to integer pixel values as PIL does, and
+    the BGR255/RGB conversion is fused with the normalization into a single per-channel scale and bias. Downscaled
+    images are resampled with PIL's antialiasing filter, horizontally and then vertically, instead of interpolate,
+    which would alias them. With channels_last, the output has the same shape but is stored in HWC order.
+    """
+
+    def __init__(self, min_size, pixel_mean, pixel_std, to_bgr255=True, channels_last=False):
+        self.min_size = min_size
+        self.channels_last = channels_last
+        pixel_mean = torch.tensor(pixel_mean, dtype=torch.float32)
+        pixel_std = torch.tensor(pixel_std, dtype=torch.float32)
+        if to_bgr255:
+            # x * 255 / 255, channels kept in BGR order
+            self.channels = None
+            self.scale = 1 / pixel_std
+        else:
+            # x / 255 with channels flipped to RGB
+            self.channels = torch.tensor([2, 1, 0])
+            self.scale = 1 / (255 * pixel_std)
+        self.bias = - pixel_mean / pixel_std
+        # Resampling coefficients, per input and output size
+        self.coefficients = {}
+
+    def get_size(self, height, width):
+        # Same output size as torchvision's Resize with an int size
+        if (width <= height and width == self.min_size) or (height <= width and height == self.min_size):
+            return height, width
+        if width < height:
+            return int(self.min_size * height / width), self.min_size
+        return self.min_size, int(self.min_size * width / height)
+
+    def __call__(self, image):
+        if isinstance(image, np.ndarray):
+            image = torch.from_numpy(np.ascontiguousarray(image))
+        height, width = image.size()[0], image.size()[1]
+        x = image.permute(2, 0, 1).unsqueeze(0).to(torch.float32)
+
+        size = self.get_size(height, width)
+        if size[0] < height or size[1] < width:
+            # Intermediate results are rounded to integer pixel values after each pass, as PIL does
+            for dim, in_size, out_size in ((3, width, size[1]), (2, height, size[0])):
+                if (in_size, out_size) not in self.coefficients:
+                    self.coefficients[(in_size, out_size)] = resample_coefficients(in_size, out_size)
+                taps, weights = self.coefficients[(in_size, out_size)]
+                x = resample(x, dim, taps.to(x.device), weights.to(x.device)).round_().clamp_(0, 255)
+        elif size != (height, width):
+            x = F.interpolate(x, size=size, mode='bilinear', align_corners=False)
+            x = x.round_().clamp_(0, 255)
+        if self.channels is not None:
+            x = x.index_select(1, self.channels.to(x.device))
+        elif x.data_ptr() == image.data_ptr():
+            x = x.clone()
+
+        x = x.mul_(self.scale.to(x.device).view(1, -1, 1, 1)).add_(self.bias.to(x.device).view(1, -1, 1, 1))
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x[0]
+
+
+def build_test_transform(cfg, channels_last=False):
+    """
+    Creates the basic transformation that was used to train the models
+    """
+    return TensorTransform(cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.PIXEL_MEAN, cfg.INPUT.PIXEL_STD, to_bgr255=cfg.INPUT.TO_BGR255, channels_last=channels_last)
@@ -6,6 +6,7 @@ from torchvision.transforms import functional as F
 from mrcnn_modified.modeling.detector.detectors_getProposals import build_detection_model
 from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
 from maskrcnn_benchmark.structures.image_list import to_image_list
+from mrcnn_modified.data.tensor_transform import build_test_transform
 from maskrcnn_benchmark.modeling.roi_heads.mask_head.inference import Masker
 from maskrcnn_benchmark import layers as L
 from maskrcnn_benchmark.utils import cv2_util
@@ -151,29 +152,7 @@ class OnlineSegmentationFeatureExtractorDemo(object):
         """
         Creates a basic transformation that was used to train the models
         """
-        # we are loading images with OpenCV, so we don't need to convert them
-        # to BGR, they are already! So all we need to do is to normalize
-        # by 255 if we want to convert to BGR255 format, or flip the channels
-        # if we want it to be in RGB in [0-1] range.
-        if cfg.INPUT.TO_BGR255:
-            to_bgr_transform = T.Lambda(lambda x: x * 255)
-        else:
-            to_bgr_transform = T.Lambda(lambda x: x[[2, 1, 0]])
-
-        normalize_transform = T.Normalize(
-            mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD
-        )
-
-        transform = T.Compose(
-            [
-                T.ToPILImage(),
-                T.Resize(cfg.INPUT.MIN_SIZE_TEST),
-                T.ToTensor(),
-                to_bgr_transform,
-                normalize_transform,
-            ]
-        )
-        return transform
+        return build_test_transform(cfg)
 
     def compute_features(self, original_image, gt_bbox_boxlist, gt_classes_list, extract_features_segmentation=False):
         """
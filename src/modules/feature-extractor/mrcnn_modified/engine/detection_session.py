@@ -0,0 +1,73 @@
+import torch
+
+from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
+
+# Online models that can be set in the pipeline, with the module and the attribute where they are set
+ONLINE_MODELS = {
+    'falkon_rpn_models': ('rpn.head', 'classifiers'),
+    'regressors_rpn_models': ('rpn.head', 'regressors'),
+    'stats_rpn': ('rpn.head', 'stats'),
+    'falkon_detector_models': ('roi_heads.box.predictor', 'classifiers'),
+    'regressors_detector_models': ('roi_heads.box.predictor', 'regressors'),
+    'stats_detector': ('roi_heads.box.predictor', 'stats'),
+    'falkon_segmentation_models': ('roi_heads.mask.predictor', 'classifiers'),
+    'stats_segmentation': ('roi_heads.mask.predictor', 'stats'),
+}
+
+
+class DetectionSession(object):
+    """
+    Detection model built and loaded once, and kept resident across feature extraction and evaluation stages. The
+    model is only used for inference, so no optimizer, scheduler or distributed wrapper is created and apex amp is
+    initialized only for float16 models. Between stages, reset applies the settings of the new stage and
+    set_online_models swaps the online classifiers, regressors and statistics.
+    """
+
+    def __init__(self, cfg, build_detection_model, model_path):
+        self.cfg = cfg
+        self.model_path = model_path
+        model = build_detection_model(cfg)
+        model.to(torch.device(cfg.MODEL.DEVICE))
+        if cfg.DTYPE == "float16":
+            from apex import amp
+            model = amp.initialize(model, opt_level='O1')
+        checkpointer = DetectronCheckpointer(cfg, model)
+        _ = checkpointer.load(model_path)
+        self.model = model
+
+    def reset(self, cfg):
+        # Settings read when the model is built are applied again, and the features sampled in the previous stage are
+        # cleared
+        self.cfg = cfg
+        rpn = getattr(self.model, 'rpn', None)
+        if hasattr(rpn, 'box_selector_test'):
+            rpn.box_selector_test.pre_nms_top_n = cfg.MODEL.RPN.PRE_NMS_TOP_N_TEST
+            rpn.box_selector_test.post_nms_top_n = cfg.MODEL.RPN.POST_NMS_TOP_N_TEST
+            rpn.box_selector_test.fpn_post_nms_top_n = cfg.MODEL.RPN.FPN_POST_NMS_TOP_N_TEST
+        for module in self.model.modules():
+            if hasattr(module, 'reset_online_state'):
+                module.reset_online_state(cfg)
+
+    def release(self):
+        # Drops the features sampled in the last stage, so that they are not kept alive together with the model
+        for module in self.model.modules():
+            if hasattr(module, 'release_online_state'):
+                module.release_online_state()
+
+    def set_online_models(self, **models):
+        # Models set to None are removed, so that the pretrained layers are used in their place
+        for name, value in models.items():
+            module_path, attribute = ONLINE_MODELS[name]
+            module = self.model
+            for m in module_path.split('.'):
+                module = getattr(module, m, None)
+            if module is None:
+                continue
+            if value is not None:
+                setattr(module, attribute, value)
+            elif attribute == 'regressors':
+                # The packed weights of the regressors are released
+                module._regressors = None
+                module.packed_regressors = None
+            elif hasattr(module, attribute):
+                delattr(module, attribute)
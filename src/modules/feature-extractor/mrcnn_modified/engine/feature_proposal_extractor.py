@@ -18,6 +18,10 @@ import glob
 import xml.etree.ElementTree as ET
 
 from torchvision import transforms as T
+from functools import partial
+from mrcnn_modified.data.prefetch_loader import make_prefetch_loader
+from mrcnn_modified.data.tensor_transform import build_test_transform
+from mrcnn_modified.utils.backbone_cache import make_cached_backbone, image_cache_key
 from maskrcnn_benchmark.structures.image_list import to_image_list
 
 OBJECTNAME_TO_ID = {
@@ -70,44 +74,13 @@ OBJECTNAME_TO_ID_YCBV_IN_HAND = {
         "061_foam_brick":19
 }
 
-def build_transform(cfg):
-    """
-    Creates a basic transformation that was used to train the models
-    """
-
-    # we are loading images with OpenCV, so we don't need to convert them
-    # to BGR, they are already! So all we need to do is to normalize
-    # by 255 if we want to convert to BGR255 format, or flip the channels
-    # if we want it to be in RGB in [0-1] range.
-    if cfg.INPUT.TO_BGR255:
-        to_bgr_transform = T.Lambda(lambda x: x * 255)
-    else:
-        to_bgr_transform = T.Lambda(lambda x: x[[2, 1, 0]])
-
-    normalize_transform = T.Normalize(
-        mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD
-    )
-
-    transform = T.Compose(
-        [
-            T.ToPILImage(),
-            T.Resize(cfg.INPUT.MIN_SIZE_TEST),
-            T.ToTensor(),
-            to_bgr_transform,
-            normalize_transform,
-        ]
-    )
-    return transform
-
-def compute_gts_icwt(dataset, i, icwt_21_objs = None):
+def compute_gts_icwt(dataset, i, icwt_21_objs = None, device='cuda'):
     img_dir = dataset._imgpath
     anno_dir = dataset._annopath
-    imgset_path = dataset._imgsetpath
-    mask_dir = dataset._maskpath
 
-    imset = open(imgset_path, "r")
-
-    img_path = imset.readlines()[i].strip('\n')
+    # Annotations of the i-th image of the split file, from the annotation index of the dataset
+    anno = dataset.annotation_index.image(i)
+    img_path = anno['id']
 
     filename_path = img_dir % img_path
     print(filename_path)
@@ -120,23 +93,17 @@ def compute_gts_icwt(dataset, i, icwt_21_objs = None):
         image = np.array(img_RGB)[:, :, [2, 1, 0]]
     except:
         image = np.array(img_RGB.convert('RGB'))[:, :, [2, 1, 0]]
-    mask_path = (mask_dir % img_path)
 
     mask = None
-    if os.path.exists(mask_path):
-        mask = T.ToTensor()(Image.open(mask_path)).to('cuda')
-    # Read in annotation file
-    anno_file = anno_dir % img_path
-    tree = ET.parse(anno_file, ET.XMLParser(encoding='utf-8'))
-    root = tree.getroot()
+    if len(anno['mask_paths']) > 0 and anno['mask_paths'][0]:
+        mask = T.ToTensor()(Image.open(anno['mask_paths'][0])).to(device)
     # Read label
     gt_labels = []
     gt_bboxes_list = []
     masks = []
-    for object in root.findall('object'):
-        try:
-            name = object.find('name').text
-        except:
+    for name, box in zip(anno['names'], anno['boxes']):
+        # Skip objects without name
+        if not name:
             continue
 
         if not icwt_21_objs:
@@ -148,35 +115,23 @@ def compute_gts_icwt(dataset, i, icwt_21_objs = None):
             gt_label = OBJECTNAME_TO_ID_21[name]
         gt_labels.append(gt_label)
 
-        xmin = object.find('bndbox').find('xmin').text
-        ymin = object.find('bndbox').find('ymin').text
-        xmax = object.find('bndbox').find('xmax').text
-        ymax = object.find('bndbox').find('ymax').text
-
-        gt_bboxes_list.append([float(xmin) - 1, float(ymin) - 1, float(xmax) - 1, float(ymax) - 1])
+        gt_bboxes_list.append([float(box[0]) - 1, float(box[1]) - 1, float(box[2]) - 1, float(box[3]) - 1])
         # Please note that that masks gts works only with the modified version of iCWT in which there is only an object per image
         # In the case that on-line segmentation will be necessary on a different extension of iCWT with possibly more than an object per image,
         # this function will be extended according to annotations' format
         if mask is not None:
             masks.append(mask)
-    imset.close()
     return image, gt_bboxes_list, masks, gt_labels, img_sizes
 
-def compute_gts_ycbv(dataset, i, extract_features_segmentation):
-
+def compute_gts_ycbv(dataset, i, extract_features_segmentation, device='cuda'):
     img_dir = dataset._imgpath
-    imgset_path = dataset._imgsetpath
-    mask_dir = dataset._maskpath
-
-    imset = open(imgset_path, "r")
 
-    img_path = imset.readlines()[i].strip('\n').split()
+    # Annotations of the i-th image of the split file, from the annotation index of the dataset
+    anno = dataset.annotation_index.image(i)
+    img_path = anno['id'].split()
 
     filename_path = img_dir%(img_path[0], img_path[1])
 
-    scene_gt = dataset.scene_gts[int(img_path[0])]
-    scene_gt_info = dataset.scene_gt_infos[int(img_path[0])]
-
     print(filename_path)
     img_RGB = Image.open(filename_path)
     # get image size such that later the boxes can be resized to the correct size
@@ -188,25 +143,21 @@ def compute_gts_ycbv(dataset, i, extract_features_segmentation):
     except:
         image = np.array(img_RGB.convert('RGB'))[:, :, [2, 1, 0]]
 
-    masks_paths = sorted(glob.glob(mask_dir%(img_path[0], img_path[1]+'*')))
-
     gt_labels = []
     gt_bboxes_list = []
     masks = []
-
-    for j in range(len(masks_paths)):
-        bbox = scene_gt_info[str(int(img_path[1]))][j]["bbox_visib"]
+    for box, label, mask_path in zip(anno['boxes'], anno['labels'], anno['mask_paths']):
+        bbox = [int(v) for v in box]
         if bbox == [-1, -1, -1, -1] or bbox[2] == 0 or bbox[3] == 0:
             continue
         gt_bboxes_list.append([bbox[0], bbox[1], bbox[0]+bbox[2]-1, bbox[1]+bbox[3]-1])
-        gt_labels.append(scene_gt[str(int(img_path[1]))][j]["obj_id"])
+        gt_labels.append(int(label))
         if extract_features_segmentation:
-            masks.append(T.ToTensor()(Image.open(masks_paths[j])).to('cuda'))
+            masks.append(T.ToTensor()(Image.open(mask_path)).to(device))
 
     return image, gt_bboxes_list, masks, gt_labels, img_sizes
 
 
-
 def extract_feature_proposals(cfg, dataset, model, transforms, icwt_21_objs=False, compute_average_recall_RPN = False, is_train = True, result_dir = None, extract_features_segmentation=False):
 
     model.eval()
@@ -215,45 +166,52 @@ def extract_feature_proposals(cfg, dataset, model, transforms, icwt_21_objs=Fals
     # Set the number of images that will be used to set minibootstrap parameters
     if hasattr(model, 'rpn'):
         model.rpn.cfg.NUM_IMAGES = num_img
+    if hasattr(model, 'rpn_sampler'):
+        model.rpn_sampler.cfg.NUM_IMAGES = num_img
     if hasattr(model, 'roi_heads'):
         model.roi_heads.box.cfg.NUM_IMAGES = num_img
 
     if compute_average_recall_RPN:
         average_recall_RPN = 0
 
-    for i in range(num_img):
-        if type(dataset).__name__ is 'iCubWorldDataset':
-            image, gt_bboxes_list, masks, gt_labels, img_sizes = compute_gts_icwt(dataset, i, icwt_21_objs)
-        elif type(dataset).__name__ is 'YCBVideoDataset':
-            image, gt_bboxes_list, masks, gt_labels, img_sizes = compute_gts_ycbv(dataset, i, extract_features_segmentation=extract_features_segmentation)
+    # Images are decoded, transformed and annotated by worker processes ahead of the model, in the split order
+    if type(dataset).__name__ is 'iCubWorldDataset':
+        compute_gts = partial(compute_gts_icwt, icwt_21_objs=icwt_21_objs, device='cpu')
+    elif type(dataset).__name__ is 'YCBVideoDataset':
+        compute_gts = partial(compute_gts_ycbv, extract_features_segmentation=extract_features_segmentation, device='cpu')
+    data_loader = make_prefetch_loader(dataset, transforms, compute_gts, num_workers=cfg.DATALOADER.PREFETCH_WORKERS)
 
-        # Save list of boxes as tensor
-        gt_bbox_tensor = torch.tensor(gt_bboxes_list, device="cuda")
-        gt_labels_torch = torch.tensor(gt_labels, device="cuda", dtype=torch.uint8).reshape((len(gt_labels),1))
+    # Backbone feature maps are read from the on-disk cache, if enabled
+    cached_backbone = make_cached_backbone(cfg, model.backbone)
+    if cached_backbone is not None:
+        model.backbone = cached_backbone
 
-        if len(masks) > 0:
-            mask_lists = SegmentationMask(torch.cat(masks), img_sizes, mode='mask')
-
-        # create box list containing the ground truth bounding boxes
-        try:
+    # The wrapped backbone is restored also if the loop fails, since the model is kept resident in its session
+    try:
+        for i, image, gt_bbox_tensor, masks, gt_labels, img_sizes in data_loader:
+            if cached_backbone is not None:
+                cached_backbone.image_key = image_cache_key(dataset, i)
+            # Save list of boxes as tensor
+            gt_bbox_tensor = gt_bbox_tensor.to("cuda", non_blocking=True)
+            gt_labels_torch = torch.tensor(gt_labels, device="cuda", dtype=torch.uint8).reshape((len(gt_labels),1))
+
+            # create box list containing the ground truth bounding boxes
             gt_bbox_boxlist = BoxList(gt_bbox_tensor, image_size=img_sizes, mode='xyxy')
-            try:
-                gt_bbox_boxlist.add_field("masks", mask_lists)
-            except:
-                pass
-        except:
-            gt_bbox_boxlist = BoxList(torch.empty((0,4), device="cuda"), image_size=img_sizes, mode='xyxy')
-            
-        # apply pre-processing to image
-        image = transforms(image)
-        # convert to an ImageList
-        image_list = to_image_list(image, 1)
-        image_list = image_list.to("cuda")
-        # compute predictions
-        with torch.no_grad():
-            AR = model(image_list, gt_bbox=gt_bbox_boxlist, gt_label=gt_labels_torch, img_size=img_sizes, compute_average_recall_RPN=compute_average_recall_RPN, gt_labels_list=gt_labels, is_train=is_train, result_dir=result_dir, extract_features_segmentation=extract_features_segmentation)
-            if compute_average_recall_RPN:
-                average_recall_RPN += AR
+            if masks is not None:
+                gt_bbox_boxlist.add_field("masks", SegmentationMask(masks.to("cuda", non_blocking=True), img_sizes, mode='mask'))
+
+            # convert to an ImageList
+            image_list = to_image_list(image, 1)
+            image_list = image_list.to("cuda", non_blocking=True)
+            # compute predictions
+            with torch.no_grad():
+                AR = model(image_list, gt_bbox=gt_bbox_boxlist, gt_label=gt_labels_torch, img_size=img_sizes, compute_average_recall_RPN=compute_average_recall_RPN, gt_labels_list=gt_labels, is_train=is_train, result_dir=result_dir, extract_features_segmentation=extract_features_segmentation)
+                if compute_average_recall_RPN:
+                    average_recall_RPN += AR
+    finally:
+        if cached_backbone is not None:
+            cached_backbone.cache.log_stats()
+            model.backbone = cached_backbone.backbone
 
     if compute_average_recall_RPN:
         return average_recall_RPN / num_img
@@ -285,7 +243,7 @@ def inference(
     total_timer = Timer()
     inference_timer = Timer()
     total_timer.tic()
-    AR = extract_feature_proposals(cfg, dataset, model, build_transform(cfg), icwt_21_objs, compute_average_recall_RPN= not is_train, is_train=is_train, result_dir=result_dir, extract_features_segmentation=extract_features_segmentation)
+    AR = extract_feature_proposals(cfg, dataset, model, build_test_transform(cfg), icwt_21_objs, compute_average_recall_RPN= not is_train, is_train=is_train, result_dir=result_dir, extract_features_segmentation=extract_features_segmentation)
     print('Average Recall (AR):', AR)
 
     if result_dir and not is_train:
@@ -0,0 +1,63 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+"""
+Implements the Generalized R-CNN framework, extracting RPN and detector features from a single backbone pass
+"""
+
+import torch
+from torch import nn
+
+from maskrcnn_benchmark.structures.image_list import to_image_list
+
+from maskrcnn_benchmark.modeling.backbone import build_backbone
+from mrcnn_modified.modeling.rpn.rpn import build_rpn
+from mrcnn_modified.modeling.rpn.rpn_getProposals import build_rpn as build_rpn_sampler
+from ..roi_heads.roi_heads_getProposals import build_roi_heads
+
+
+class GeneralizedRCNN(nn.Module):
+    """
+    Generalized R-CNN which feeds both the RPN and the detector feature extraction with the same backbone features.
+    It consists of four parts:
+    - backbone
+    - rpn: computes the proposals for the detector with the pretrained RPN
+    - rpn_sampler: samples the RPN features for the online RPN, configured by cfg_rpn
+    - heads: sample the detector (and segmentation) features from the proposals of the RPN
+    The conv layer of the RPN head is shared by rpn and rpn_sampler and it is computed once per image.
+    """
+
+    def __init__(self, cfg, cfg_rpn):
+        super(GeneralizedRCNN, self).__init__()
+
+        self.backbone = build_backbone(cfg)
+        self.rpn = build_rpn(cfg, self.backbone.out_channels)
+        self.rpn_sampler = build_rpn_sampler(cfg_rpn, self.backbone.out_channels)
+        # The sampler uses the features of the conv layer of the RPN head, its own head is not needed
+        self.rpn_sampler.head = None
+        self.roi_heads = build_roi_heads(cfg, self.backbone.out_channels)
+
+    def forward(self, images, gt_bbox = None, gt_label = None, img_size = [0,0], compute_average_recall_RPN=False, gt_labels_list = None, is_train = True, result_dir = None, extract_features_segmentation=False):
+        """
+        Arguments:
+            images (list[Tensor] or ImageList): images to be processed
+            gt_bbox (BoxList): ground-truth boxes present in the image
+
+        Returns:
+            average_recall_RPN: average recall of the proposals of the RPN, if compute_average_recall_RPN is True
+
+        """
+        images = to_image_list(images)
+        features = self.backbone(images.tensors)
+        rpn_features = self.rpn.head.conv_features(features)
+        self.rpn_sampler.sample(images, rpn_features[0][0], gt_bbox=gt_bbox)
+        proposals, proposal_losses, average_recall_RPN = self.rpn(images, features, gt_bbox.resize((images.image_sizes[0][1], images.image_sizes[0][0])), compute_average_recall_RPN=compute_average_recall_RPN, head_features=rpn_features)
+        if gt_bbox is not None:
+            # Resize the ground truth boxes to the correct format
+            width, height = proposals[0].size
+            gt_bbox = gt_bbox.resize((width, height))
+            # Add the ground truth proposals to the proposal vector
+            proposals[0].bbox = torch.cat((gt_bbox.bbox, proposals[0].bbox), 0)
+            proposals[0].extra_fields['objectness'] = torch.cat((1.0 * torch.ones(gt_bbox.bbox.size()[0], device="cuda"), proposals[0].extra_fields['objectness']), 0)
+
+        if self.roi_heads:
+            x, result, detector_losses = self.roi_heads(features, proposals, gt_bbox = gt_bbox, gt_label= gt_label, img_size=img_size, gt_labels_list = gt_labels_list, is_train = is_train, result_dir = result_dir, extract_features_segmentation=extract_features_segmentation)
+        return average_recall_RPN
@@ -31,6 +31,14 @@ class ROIBoxHead(torch.nn.Module):
 
         self.cfg = cfg
 
+    def reset_online_state(self, cfg):
+        # The post processor is built again at the next forward, for the online models set at that time
+        self.score_thresh = cfg['MODEL']['ROI_HEADS']['SCORE_THRESH']
+        self.nms = cfg['MODEL']['ROI_HEADS']['NMS']
+        self.detections_per_img = cfg['TEST']['DETECTIONS_PER_IMG']
+        self.post_processor = None
+        self.cfg = cfg
+
     def forward(self, features, proposals, gt_bbox=None, gt_label=None, img_size=None, gt_labels_list=None, is_train=True, result_dir=None, targets=None):
 
         """
@@ -12,7 +12,10 @@ import numpy as np
 
 import time
 
-from mrcnn_modified.utils.evaluations import compute_overlap_torch
+from mrcnn_modified.utils.evaluations import compute_overlap_matrix_torch
+from mrcnn_modified.utils.feature_buffer import FeatureBuffer
+from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+from mrcnn_modified.utils.feature_statistics import FeatureStatistics
 import math
 
 class ROIBoxHead(torch.nn.Module):
@@ -28,6 +31,11 @@ class ROIBoxHead(torch.nn.Module):
             cfg, self.feature_extractor.out_channels)
         self.post_processor = make_roi_box_post_processor(cfg)
         self.loss_evaluator = make_roi_box_loss_evaluator(cfg)
+
+        self.reset_online_state(cfg)
+
+    def reset_online_state(self, cfg):
+        # Reads the feature extraction settings of cfg and clears the features sampled with the previous ones
         self.cfg = cfg
 
         # TODO set these parameters in the default cfg file
@@ -40,9 +48,26 @@ class ROIBoxHead(torch.nn.Module):
             self.save_features = self.cfg.SAVE_FEATURES_DETECTOR
         except:
             self.save_features = False
+        # Feature store where full batches are written, set by the feature extractor when features must be saved
+        self.feature_writer = None
+        # Precision of the test features kept in memory
+        self.test_features_dtype = getattr(torch, self.cfg.FEATURE_STORE.IN_MEMORY_DTYPE)
 
         self.initialize_online_detection_params()
 
+    def release_online_state(self):
+        # Drops the references to the sampled features. The head can be used again after reset_online_state
+        self.feature_writer = None
+        self.negatives = []
+        if self.compute_gt_positives:
+            self.positives = []
+        self.X = []
+        self.Y = []
+        self.C = []
+        self.regression_statistics = None
+        self.feature_statistics = None
+        self.test_boxes = []
+
     def initialize_online_detection_params(self, num_classes=0, num_images=None):
         self.num_classes = num_classes if num_classes else self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES
         self.iterations = self.cfg.MINIBOOTSTRAP.DETECTOR.ITERATIONS
@@ -58,11 +83,13 @@ class ROIBoxHead(torch.nn.Module):
             self.current_batch.append(0)
             self.current_batch_size.append(0)
             if self.compute_gt_positives:
-                self.positives.append([torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)])
+                self.positives.append([FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device)])
             for j in range(self.iterations):
-                self.negatives[i].append(torch.empty((0, self.feature_extractor.out_channels), device=self.training_device))
+                self.negatives[i].append(FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device))
 
         self.negatives_to_pick = None
+        # Statistics of the sampled features, updated image by image
+        self.feature_statistics = FeatureStatistics(self.feature_extractor.out_channels, device=self.training_device)
 
         if num_images is not None:
             self.cfg.NUM_IMAGES = num_images
@@ -72,14 +99,22 @@ class ROIBoxHead(torch.nn.Module):
 
         self.reg_min_overlap = self.cfg.REGRESSORS.MIN_OVERLAP
 
-        # Regressor features
-        self.X = [torch.empty((0, self.feature_extractor.out_channels), dtype=torch.float32, device=self.training_device)]
-        # Regressor target values
-        self.Y = [torch.empty((0, 4), dtype=torch.float32, device=self.training_device)]
         # Regressor overlap amounts
         self.O = None
-        # Regressor classes
-        self.C = [torch.empty((0), dtype=torch.float32, device=self.training_device)]
+        if self.cfg.REGRESSORS.SUFFICIENT_STATISTICS:
+            # Regressor statistics, updated image by image in place of features, targets and classes
+            self.regression_statistics = RegressionStatistics(self.feature_extractor.out_channels, device=self.training_device)
+            self.X = []
+            self.Y = []
+            self.C = []
+        else:
+            self.regression_statistics = None
+            # Regressor features
+            self.X = [FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device)]
+            # Regressor target values
+            self.Y = [FeatureBuffer(self.batch_size, (4,), device=self.training_device)]
+            # Regressor classes
+            self.C = [FeatureBuffer(self.batch_size, (1,), device=self.training_device)]
 
         self.test_boxes = []
 
@@ -90,9 +125,9 @@ class ROIBoxHead(torch.nn.Module):
         self.current_batch.append(0)
         self.current_batch_size.append(0)
         if self.compute_gt_positives:
-            self.positives.append([torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)])
+            self.positives.append([FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device)])
         for j in range(self.iterations):
-            self.negatives[len(self.negatives)-1].append(torch.empty((0, self.feature_extractor.out_channels), device=self.training_device))
+            self.negatives[len(self.negatives)-1].append(FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device))
 
 
 
@@ -106,6 +141,9 @@ class ROIBoxHead(torch.nn.Module):
 
         if self.negatives_to_pick is None:
             self.negatives_to_pick = math.ceil((self.batch_size*self.iterations)/self.cfg.NUM_IMAGES)
+        if self.feature_writer is not None:
+            # The int8 offset and scale of the saved features are derived from the statistics accumulated so far
+            self.feature_writer.feature_statistics = self.feature_statistics
 
         # Extract features that will be fed to the final classifier.
         feat = self.feature_extractor(features, proposals)
@@ -128,55 +166,45 @@ class ROIBoxHead(torch.nn.Module):
         arr_gt_bbox[:, 3] = torch.clamp(arr_gt_bbox[:, 3], 0, img_size[1]-1)
         arr_gt_bbox[:, 1] = torch.clamp(arr_gt_bbox[:, 1], 0, img_size[1]-1)
 
-        # Count gt bboxes
-        if gt_label is not None:
-            len_gt = gt_label.size()[0]
-        else:
-            len_gt = 0
-        # Count num of proposals
-        num_proposals = arr_proposals.size()[0]- len_gt
-        # Specify the classes of the ground truth boxes, then set the classes of the not-gt proposals to 0
-        if gt_label is not None:
-            arr_class = torch.cat((gt_label, torch.zeros((num_proposals, 1), device='cuda', dtype=torch.uint8)), dim=0)
+        device = arr_proposals.device
+        num_gts = arr_gt_bbox.size()[0]
+        gt_classes = torch.as_tensor(gt_labels_list, dtype=torch.long, device=device)
+        # Compute the [G, N] IoU matrix between gts and proposals
+        ious = compute_overlap_matrix_torch(arr_gt_bbox, arr_proposals)
+        if num_gts > 0:
+            # Compute max overlap of each proposal with each class
+            gt_classes_one_hot = torch.zeros((num_gts, 1, self.num_classes), dtype=torch.float, device=device)
+            gt_classes_one_hot[torch.arange(num_gts, device=device), 0, gt_classes-1] = 1
+            overlap = (ious.unsqueeze(2) * gt_classes_one_hot).max(dim=0)[0]
+            # Keep track of the gt with max overlap for each proposal (-1 if it does not overlap any gt)
+            max_iou_gt, associated_gt_id = ious.max(dim=0)
+            associated_gt_id[max_iou_gt <= 0] = -1
         else:
-            arr_class = torch.zeros((num_proposals,1), device='cuda')
-        # Initialize overlaps with gts to 0
-        overlap = torch.zeros((arr_proposals.size()[0], self.num_classes), dtype=torch.float, device='cuda')
-        # Initialize tensors to keep track of the gt with max overlap for each proposal
-        associated_gt_id = torch.full((arr_proposals.size()[0],), -1, dtype=torch.int, device='cuda')
-        max_iou_gt = torch.zeros((arr_proposals.size()[0],), dtype=torch.float, device='cuda')
-        # Compute max overlap of each proposal with each class
-        for j in range(arr_gt_bbox.size()[0]):
-            overlap_j = compute_overlap_torch(arr_gt_bbox[j], arr_proposals)
-            overlap[:, gt_labels_list[j]-1] = torch.max(overlap[:, gt_labels_list[j]-1], overlap_j)
-            ids_to_update = torch.where(overlap_j > max_iou_gt)
-            associated_gt_id[ids_to_update] = j
-            max_iou_gt[ids_to_update] = overlap_j[ids_to_update]
-            
+            overlap = torch.zeros((arr_proposals.size()[0], self.num_classes), dtype=torch.float, device=device)
+            associated_gt_id = torch.full((arr_proposals.size()[0],), -1, dtype=torch.long, device=device)
 
         # Loop on all the gt boxes
         for i in range(len(gt_labels_list)):
             if self.compute_gt_positives:
                 # Concatenate each gt to the positive tensor for its corresponding class
-                if self.training_device is 'cpu':
-                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.cat((self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], x[i].view(-1, self.feature_extractor.out_channels).cpu()))
-                else:
-                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.cat((self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], x[i].view(-1, self.feature_extractor.out_channels)))
-                if self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].size()[0] >= self.batch_size:
+                self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].append(x[i])
+                self.feature_statistics.update(gt_labels_list[i]-1, x[i].view(1, -1), positive=True)
+                if self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].is_full():
                     if self.save_features:
-                        path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(gt_labels_list[i]-1, len(self.positives[gt_labels_list[i]-1]) - 1))
-                        torch.save(self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], path_to_save)
-                        self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)
-                    self.positives[gt_labels_list[i]-1].append(torch.empty((0, self.feature_extractor.out_channels), device=self.training_device))
-
-            # Extract regressor positives, i.e. with overlap > self.reg_min_overlap and with proposed boxes associated to that gt
-            pos_ids = overlap[:,gt_labels_list[i]-1] > self.reg_min_overlap
-            pos_ids = pos_ids & torch.eq(associated_gt_id, i)
-            regr_positives_i = x[pos_ids].view(-1, self.feature_extractor.out_channels)
-
-            # Compute targets
+                        self.feature_writer.append('positives_cl_{}'.format(gt_labels_list[i]-1), self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].view())
+                        self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device)
+                    self.positives[gt_labels_list[i]-1].append(FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device))
+
+        if num_gts > 0:
+            # Extract regressor positives of all the gts at once, i.e. proposals with overlap > self.reg_min_overlap with
+            # the class of the gt and associated to that gt. Pairs are ordered by gt and then by proposal
+            pos_pairs = (overlap[:, gt_classes-1].t() > self.reg_min_overlap) & torch.eq(associated_gt_id.unsqueeze(0), torch.arange(num_gts, device=device).unsqueeze(1))
+            pos_gt_ids, pos_ids = pos_pairs.nonzero().unbind(1)
+            regr_positives = x[pos_ids].view(-1, self.feature_extractor.out_channels)
+
+            # Compute targets. The gts are the first proposals
             ex_boxes = arr_proposals[pos_ids].view(-1, 4)
-            gt_boxes = torch.ones(ex_boxes.size(), device='cuda') * arr_proposals[i].view(-1, 4)
+            gt_boxes = arr_proposals[pos_gt_ids].view(-1, 4)
 
             src_w = ex_boxes[:,2] - ex_boxes[:,0] + 1
             src_h = ex_boxes[:,3] - ex_boxes[:,1] + 1
@@ -194,34 +222,29 @@ class ROIBoxHead(torch.nn.Module):
             dst_scl_h = torch.log(gt_h / src_h)
 
             target = torch.stack((dst_ctr_x, dst_ctr_y, dst_scl_w, dst_scl_h), dim=1)
+            regr_classes = gt_classes[pos_gt_ids].to(torch.float32).view(-1, 1)
 
-            if self.training_device is 'cpu':
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target.cpu()), dim=0)
-                # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((torch.sum(pos_ids), 1), gt_labels_list[i])))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], regr_positives_i.cpu()))
+            if self.regression_statistics is not None:
+                self.regression_statistics.update(regr_positives, target, regr_classes)
             else:
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target), dim=0)
+                self.Y[len(self.Y)-1].append(target)
                 # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((torch.sum(pos_ids), 1), gt_labels_list[i], device='cuda')))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], regr_positives_i))
-            if self.X[len(self.X)-1].size()[0] >= self.batch_size:
-                if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_detector','reg_x_batch_{}'.format(len(self.X)-1))
-                    torch.save(self.X[len(self.X)-1], path_to_save)
-                    self.X[len(self.X)-1] = torch.empty((0, self.feature_extractor.out_channels), dtype=torch.float32, device=self.training_device)
+                self.C[len(self.C)-1].append(regr_classes)
+                self.X[len(self.X)-1].append(regr_positives)
+                if self.X[len(self.X)-1].is_full():
+                    if self.save_features:
+                        self.feature_writer.append('reg_x', self.X[len(self.X)-1].view())
+                        self.X[len(self.X)-1] = FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device)
 
-                    path_to_save = os.path.join(result_dir, 'features_detector','reg_c_batch_{}'.format(len(self.C)-1))
-                    torch.save(self.C[len(self.C)-1], path_to_save)
-                    self.C[len(self.C)-1] = torch.empty((0), dtype=torch.float32, device=self.training_device)
+                        self.feature_writer.append('reg_c', self.C[len(self.C)-1].view())
+                        self.C[len(self.C)-1] = FeatureBuffer(self.batch_size, (1,), device=self.training_device)
 
-                    path_to_save = os.path.join(result_dir, 'features_detector','reg_y_batch_{}'.format(len(self.Y)-1))
-                    torch.save(self.Y[len(self.Y)-1], path_to_save)
-                    self.Y[len(self.Y)-1] = torch.empty((0, 4), dtype=torch.float32, device=self.training_device)
+                        self.feature_writer.append('reg_y', self.Y[len(self.Y)-1].view())
+                        self.Y[len(self.Y)-1] = FeatureBuffer(self.batch_size, (4,), device=self.training_device)
 
-                self.X.append(torch.empty((0, self.feature_extractor.out_channels), dtype=torch.float32, device=self.training_device))
-                self.C.append(torch.empty((0), dtype=torch.float32, device=self.training_device))
-                self.Y.append(torch.empty((0, 4), dtype=torch.float32, device=self.training_device))
+                    self.X.append(FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device))
+                    self.C.append(FeatureBuffer(self.batch_size, (1,), device=self.training_device))
+                    self.Y.append(FeatureBuffer(self.batch_size, (4,), device=self.training_device))
 
 
         # Fill batches for minibootstrap
@@ -240,22 +263,19 @@ class ROIBoxHead(torch.nn.Module):
             neg_to_add = math.ceil(self.negatives_to_pick/self.iterations)
             ind_to_add = 0
             for b in range(self.current_batch[i], self.iterations):
-                if self.negatives[i][b].size()[0] >= self.batch_size:
-                    # If features must be saved, save full batches and replace the batch in gpu with an empty tensor
+                if self.negatives[i][b].is_full():
+                    # If features must be saved, save full batches and replace the batch with an empty buffer
                     if self.save_features:
-                        path_to_save = os.path.join(result_dir, 'features_detector', 'negatives_cl_{}_batch_{}'.format(i, b))
-                        torch.save(self.negatives[i][b], path_to_save)
-                        self.negatives[i][b] = torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)
+                        self.feature_writer.append('negatives_cl_{}'.format(i), self.negatives[i][b].view())
+                        self.negatives[i][b] = FeatureBuffer(self.batch_size, (self.feature_extractor.out_channels,), device=self.training_device)
                     self.current_batch[i] += 1
                     if self.current_batch[i] >= self.iterations:
                         indices_to_remove.append(i)
                     continue
                 else:
-                    end_interval = int(ind_to_add + min(neg_to_add, self.batch_size - self.negatives[i][b].size()[0], self.negatives_to_pick - ind_to_add))
-                    if self.training_device is 'cpu':
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], neg_i[ind_to_add:end_interval].view(-1, self.feature_extractor.out_channels).cpu()))
-                    else:
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], neg_i[ind_to_add:end_interval].view(-1, self.feature_extractor.out_channels)))
+                    end_interval = int(ind_to_add + min(neg_to_add, self.batch_size - len(self.negatives[i][b]), self.negatives_to_pick - ind_to_add))
+                    self.negatives[i][b].append(neg_i[ind_to_add:end_interval])
+                    self.feature_statistics.update(i, neg_i[ind_to_add:end_interval], positive=False)
                     ind_to_add = end_interval
                     if ind_to_add == self.negatives_to_pick:
                         break
@@ -302,7 +322,7 @@ class ROIBoxHead(torch.nn.Module):
             arr_class = torch.zeros((num_proposals,1), device='cuda')
         # Signal if the box is a gt or not
         arr_gt = arr_class > 0
-        self.test_boxes.append({'boxes': arr_proposals.cpu().numpy(), 'feat': x.cpu().numpy(), 'gt': arr_gt.cpu().numpy(), 'img_size': np.array(img_size)})
+        self.test_boxes.append({'boxes': arr_proposals.cpu().numpy(), 'feat': x.to(self.test_features_dtype).cpu().numpy(), 'gt': arr_gt.cpu().numpy(), 'img_size': np.array(img_size)})
 
         return None, None, None
 
@@ -1,6 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 #from maskrcnn_benchmark.modeling import registry
 from mrcnn_modified.modeling import registry
+from mrcnn_modified.utils.falkon_bank import get_falkon_bank
+from mrcnn_modified.utils.packed_regressors import PackedRegressors
 from torch import nn
 import torch
 
@@ -27,6 +29,8 @@ class FastRCNNPredictor(nn.Module):
         nn.init.constant_(self.bbox_pred.bias, 0)
 
         self.normalize_features_regressors = False
+        self._regressors = None
+        self.packed_regressors = None
 
     def forward(self, x, proposals=None):
         x = self.avgpool(x)
@@ -53,36 +57,29 @@ class FastRCNNPredictor(nn.Module):
             return cls_logit, bbox_pred
 
     def refine_boxes(self, features):
-        refined_boxes = torch.zeros((features.size()[0], 4), device='cuda')
-        for j in range(len(self.regressors)):
-            # Refine boxes with RLS regressors
-            if self.regressors[j]['Beta'] is not None:
-                weights = self.regressors[j]['Beta'][str(0)]['weights'].view(1, -1)
-                for k in range(1, 4):
-                    weights = torch.cat((weights, self.regressors[j]['Beta'][str(k)]['weights'].view(1, -1)))
-
-                weights = torch.t(weights)
-                Y = torch.matmul(features, weights[:-1])
-                Y += weights[-1]
-                Y = torch.matmul(Y, self.regressors[j]['T_inv'])
-                Y += self.regressors[j]['mu']
-            # If the regressor is not available, do not refine the boxes
-            else:
-                Y = torch.zeros((features.size()[0], 4), device='cuda')
-            refined_boxes = torch.cat((refined_boxes, Y), dim=1)
+        # Background boxes are not refined
+        refined_boxes = torch.zeros((features.size()[0], 4), device=features.device)
+        # Refine boxes of all the classes with RLS regressors in a single matmul. If a regressor is not available, the boxes are not refined
+        refined_boxes = torch.cat((refined_boxes, self.packed_regressors.predict(features)), dim=1)
         return refined_boxes
 
+    @property
+    def regressors(self):
+        return self._regressors
+
+    @regressors.setter
+    def regressors(self, regressors):
+        # Regressors are packed into a single weight matrix once, when they are assigned
+        self._regressors = regressors
+        self.packed_regressors = PackedRegressors(regressors)
+
     def predict_clss_FALKON(self, features):
         # Set background class to the default negative value -2
         objectness_scores = torch.full((features.size()[0], 1), -2, device='cuda')
-        for classifier in self.classifiers:
-            # If the classifier is not available, set the objectness to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                predictions = torch.full((features.size()[0], 1), -2, device='cuda')
-            # Compute objectness with falkon classifier
-            else:
-                predictions = classifier.predict(features)
-            objectness_scores = torch.cat((objectness_scores, predictions), dim=1)
+        # Scores of all the classifiers are computed with a single kernel evaluation. If a classifier is not available,
+        # its objectness is set to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
+        predictions = get_falkon_bank(self, self.classifiers, fill_value=-2).predict(features)
+        objectness_scores = torch.cat((objectness_scores, predictions), dim=1)
         return objectness_scores
 
 
@@ -13,6 +13,9 @@ from .loss import make_roi_mask_loss_evaluator
 
 import os
 
+from mrcnn_modified.utils.feature_buffer import FeatureBuffer
+from mrcnn_modified.utils.feature_statistics import FeatureStatistics
+
 def project_masks_on_boxes(segmentation_masks, proposals, discretization_size):
     """
     Given segmentation masks and the bounding boxes corresponding
@@ -49,37 +52,53 @@ def project_masks_on_boxes(segmentation_masks, proposals, discretization_size):
 class ROIMaskHead(torch.nn.Module):
     def __init__(self, cfg, in_channels):
         super(ROIMaskHead, self).__init__()
-        self.cfg = cfg.clone()
         self.feature_extractor = make_roi_mask_feature_extractor(cfg, in_channels)
         self.predictor = make_roi_mask_predictor(
             cfg, self.feature_extractor.out_channels)
         self.post_processor = make_roi_mask_post_processor(cfg)
         self.loss_evaluator = make_roi_mask_loss_evaluator(cfg)
+
+        self.reset_online_state(cfg)
+
+    def reset_online_state(self, cfg):
+        # Reads the feature extraction settings of cfg and clears the features sampled with the previous ones
+        self.cfg = cfg.clone()
         # TODO set these parameters in the default cfg file
         try:
             self.save_features = self.cfg.SAVE_FEATURES_DETECTOR
         except:
             self.save_features = False
+        # Feature store where full batches are written, set by the feature extractor when features must be saved
+        self.feature_writer = None
 
         self.training_device = self.cfg.SEGMENTATION.FEATURES_DEVICE
 
         self.initialize_online_segmentation_params()
 
+    def release_online_state(self):
+        # Drops the references to the sampled features. The head can be used again after reset_online_state
+        self.feature_writer = None
+        self.positives = []
+        self.negatives = []
+        self.feature_statistics = None
+
     def initialize_online_segmentation_params(self, num_classes=0):
         self.num_classes = num_classes if num_classes else self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES
         self.batch_size = self.cfg.SEGMENTATION.BATCH_SIZE
         self.positives = []
         self.negatives = []
         for i in range(self.num_classes):
-            self.positives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
-            self.negatives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
+            self.positives.append([FeatureBuffer(self.batch_size, (self.predictor.mask_fcn_logits.in_channels,), device=self.training_device)])
+            self.negatives.append([FeatureBuffer(self.batch_size, (self.predictor.mask_fcn_logits.in_channels,), device=self.training_device)])
+        # Statistics of the sampled features, updated image by image
+        self.feature_statistics = FeatureStatistics(self.predictor.mask_fcn_logits.in_channels, device=self.training_device)
 
         self.sampling_factor = self.cfg.SEGMENTATION.SAMPLING_FACTOR
 
     def add_new_class(self):
         self.num_classes += 1
-        self.positives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
-        self.negatives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
+        self.positives.append([FeatureBuffer(self.batch_size, (self.predictor.mask_fcn_logits.in_channels,), device=self.training_device)])
+        self.negatives.append([FeatureBuffer(self.batch_size, (self.predictor.mask_fcn_logits.in_channels,), device=self.training_device)])
 
     def forward(self, features, proposals, gt_labels_list, gt_bbox, targets=None, result_dir=None):
         """
@@ -96,6 +115,9 @@ class ROIMaskHead(torch.nn.Module):
             losses (dict[Tensor]): During training, returns the losses for the
                 head. During testing, returns an empty dict.
         """
+        if self.feature_writer is not None:
+            # The int8 offset and scale of the saved features are derived from the statistics accumulated so far
+            self.feature_writer.feature_statistics = self.feature_statistics
 
         if self.cfg.MODEL.ROI_MASK_HEAD.SHARE_BOX_FEATURE_EXTRACTOR:
             x = features[:len(gt_labels_list)]
@@ -116,30 +138,26 @@ class ROIMaskHead(torch.nn.Module):
                 sampled_indices = torch.randperm(len(positives_indices))[:int(self.sampling_factor*len(positives_indices))]
                 positives_indices = positives_indices[sampled_indices]
             # Add positives of the given mask to the positives list of the corresponding object class
-            self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.cat((self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], mask_features[positives_indices]))
+            self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].append(mask_features[positives_indices])
+            self.feature_statistics.update(gt_labels_list[i]-1, mask_features[positives_indices], positive=True)
             # Manage full batches of features
-            if self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].size()[0] >= self.batch_size:
+            if self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].is_full():
                 if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_segmentation', 'positives_cl_{}_batch_{}'.format(gt_labels_list[i]-1, len(self.positives[gt_labels_list[i]-1]) - 1))
-                    torch.save(self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], path_to_save)
-                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.empty((0, self.predictor.conv5_mask.out_channels), device=self.training_device)
-                if self.training_device == 'cpu':
-                    self.positives[gt_labels_list[i] - 1][len(self.positives[gt_labels_list[i] - 1]) - 1] = self.positives[gt_labels_list[i] - 1][len(self.positives[gt_labels_list[i] - 1]) - 1].to('cpu')
-                self.positives[gt_labels_list[i]-1].append(torch.empty((0, self.predictor.conv5_mask.out_channels), device='cuda'))
+                    self.feature_writer.append('positives_cl_{}'.format(gt_labels_list[i]-1), self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].view())
+                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = FeatureBuffer(self.batch_size, (self.predictor.conv5_mask.out_channels,), device=self.training_device)
+                self.positives[gt_labels_list[i]-1].append(FeatureBuffer(self.batch_size, (self.predictor.conv5_mask.out_channels,), device=self.training_device))
             # Repeat the procedure done for positive features with the negatives
             negatives_indices = torch.where(masks_gt < 0.5)[0]
             if self.sampling_factor < 1.0:
                 sampled_indices = torch.randperm(len(negatives_indices))[:int(self.sampling_factor*len(negatives_indices))]
                 negatives_indices = negatives_indices[sampled_indices]
-            self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1] = torch.cat((self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1], mask_features[negatives_indices]))
-            if self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1].size()[0] >= self.batch_size:
+            self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1].append(mask_features[negatives_indices])
+            self.feature_statistics.update(gt_labels_list[i]-1, mask_features[negatives_indices], positive=False)
+            if self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1].is_full():
                 if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_segmentation', 'negatives_cl_{}_batch_{}'.format(gt_labels_list[i]-1, len(self.negatives[gt_labels_list[i]-1]) - 1))
-                    torch.save(self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1], path_to_save)
-                    self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1] = torch.empty((0, self.predictor.conv5_mask.out_channels), device=self.training_device)
-                if self.training_device == 'cpu':
-                    self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1])-1] = self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1])-1].to('cpu')
-                self.negatives[gt_labels_list[i]-1].append(torch.empty((0, self.predictor.conv5_mask.out_channels), device='cuda'))
+                    self.feature_writer.append('negatives_cl_{}'.format(gt_labels_list[i]-1), self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1].view())
+                    self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1] = FeatureBuffer(self.batch_size, (self.predictor.conv5_mask.out_channels,), device=self.training_device)
+                self.negatives[gt_labels_list[i]-1].append(FeatureBuffer(self.batch_size, (self.predictor.conv5_mask.out_channels,), device=self.training_device))
 
         return None, None, None
 
@@ -5,6 +5,7 @@ from torch.nn import functional as F
 from maskrcnn_benchmark.layers import Conv2d
 from maskrcnn_benchmark.layers import ConvTranspose2d
 from maskrcnn_benchmark.modeling import registry
+from mrcnn_modified.utils.falkon_bank import get_falkon_bank
 
 import torch
 
@@ -43,18 +44,14 @@ class MaskRCNNC4Predictor(nn.Module):
     def predict_pixel_FALKON(self, features, feat_width):
         # Set background class to the default negative value -2
         pixels_scores = torch.full((features.size()[0], 1), -2, device='cuda')
-        for classifier in self.classifiers:
-            # If the classifier is not available, set the pixel value to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                predictions = torch.full((features.size()[0], 1), -2, device='cuda')
-            # Compute pixel predictions with falkon classifier
-            else:
-                predictions = classifier.predict(features)
-            pixels_scores = torch.cat((pixels_scores, predictions), dim=1)
-
-        to_return = torch.empty((0, len(self.classifiers)+1, feat_width, feat_width), device='cuda')    #TODO maybe the loop can be optimized
-        for i in range(int((len(predictions))/(feat_width**2))):
-            to_return = torch.cat((to_return, pixels_scores[i*(feat_width**2):(i+1)*(feat_width**2)].T.reshape(1, len(self.classifiers)+1, feat_width, feat_width)))
+        # Pixel predictions of all the classifiers are computed with a single kernel evaluation. If a classifier is not available,
+        # its pixel value is set to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
+        predictions = get_falkon_bank(self, self.classifiers, fill_value=-2).predict(features)
+        pixels_scores = torch.cat((pixels_scores, predictions), dim=1)
+
+        # Rows are ordered as (roi, y, x), reshape them to [num_rois, num_classes, feat_width, feat_width]
+        num_channels = len(self.classifiers) + 1
+        to_return = pixels_scores.reshape(-1, feat_width**2, num_channels).permute(0, 2, 1).reshape(-1, num_channels, feat_width, feat_width)
         return to_return
 
 
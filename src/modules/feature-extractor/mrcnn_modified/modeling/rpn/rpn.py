@@ -11,9 +11,12 @@ from .anchor_generator import make_anchor_generator
 from .inference import make_rpn_postprocessor
 
 from .average_recall import compute_average_recall
+from mrcnn_modified.utils.falkon_bank import get_falkon_bank
+from mrcnn_modified.utils.packed_regressors import PackedRegressors
 
 from joblib import Parallel, delayed, parallel_backend
 import multiprocessing
+from collections import OrderedDict
 
 
 class RPNHeadConvRegressor(nn.Module):
@@ -105,20 +108,28 @@ class RPNHead(nn.Module):
         self.width = None
         self.num_clss = num_anchors
         self.area = None
+        self._regressors = None
+        self.packed_regressors = None
 
     def forward(self, x):
+        return self.predict(self.conv_features(x))
+
+    def conv_features(self, x):
+        return [F.relu(self.conv(feature)) for feature in x]
+
+    def predict(self, x):
+        # Objectness and box regressions from the features computed by the conv layer of the head
         logits = []
         bbox_reg = []
-        for feature in x:
-            t = F.relu(self.conv(feature))
+        for t in x:
             # If FALKON classifiers, regressors and stats are defined use online pipeline
             if hasattr(self, 'classifiers'):
-                if self.feat_size is None:
-                    features_map_size = t.size()
-                    self.feat_size = features_map_size[1]
-                    self.height = features_map_size[2]
-                    self.width = features_map_size[3]
-                    self.area = self.height * self.width
+                # Features map size may change with the input resolution
+                features_map_size = t.size()
+                self.feat_size = features_map_size[1]
+                self.height = features_map_size[2]
+                self.width = features_map_size[3]
+                self.area = self.height * self.width
                 # Flatten feature map
                 t = t.permute(0,2,3,1).view(self.area,self.feat_size)
                 # Normalize features
@@ -135,36 +146,26 @@ class RPNHead(nn.Module):
         return logits, bbox_reg
 
     def refine_boxes(self, features):
-        refined_boxes = torch.empty((1, 0, self.height, self.width), device='cuda')
-        for j in range(self.num_clss):
-            # Refine boxes with RLS regressors
-            if self.regressors[j]['Beta'] is not None:
-                weights = torch.empty((0,self.feat_size+1), device='cuda')
-                for k in range(0, 4):
-                    weights = torch.cat((weights, self.regressors[j]['Beta'][str(k)]['weights'].view(1,self.feat_size+1)))
-
-                weights = torch.t(weights)
-                Y = torch.matmul(features, weights[:-1])
-                Y += weights[-1]
-                Y = torch.matmul(Y, self.regressors[j]['T_inv'])
-                Y += self.regressors[j]['mu']
-            # If the regressor is not available, do not refine the boxes
-            else:
-                Y = torch.zeros((self.area, 4), device='cuda')
-            Y = torch.t(Y).reshape(1,4,self.height,self.width)
-            refined_boxes = torch.cat((refined_boxes, Y), dim=1)
+        # Refine boxes of all the anchors with RLS regressors in a single matmul. If a regressor is not available, the boxes are not refined
+        Y = self.packed_regressors.predict(features)
+        refined_boxes = torch.t(Y).reshape(1, 4*len(self.packed_regressors), self.height, self.width)
         return refined_boxes
-    
+
+    @property
+    def regressors(self):
+        return self._regressors
+
+    @regressors.setter
+    def regressors(self, regressors):
+        # Regressors are packed into a single weight matrix once, when they are assigned
+        self._regressors = regressors
+        self.packed_regressors = PackedRegressors(regressors)
+
     def compute_objectness_FALKON(self, features):
-        objectness_scores = torch.empty((1, 0, self.height, self.width), device='cuda')
-        for classifier in self.classifiers:
-            # If the classifier is not available, set the objectness to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                predictions = torch.full((self.area, 1), -2, device='cuda')
-            # Compute objectness with falkon classifier
-            else:
-                predictions = classifier.predict(features)
-            objectness_scores = torch.cat((objectness_scores, torch.t(predictions).reshape(1,1,self.height,self.width)), dim=1)
+        # Scores of all the classifiers are computed with a single kernel evaluation. If a classifier is not available,
+        # its objectness is set to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
+        predictions = get_falkon_bank(self, self.classifiers, fill_value=-2).predict(features)
+        objectness_scores = torch.t(predictions).reshape(1, len(self.classifiers), self.height, self.width)
         return objectness_scores
 
     def compute_objectness_FALKON_parallel(self, features):
@@ -213,9 +214,11 @@ class RPNModule(torch.nn.Module):
         self.box_selector_train = box_selector_train
         self.box_selector_test = box_selector_test
         self.loss_evaluator = loss_evaluator
-        self.anchors = None
+        # Anchors cached per image sizes and features map sizes, keeping the most recently used entries
+        self.anchors_cache = OrderedDict()
+        self.anchors_cache_size = cfg.MODEL.RPN.ANCHORS_CACHE_SIZE
 
-    def forward(self, images, features, targets=None, compute_average_recall_RPN = False):
+    def forward(self, images, features, targets=None, compute_average_recall_RPN = False, head_features=None):
         """
         Arguments:
             images (ImageList): images for which we want to compute the predictions
@@ -223,6 +226,8 @@ class RPNModule(torch.nn.Module):
                 used for computing the predictions. Each tensor in the list
                 correspond to different feature levels
             targets (list[BoxList): ground-truth boxes present in the image (optional)
+            head_features (list[Tensor]): features of the conv layer of the head, if they
+                have already been computed for these images (optional)
 
         Returns:
             boxes (list[BoxList]): the predicted boxes from the RPN, one BoxList per
@@ -230,13 +235,25 @@ class RPNModule(torch.nn.Module):
             losses (dict[Tensor]): the losses for the model during training. During
                 testing, it is an empty dict.
         """
-        objectness, rpn_box_regression = self.head(features)
-        if self.anchors is None:
-            self.anchors = self.anchor_generator(images, features)
+        if head_features is None:
+            objectness, rpn_box_regression = self.head(features)
+        else:
+            objectness, rpn_box_regression = self.head.predict(head_features)
+        anchors = self.get_anchors(images, features)
         if self.training:
-            return self._forward_train(self.anchors, objectness, rpn_box_regression, targets, compute_average_recall_RPN = compute_average_recall_RPN)
+            return self._forward_train(anchors, objectness, rpn_box_regression, targets, compute_average_recall_RPN = compute_average_recall_RPN)
+        else:
+            return self._forward_test(anchors, objectness, rpn_box_regression, targets = targets, compute_average_recall_RPN = compute_average_recall_RPN)
+
+    def get_anchors(self, images, features):
+        key = (tuple(tuple(image_size) for image_size in images.image_sizes), tuple(tuple(feature_map.size()[-2:]) for feature_map in features))
+        if key in self.anchors_cache:
+            self.anchors_cache.move_to_end(key)
         else:
-            return self._forward_test(self.anchors, objectness, rpn_box_regression, targets = targets, compute_average_recall_RPN = compute_average_recall_RPN)
+            self.anchors_cache[key] = self.anchor_generator(images, features)
+            if len(self.anchors_cache) > self.anchors_cache_size:
+                self.anchors_cache.popitem(last=False)
+        return self.anchors_cache[key]
 
     def _forward_train(self, anchors, objectness, rpn_box_regression, targets, compute_average_recall_RPN = False):
         if self.cfg.MODEL.RPN_ONLY:
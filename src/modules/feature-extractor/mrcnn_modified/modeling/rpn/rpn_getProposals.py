@@ -16,7 +16,10 @@ import time
 import os
 
 import math
-import copy
+from collections import OrderedDict
+from mrcnn_modified.utils.feature_buffer import FeatureBuffer
+from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+from mrcnn_modified.utils.feature_statistics import FeatureStatistics
 
 class RPNHeadConvRegressor(nn.Module):
     """
@@ -124,6 +127,8 @@ class RPNModule(torch.nn.Module):
             self.save_features = self.cfg.SAVE_FEATURES_RPN
         except:
             self.save_features = False
+        # Feature store where full batches are written, set by the feature extractor when features must be saved
+        self.feature_writer = None
 
         anchor_generator = make_anchor_generator(self.cfg)
 
@@ -145,100 +150,168 @@ class RPNModule(torch.nn.Module):
         self.box_selector_test = box_selector_test
         self.loss_evaluator = loss_evaluator
 
+        # Features map positions and anchor values of the anchors, per features map shape, keeping the most recently
+        # used ANCHORS_CACHE_SIZE entries
+        self.anchors_metadata = OrderedDict()
+        self.anchors_cache_size = cfg.MODEL.RPN.ANCHORS_CACHE_SIZE
+
         self.initialize_online_rpn_params()
 
+    def reset_online_state(self, cfg):
+        # Reads the feature extraction settings of cfg and clears the features sampled with the previous ones
+        self.cfg = cfg.clone()
+        try:
+            self.save_features = self.cfg.SAVE_FEATURES_RPN
+        except:
+            self.save_features = False
+        self.feature_writer = None
+        self.initialize_online_rpn_params()
+
+    def release_online_state(self):
+        # Drops the references to the sampled features, which are initialized again at the next forward
+        self.feature_writer = None
+        self.negatives = []
+        self.positives = []
+        self.X = []
+        self.Y = []
+        self.C = []
+        self.regression_statistics = None
+        self.feature_statistics = None
+
     def initialize_online_rpn_params(self):
 
         self.anchors = None
+        self.anchors_cache = OrderedDict()
+        self.anchors_ids = []
+        # Anchors reported without visible regions
+        self.removed_anchors = set()
 
         self.num_classes = self.cfg.MINIBOOTSTRAP.RPN.NUM_CLASSES
         self.iterations = self.cfg.MINIBOOTSTRAP.RPN.ITERATIONS
         self.batch_size = self.cfg.MINIBOOTSTRAP.RPN.BATCH_SIZE
         self.negatives = []
         self.positives = []
+        # Statistics of the sampled features, updated image by image
+        self.feature_statistics = None
         self.current_batch = []
         self.current_batch_size = []
         self.neg_iou_thresh = self.cfg.MINIBOOTSTRAP.RPN.NEG_IOU_THRESH
         self.pos_iou_thresh = self.cfg.MINIBOOTSTRAP.RPN.POS_IOU_THRESH
 
-        self.diag_list=[torch.empty(0, dtype=torch.long, device='cuda')]
-        for i in range(50):
-            if i == 0:
-                continue
-            else:
-                self.diag_list.append(torch.arange(0,i**2, i+1, dtype=torch.long, device='cuda'))
         self.negatives_to_pick = None
         try:
             self.training_device = self.cfg.TRAIN_FALKON_REGRESSORS_DEVICE
         except:
             self.training_device = 'cuda'
 
+    def compute_anchors_metadata(self, height, width, device):
+        # Anchors are ordered by position in the features map and then by anchor value. The result is cached per
+        # features map shape
+        key = (height, width, str(device))
+        if key in self.anchors_metadata:
+            self.anchors_metadata.move_to_end(key)
+            return self.anchors_metadata[key]
+        rows, cols = torch.meshgrid(torch.arange(height, dtype=torch.long, device=device), torch.arange(width, dtype=torch.long, device=device))
+        feature_ids = torch.stack((rows.reshape(-1), cols.reshape(-1)), dim=1).repeat_interleave(self.num_classes, dim=0)
+        classifiers = (torch.arange(height * width * self.num_classes, device=device) % self.num_classes).to(torch.uint8)
+        self.anchors_metadata[key] = (feature_ids, classifiers)
+        if len(self.anchors_metadata) > self.anchors_cache_size:
+            self.anchors_metadata.popitem(last=False)
+        return feature_ids, classifiers
+
+    def get_anchors(self, images, features):
+        # Anchors, with their visibility, features map position and classifier id, are cached per image size and
+        # features map size, keeping the most recently used ANCHORS_CACHE_SIZE entries
+        key = (tuple(images.image_sizes[0]), tuple(features.size()[-2:]))
+        if key in self.anchors_cache:
+            self.anchors_cache.move_to_end(key)
+            return self.anchors_cache[key]
+
+        # Generate anchors
+        anchors = self.anchor_generator(images, features)[0][0]
+        # Associate to each feature tensor an id, corresponding to its position and a classifier id corresponding to an anchor value
+        feature_ids, classifiers = self.compute_anchors_metadata(features.size()[-2], features.size()[-1], anchors.bbox.device)
+        anchors.add_field('feature_id', feature_ids)
+        anchors.add_field('classifier', classifiers)
+        # Remove features with borders external to the image
+        visible_anchors = anchors.get_field('visibility')
+        anchors = anchors[visible_anchors]
+        visible_classes = torch.unique(anchors.get_field('classifier')).tolist()
+        for i in range(self.num_classes):
+            if i not in visible_classes and i not in self.anchors_ids and i not in self.removed_anchors:
+                # Reported and saved empty only the first time, not at every resolution where it is not visible
+                self.removed_anchors.add(i)
+                print('Anchor %i does not have visible regions.' %i ,'Removed from the list.')
+                if self.save_features:
+                    # Saving empty tensors
+                    self.feature_writer.append('negatives_cl_{}'.format(i), torch.empty((0, self.feat_size), device=self.training_device))
+                    self.feature_writer.append('positives_cl_{}'.format(i), torch.empty((0, self.feat_size), device=self.training_device))
+        # Classes with visible regions in at least one of the processed resolutions
+        self.anchors_ids = sorted(set(self.anchors_ids) | set(visible_classes))
+
+        entry = {'anchors': anchors, 'visibility': visible_anchors, 'visible_classes': visible_classes}
+        self.anchors_cache[key] = entry
+        if len(self.anchors_cache) > self.anchors_cache_size:
+            self.anchors_cache.popitem(last=False)
+        return entry
+
     def forward(self, images, features, gt_bbox=None, img_size = None, compute_average_recall_RPN = False, is_train = None, result_dir = None):
+        features = self.head(features)
+        return self.sample(images, features[0][0], gt_bbox=gt_bbox)
 
+    def sample(self, images, features, gt_bbox=None):
+        """
+        Samples the minibootstrap negatives, the positives and the regression examples of an image from the
+        [C, H, W] features map computed by the head.
+        """
         if self.negatives_to_pick is None:
             self.negatives_to_pick = math.ceil((self.batch_size*self.iterations)/self.cfg.NUM_IMAGES)
 
-        features = self.head(features)
-        if self.anchors is None:
-            features = features[0][0]
-            features_map_size = features.size()
-            # Extract feature map info
-            self.feat_size = features_map_size[0]
-            self.height = features_map_size[1]
-            self.width = features_map_size[2]
-
-            # Generate anchors
-            self.anchors = self.anchor_generator(images, features)[0][0]
-
-            self.feature_ids = torch.empty((0, 2), dtype=torch.long, device='cuda')
-            self.classifiers = torch.empty(0, dtype=torch.uint8, device='cuda')
-            # Associate to each feature tensor an id, corresponding to its position and a classifier id corresponding to an anchor value
-            for ind in range(0, int(self.anchors.bbox.size()[0])):
-                feat_ij = [[int(int(ind/self.num_classes)/self.width), int(int(ind/self.num_classes)%self.width)]]
-                self.feature_ids = torch.cat((self.feature_ids, torch.tensor(feat_ij, dtype=torch.long, device='cuda')))
-                cls = [ind %self.num_classes]
-                self.classifiers = torch.cat((self.classifiers, torch.tensor(cls, dtype=torch.uint8, device='cuda')))
-            self.anchors.add_field('feature_id', self.feature_ids)
-            self.anchors.add_field('classifier', self.classifiers)
-            # Remove features with borders external to the image
-            self.visible_anchors = self.anchors.get_field('visibility')
-            self.anchors = self.anchors[self.visible_anchors]
-            # Avoid computing unuseful regions
-            self.still_to_complete = list(range(self.num_classes))
-            for i in self.still_to_complete:
-                if self.anchors[self.anchors.get_field('classifier') == i].bbox.size()[0] == 0:
-                    self.still_to_complete.remove(i)
-                    print('Anchor %i does not have visible regions.' %i ,'Removed from the list.')
-                    if self.save_features:
-                        # Saving empty tensors
-                        path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(i, 0))
-                        torch.save(torch.empty((0, self.feat_size), device=self.training_device), path_to_save)
-
-                        path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(i, 0))
-                        torch.save(torch.empty((0, self.feat_size), device=self.training_device), path_to_save)
-            self.anchors_ids = copy.deepcopy(self.still_to_complete)
+        features_map_size = features.size()
+        # Extract feature map info
+        self.feat_size = features_map_size[0]
+        self.height = features_map_size[1]
+        self.width = features_map_size[2]
 
+        if not self.negatives:
             # Initialize batches for minibootstrap
+            self.still_to_complete = list(range(self.num_classes))
             for i in range(self.num_classes):
                 self.negatives.append([])
                 self.current_batch.append(0)
                 self.current_batch_size.append(0)
-                self.positives.append([torch.empty((0, self.feat_size), device=self.training_device)])
+                self.positives.append([FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device)])
                 for j in range(self.iterations):
-                    self.negatives[i].append(torch.empty((0, self.feat_size), device=self.training_device))
+                    self.negatives[i].append(FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device))
 
-            # Initialize tensors for box regression
-            # Regressor features
-            self.X = [torch.empty((0, self.feat_size), dtype=torch.float32, device=self.training_device)]
-            # Regressor target values
-            self.Y = [torch.empty((0, 4), dtype=torch.float32, device=self.training_device)]
+            self.feature_statistics = FeatureStatistics(self.feat_size, device=self.training_device)
+
+            # Initialize buffers for box regression
             # Regressor overlap amounts
             self.O = None
-            # Regressor classes
-            self.C = [torch.empty((0), dtype=torch.float32, device=self.training_device)]
-            
-        else:
-            features = features[0][0]
+            if self.cfg.REGRESSORS.SUFFICIENT_STATISTICS:
+                # Regressor statistics, updated image by image in place of features, targets and classes
+                self.regression_statistics = RegressionStatistics(self.feat_size, device=self.training_device)
+                self.X = []
+                self.Y = []
+                self.C = []
+            else:
+                self.regression_statistics = None
+                # Regressor features
+                self.X = [FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device)]
+                # Regressor target values
+                self.Y = [FeatureBuffer(self.batch_size, (4,), device=self.training_device)]
+                # Regressor classes
+                self.C = [FeatureBuffer(self.batch_size, (1,), device=self.training_device)]
+
+        if self.feature_writer is not None:
+            # The int8 offset and scale of the saved features are derived from the statistics accumulated so far
+            self.feature_writer.feature_statistics = self.feature_statistics
+
+        anchors_entry = self.get_anchors(images, features)
+        self.anchors = anchors_entry['anchors']
+        # Avoid computing unuseful regions, i.e. anchors without visible regions at this resolution
+        classes_to_complete = [i for i in self.still_to_complete if i in anchors_entry['visible_classes']]
 
         anchors_to_return = self.anchors.copy_with_fields(self.anchors.fields())
         # Resize ground truth boxes to anchors dimensions
@@ -257,28 +330,35 @@ class RPNModule(torch.nn.Module):
         # Filter all the negatives, i.e. with iou with the gts < self.neg_iou_thresh
         negative_anchors_total = anchors_to_return[ious < self.neg_iou_thresh]
 
-        indices_to_remove = []
-        for i in self.still_to_complete:
+        sampled_ids = []
+        for i in classes_to_complete:
             # Filter negatives for the i-th anchor
             anchors_i = negative_anchors_total[negative_anchors_total.get_field('classifier')==i]
             # Sample negatives, according to minibootstrap parameters
             if anchors_i.bbox.size()[0] > self.negatives_to_pick:
                 anchors_i = anchors_i[torch.randint(anchors_i.bbox.size()[0], (self.negatives_to_pick,))]
             # Compute their id, i.e. position in the features map
-            ids = anchors_i.get_field('feature_id')
-            ids_size = ids.size()[0]
+            sampled_ids.append(anchors_i.get_field('feature_id'))
+        # Gather the features of the sampled negatives of all the anchors at once, then split them by anchor
+        negative_features = []
+        if len(sampled_ids):
+            ids = torch.cat(sampled_ids)
+            negative_features = features[:, ids[:, 0], ids[:, 1]].t().split([ids_i.size()[0] for ids_i in sampled_ids])
+
+        indices_to_remove = []
+        for i, feat_i in zip(classes_to_complete, negative_features):
+            ids_size = feat_i.size()[0]
             # Compute at most how many negatives to add to each batch
             reg_to_add = math.ceil(self.negatives_to_pick/self.iterations)
             # Initialize index of chosen negatives among all the negatives to pick
             ind_to_add = 0
             for b in range(self.current_batch[i], self.iterations):
                 # If the batch is full, start from the subsequent
-                if self.negatives[i][b].size()[0] >= self.batch_size:
-                    # If features must be saved, save full batches and replace the batch in gpu with an empty tensor
+                if self.negatives[i][b].is_full():
+                    # If features must be saved, save full batches and replace the batch with an empty buffer
                     if self.save_features:
-                        path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(i, b))
-                        torch.save(self.negatives[i][b], path_to_save)
-                        self.negatives[i][b] = torch.empty((0, self.feat_size), device=self.training_device)
+                        self.feature_writer.append('negatives_cl_{}'.format(i), self.negatives[i][b].view())
+                        self.negatives[i][b] = FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device)
                     self.current_batch[i] += 1
                     if self.current_batch[i] >= self.iterations:
                         indices_to_remove.append(i)
@@ -286,19 +366,10 @@ class RPNModule(torch.nn.Module):
 
                 else:
                     # Compute the end index of negatives to add to the batch
-                    end_interval = int(ind_to_add + min(reg_to_add, self.batch_size - self.negatives[i][b].size()[0], self.negatives_to_pick - ind_to_add, ids_size -ind_to_add))
-                    # Extract features corresponding to the ids and add them to the ids
-                    # Diagonal choice done for computational efficiency
-                    feat = torch.index_select(features, 1, ids[ind_to_add:end_interval, 0])
-                    feat = torch.index_select(feat, 2, ids[ind_to_add:end_interval, 1]).permute(1,2,0).view((end_interval-ind_to_add)**2,self.feat_size)
-                    try:
-                        feat = feat[self.diag_list[end_interval-ind_to_add]]
-                    except:
-                        feat = feat[list(range(0,(end_interval-ind_to_add)**2+(end_interval-ind_to_add)-1, (end_interval-ind_to_add)+1))]
-                    if self.training_device is 'cpu':
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], feat.cpu()))
-                    else:
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], feat))
+                    end_interval = int(ind_to_add + min(reg_to_add, self.batch_size - len(self.negatives[i][b]), self.negatives_to_pick - ind_to_add, ids_size -ind_to_add))
+                    # Add the features of the chosen negatives to the batch
+                    self.negatives[i][b].append(feat_i[ind_to_add:end_interval])
+                    self.feature_statistics.update(i, feat_i[ind_to_add:end_interval], positive=False)
                     # Update indices
                     ind_to_add = end_interval
                     if ind_to_add == self.negatives_to_pick:
@@ -326,29 +397,24 @@ class RPNModule(torch.nn.Module):
                     positives_i = positives_i[positives_i.get_field('overlap') == values.item()]
                     positive_anchors = cat_boxlist([positive_anchors, positives_i])
                 
+        # Gather the features of all the positives at once
+        ids = positive_anchors.get_field('feature_id')
+        positive_features = features[:, ids[:, 0], ids[:, 1]].t()
         # Find anchors associated to the positives, to avoid unuseful computation
         pos_inds = torch.unique(positive_anchors.get_field('classifier'))
         for i in pos_inds:
-            anchors_i = positive_anchors[positive_anchors.get_field('classifier')==i]
-            ids = anchors_i.get_field('feature_id')
-            ids_size = ids.size()[0]
-            feat = torch.index_select(features, 1, ids[:,0])
-            feat = torch.index_select(feat, 2, ids[:,1]).permute(1,2,0).view(ids_size**2,self.feat_size)
-            try:
-                feat = feat[self.diag_list[ids_size]]
-            except:
-                feat = feat[list(range(0,ids_size**2+ids_size-1, ids_size+1))]
+            anchors_i_mask = positive_anchors.get_field('classifier')==i
+            anchors_i = positive_anchors[anchors_i_mask]
+            feat = positive_features[anchors_i_mask]
+            ids_size = feat.size()[0]
             # Add positive features for the i-th anchor to the i-th positives list
-            if self.training_device is 'cpu':
-                self.positives[i][len(self.positives[i]) - 1] = torch.cat((self.positives[i][len(self.positives[i]) - 1], feat.cpu()))
-            else:
-                self.positives[i][len(self.positives[i]) - 1] = torch.cat((self.positives[i][len(self.positives[i]) - 1], feat))
-            if self.positives[i][len(self.positives[i]) - 1].size()[0] >= self.batch_size:
+            self.positives[i][len(self.positives[i]) - 1].append(feat)
+            self.feature_statistics.update(i, feat, positive=True)
+            if self.positives[i][len(self.positives[i]) - 1].is_full():
                 if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(i, len(self.positives[i]) - 1))
-                    torch.save(self.positives[i][len(self.positives[i]) - 1], path_to_save)
-                    self.positives[i][len(self.positives[i]) - 1] = torch.empty((0, self.feat_size), device=self.training_device)
-                self.positives[i].append(torch.empty((0, self.feat_size), device=self.training_device))
+                    self.feature_writer.append('positives_cl_{}'.format(i), self.positives[i][len(self.positives[i]) - 1].view())
+                    self.positives[i][len(self.positives[i]) - 1] = FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device)
+                self.positives[i].append(FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device))
 
             # COXY computation for regressors
             ex_boxes = anchors_i.bbox
@@ -370,33 +436,27 @@ class RPNModule(torch.nn.Module):
             dst_scl_h = torch.log(gt_h / src_h)
 
             target = torch.stack((dst_ctr_x, dst_ctr_y, dst_scl_w, dst_scl_h), dim=1)
-            if self.training_device is 'cpu':
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target.cpu()), dim=0)
-                # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((ids_size,1), i, dtype=torch.float32)))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], feat.cpu()))
+            if self.regression_statistics is not None:
+                self.regression_statistics.update_class(int(i), feat, target)
             else:
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target), dim=0)
+                self.Y[len(self.Y)-1].append(target)
                 # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((ids_size,1), i, dtype=torch.float32, device='cuda')))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], feat))
-            if self.X[len(self.X)-1].size()[0] >= self.batch_size:
-                if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_RPN','reg_x_batch_{}'.format(len(self.X)-1))
-                    torch.save(self.X[len(self.X)-1], path_to_save)
-                    self.X[len(self.X)-1] = torch.empty((0, self.feat_size), dtype=torch.float32, device=self.training_device)
+                self.C[len(self.C)-1].append(torch.full((ids_size,1), i, dtype=torch.float32, device=feat.device))
+                self.X[len(self.X)-1].append(feat)
+                if self.X[len(self.X)-1].is_full():
+                    if self.save_features:
+                        self.feature_writer.append('reg_x', self.X[len(self.X)-1].view())
+                        self.X[len(self.X)-1] = FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device)
 
-                    path_to_save = os.path.join(result_dir, 'features_RPN','reg_c_batch_{}'.format(len(self.C)-1))
-                    torch.save(self.C[len(self.C)-1], path_to_save)
-                    self.C[len(self.C)-1] = torch.empty((0), dtype=torch.float32, device=self.training_device)
+                        self.feature_writer.append('reg_c', self.C[len(self.C)-1].view())
+                        self.C[len(self.C)-1] = FeatureBuffer(self.batch_size, (1,), device=self.training_device)
 
-                    path_to_save = os.path.join(result_dir, 'features_RPN','reg_y_batch_{}'.format(len(self.Y)-1))
-                    torch.save(self.Y[len(self.Y)-1], path_to_save)
-                    self.Y[len(self.Y)-1] = torch.empty((0, 4), dtype=torch.float32, device=self.training_device)
+                        self.feature_writer.append('reg_y', self.Y[len(self.Y)-1].view())
+                        self.Y[len(self.Y)-1] = FeatureBuffer(self.batch_size, (4,), device=self.training_device)
 
-                self.X.append(torch.empty((0, self.feat_size), dtype=torch.float32, device=self.training_device))
-                self.C.append(torch.empty((0), dtype=torch.float32, device=self.training_device))
-                self.Y.append(torch.empty((0, 4), dtype=torch.float32, device=self.training_device))
+                    self.X.append(FeatureBuffer(self.batch_size, (self.feat_size,), device=self.training_device))
+                    self.C.append(FeatureBuffer(self.batch_size, (1,), device=self.training_device))
+                    self.Y.append(FeatureBuffer(self.batch_size, (4,), device=self.training_device))
 
         return {}, {}, 0
 
@@ -0,0 +1,130 @@
+import glob
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch import nn
+
+# Bump to invalidate the feature maps saved with a different format
+CACHE_VERSION = 1
+
+
+def backbone_cache_key(cfg, backbone):
+    """
+    Hash of the backbone weights and of the configuration of the input transform, which together determine the
+    feature map of an image.
+    """
+    sha1 = hashlib.sha1()
+    for name, tensor in sorted(backbone.state_dict().items()):
+        sha1.update(name.encode('utf-8'))
+        sha1.update(tensor.detach().cpu().numpy().tobytes())
+    sha1.update(repr((CACHE_VERSION, cfg.MODEL.BACKBONE.CONV_BODY, cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST,
+                      tuple(cfg.INPUT.PIXEL_MEAN), tuple(cfg.INPUT.PIXEL_STD), cfg.INPUT.TO_BGR255, cfg.DTYPE)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class BackboneFeatureCache(object):
+    """
+    On-disk cache of the backbone feature maps of single images, saved as float16 .npy files in a subdirectory of
+    root named after the key of the backbone and of the input transform, and read back memory-mapped. When the cached
+    files exceed max_size_gb, the least recently used ones (of any key) are removed.
+    """
+
+    def __init__(self, root, key, max_size_gb=0):
+        self.dir = os.path.join(root, key)
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.max_size = int(max_size_gb * 1024 ** 3) if max_size_gb > 0 else None
+        self.hits = 0
+        self.misses = 0
+        # Sizes of the cached files, from the least to the most recently used
+        self.entries = OrderedDict()
+        for path in sorted(glob.glob(os.path.join(root, '*', '*.npy')), key=os.path.getmtime):
+            self.entries[path] = os.path.getsize(path)
+        self.size = sum(self.entries.values())
+
+    def path(self, image_key):
+        return os.path.join(self.dir, hashlib.sha1(image_key.encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, image_key, device='cuda'):
+        # Returns the [1, C, H, W] float32 feature map of the image, or None if it is not cached
+        path = self.path(image_key)
+        if path not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(path)
+        os.utime(path, None)
+        # Copy-on-write mapping, which torch can wrap without copying: the file is read once, by the copy to device
+        features = np.load(path, mmap_mode='c')
+        return torch.from_numpy(features).to(device).float()
+
+    def put(self, image_key, features):
+        path = self.path(image_key)
+        # Write to a temporary file first, so that an interrupted save does not leave a truncated feature map
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, features.detach().to(torch.float16).cpu().numpy())
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path) - self.entries.pop(path, 0)
+        self.entries[path] = os.path.getsize(path)
+        while self.max_size is not None and self.size > self.max_size and len(self.entries) > 1:
+            evicted_path, evicted_size = self.entries.popitem(last=False)
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass
+            self.size -= evicted_size
+
+    def log_stats(self):
+        logger = logging.getLogger("maskrcnn_benchmark.inference")
+        logger.info("Backbone feature cache {}: {} hits, {} misses, {:.2f} GB cached".format(self.dir, self.hits, self.misses, self.size / 1024 ** 3))
+
+
+class CachedBackbone(nn.Module):
+    """
+    Wraps a single-level backbone, returning the cached feature map of the image identified by image_key, which must
+    be set before each forward pass, or computing and caching it. Feature maps are rounded to float16 also when they
+    are computed, so that runs with and without cache hits use the same features.
+    """
+
+    def __init__(self, backbone, cache):
+        super(CachedBackbone, self).__init__()
+        self.backbone = backbone
+        self.cache = cache
+        self.out_channels = backbone.out_channels
+        self.image_key = None
+
+    def forward(self, x):
+        features = self.cache.get(self.image_key, device=x.device)
+        if features is not None:
+            return [features]
+        features = self.backbone(x)
+        if len(features) != 1:
+            # Multi-level feature maps are not cached
+            return features
+        self.cache.put(self.image_key, features[0])
+        return [features[0].to(torch.float16).float()]
+
+
+def make_cached_backbone(cfg, backbone):
+    """
+    Returns backbone wrapped with the cache in cfg.BACKBONE_CACHE.DIR, or None if the cache is disabled.
+    """
+    try:
+        cache_dir = cfg.BACKBONE_CACHE.DIR
+    except:
+        cache_dir = ''
+    if not cache_dir:
+        return None
+    cache = BackboneFeatureCache(cache_dir, backbone_cache_key(cfg, backbone), max_size_gb=cfg.BACKBONE_CACHE.MAX_SIZE_GB)
+    return CachedBackbone(backbone, cache)
+
+
+def image_cache_key(dataset, i):
+    # Identifies, among the images of all the datasets, the image loaded for row i of the annotation index of dataset.
+    # dataset.ids may skip the images without annotations, so it is not used here
+    return '{} {} {}'.format(type(dataset).__name__, dataset.root, dataset.annotation_index.ids[i])
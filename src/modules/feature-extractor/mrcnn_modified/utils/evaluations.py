@@ -3,16 +3,25 @@ import torch
 
 def compute_overlap_torch(gt, prop):
 
-    gt_tens = torch.ones((prop.size()[0], 4), device='cuda') * gt
-    xmin = torch.max(gt_tens[:, 0], prop[:,0])
-    ymin = torch.max(gt_tens[:, 1], prop[:,1])
-    xmax = torch.min(gt_tens[:, 2], prop[:,2])
-    ymax = torch.min(gt_tens[:, 3], prop[:,3])
-    intersection_area = (xmax - xmin + 1) * (ymax - ymin + 1)
-    gt_area = (gt_tens[:, 2] - gt_tens[:, 0] + 1) * (gt_tens[:, 3] - gt_tens[:, 1] + 1)
-    pred_area = (prop[:, 2] - prop[:, 0] + 1) * (prop[:, 3] - prop[:, 1] + 1)
+    return compute_overlap_matrix_torch(gt.view(1, 4), prop)[0]
+
+
+def compute_overlap_matrix_torch(gt, prop):
+    """
+    Computes the [G, N] IoU matrix between [G, 4] gt boxes and [N, 4] proposals, in xyxy format, on their device.
+    """
+    gt = gt.view(-1, 1, 4)
+    prop = prop.view(1, -1, 4)
+    xmin = torch.max(gt[:, :, 0], prop[:, :, 0])
+    ymin = torch.max(gt[:, :, 1], prop[:, :, 1])
+    xmax = torch.min(gt[:, :, 2], prop[:, :, 2])
+    ymax = torch.min(gt[:, :, 3], prop[:, :, 3])
+    intersection_w = xmax - xmin + 1
+    intersection_h = ymax - ymin + 1
+    intersection_area = intersection_w * intersection_h
+    gt_area = (gt[:, :, 2] - gt[:, :, 0] + 1) * (gt[:, :, 3] - gt[:, :, 1] + 1)
+    pred_area = (prop[:, :, 2] - prop[:, :, 0] + 1) * (prop[:, :, 3] - prop[:, :, 1] + 1)
     overlap = intersection_area / (gt_area + pred_area - intersection_area)
-    overlap = torch.where((xmax - xmin + 1) > 0, overlap, torch.zeros(overlap.size(), device='cuda'))
-    overlap = torch.where((ymax - ymin + 1) > 0, overlap, torch.zeros(overlap.size(), device='cuda'))
+    overlap = torch.where((intersection_w > 0) & (intersection_h > 0), overlap, torch.zeros_like(overlap))
 
     return overlap
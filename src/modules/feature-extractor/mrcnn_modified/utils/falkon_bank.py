@@ -0,0 +1,98 @@
+import torch
+
+# Maximum number of elements of a kernel block computed at once, i.e. rows of the features times stacked centres
+MAX_KERNEL_ELEMENTS = 2**25
+
+
+def _kernel_sigma(model):
+    sigma = model.kernel.sigma
+    if torch.is_tensor(sigma):
+        if sigma.numel() != 1:
+            raise ValueError('FusedFalkonBank supports only Gaussian kernels with a scalar sigma.')
+        sigma = sigma.item()
+    return float(sigma)
+
+
+class FusedFalkonBank(object):
+    """
+    Scores features with a list of one-vs-all FALKON models at once. The Nystrom centres of all the models sharing
+    the same sigma are stacked (and deduplicated), so that a single Gaussian kernel evaluation and a single matmul with
+    the [M, num_classes] alpha matrix produce the scores of all the classes. Classes without a model are set to
+    fill_value.
+    """
+
+    def __init__(self, models, fill_value=-2, max_kernel_elements=MAX_KERNEL_ELEMENTS):
+        self.models = list(models)
+        self.num_classes = len(self.models)
+        self.fill_value = fill_value
+        self.max_kernel_elements = max_kernel_elements
+
+        classes_per_sigma = {}
+        for c, model in enumerate(self.models):
+            if model is not None:
+                classes_per_sigma.setdefault(_kernel_sigma(model), []).append(c)
+
+        # Each group holds gamma = 1/(2*sigma^2), centres, their squared norms, alpha and the indices of its classes
+        self.groups = []
+        for sigma, classes in classes_per_sigma.items():
+            centers = torch.cat([self.models[c].ny_points_.to(torch.float32) for c in classes], dim=0)
+            device = centers.device
+            centers, inverse = torch.unique(centers, dim=0, return_inverse=True)
+            alpha = torch.zeros((len(centers), len(classes)), dtype=torch.float32, device=device)
+            start = 0
+            for k, c in enumerate(classes):
+                model_alpha = self.models[c].alpha_.to(device=device, dtype=torch.float32).view(-1)
+                rows = inverse[start:start + len(model_alpha)]
+                # Centres shared by two models of the same class are summed, as in the per-model kernel product
+                alpha[:, k].index_add_(0, rows, model_alpha)
+                start += len(model_alpha)
+            self.groups.append({
+                'gamma': 1 / (2 * sigma ** 2),
+                'centers': centers,
+                'centers_norm': (centers * centers).sum(dim=1),
+                'alpha': alpha,
+                'classes': torch.tensor(classes, dtype=torch.long, device=device),
+            })
+
+    def built_from(self, models):
+        # True if the bank was built from exactly these model objects
+        return len(models) == self.num_classes and all(a is b for a, b in zip(models, self.models))
+
+    def to(self, device):
+        for group in self.groups:
+            for key in ('centers', 'centers_norm', 'alpha', 'classes'):
+                group[key] = group[key].to(device)
+        return self
+
+    def predict(self, features):
+        """
+        Returns the [N, num_classes] scores of the [N, feat_dim] features.
+        """
+        features = features.to(torch.float32)
+        scores = torch.full((features.size()[0], self.num_classes), self.fill_value, dtype=torch.float32, device=features.device)
+        features_norm = (features * features).sum(dim=1)
+        for group in self.groups:
+            if group['centers'].device != features.device:
+                self.to(features.device)
+            chunk_size = max(1, self.max_kernel_elements // len(group['centers']))
+            group_scores = torch.empty((features.size()[0], len(group['classes'])), dtype=torch.float32, device=features.device)
+            for start in range(0, features.size()[0], chunk_size):
+                x = features[start:start + chunk_size]
+                # Squared distances ||x||^2 + ||c||^2 - 2 x c^T, clamped to remove negative rounding errors
+                kernel = torch.addmm(group['centers_norm'].unsqueeze(0), x, group['centers'].t(), alpha=-2)
+                kernel += features_norm[start:start + chunk_size].unsqueeze(1)
+                kernel.clamp_(min=0).mul_(-group['gamma']).exp_()
+                group_scores[start:start + chunk_size] = torch.matmul(kernel, group['alpha'])
+            scores[:, group['classes']] = group_scores
+        return scores
+
+
+def get_falkon_bank(owner, models, fill_value=-2):
+    """
+    Returns the FusedFalkonBank cached in owner.falkon_bank, rebuilding it when models are replaced.
+    """
+    bank = getattr(owner, 'falkon_bank', None)
+    if bank is None or not bank.built_from(models) or bank.fill_value != fill_value:
+        bank = FusedFalkonBank(models, fill_value=fill_value)
+        owner.falkon_bank = bank
+    return bank
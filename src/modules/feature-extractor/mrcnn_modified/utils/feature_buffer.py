@@ -0,0 +1,52 @@
+import torch
+
+
+class FeatureBuffer(object):
+    """
+    Batch of features filled in place through a cursor. The [capacity, *row_shape] storage is allocated on device at the
+    first append, and rows are copied into it by slice assignment (moving them to device if needed). The buffer grows
+    only if a single append exceeds its capacity.
+    """
+
+    def __init__(self, capacity, row_shape, device='cuda', dtype=torch.float32):
+        self.capacity = capacity
+        self.row_shape = tuple(row_shape)
+        self.device = device
+        self.dtype = dtype
+        self.storage = None
+        self.cursor = 0
+
+    def __len__(self):
+        return self.cursor
+
+    def is_full(self):
+        return self.cursor >= self.capacity
+
+    def append(self, tensor):
+        tensor = tensor.reshape((-1,) + self.row_shape)
+        num_rows = tensor.size()[0]
+        if num_rows == 0:
+            return
+        if self.storage is None:
+            self.storage = torch.empty((max(self.capacity, num_rows),) + self.row_shape, dtype=self.dtype, device=self.device)
+        elif self.cursor + num_rows > self.storage.size()[0]:
+            storage = torch.empty((self.cursor + num_rows,) + self.row_shape, dtype=self.dtype, device=self.device)
+            storage[:self.cursor] = self.storage[:self.cursor]
+            self.storage = storage
+        self.storage[self.cursor:self.cursor + num_rows] = tensor
+        self.cursor += num_rows
+
+    def view(self):
+        # Filled rows, without copies
+        if self.storage is None:
+            return torch.empty((0,) + self.row_shape, dtype=self.dtype, device=self.device)
+        return self.storage[:self.cursor]
+
+
+def buffer_views(buffers):
+    """
+    Replaces the FeatureBuffers of a (possibly nested) list with the views of their filled rows.
+    """
+    if isinstance(buffers, FeatureBuffer):
+        return buffers.view()
+    return [buffer_views(b) for b in buffers]
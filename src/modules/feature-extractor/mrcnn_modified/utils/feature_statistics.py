@@ -0,0 +1,117 @@
+import torch
+
+# Name of the file where the statistics are saved, in the features directory of the classifiers
+FEATURE_STATISTICS_FILE_NAME = 'feature_statistics.pth'
+
+
+class FeatureStatistics(object):
+    """
+    Per-class streaming statistics of the positive and negative features of the online classifiers, accumulated in
+    float64 while the features are sampled. Each class stores, separately for positives and negatives, the number of
+    examples, their mean, the sum of their squared deviations from the mean (M2) and the sum of their L2 norms, updated
+    batch by batch with the parallel form of Welford's algorithm. The same update merges the statistics of different
+    shards or sessions, also when they have different classes.
+    """
+
+    def __init__(self, feat_size, device='cuda'):
+        self.feat_size = feat_size
+        self.device = device
+        # Per-class [count, mean, M2, sum of norms]
+        self.positives = {}
+        self.negatives = {}
+
+    def classes(self):
+        return sorted(set(self.positives.keys()) | set(self.negatives.keys()))
+
+    def num_examples(self, c, positive=True):
+        moments = self.positives if positive else self.negatives
+        if c not in moments:
+            return 0
+        return moments[c][0]
+
+    def update(self, c, feat, positive):
+        """
+        Adds the [N, feat_size] features feat, positives or negatives of class c.
+        """
+        if feat.size()[0] == 0:
+            return
+        feat = feat.detach().to(device=self.device, dtype=torch.float64).view(-1, self.feat_size)
+        mean = torch.mean(feat, dim=0)
+        m2 = torch.sum((feat - mean) ** 2, dim=0)
+        norms = torch.sum(torch.norm(feat, dim=1))
+        self.combine(self.positives if positive else self.negatives, int(c), [feat.size()[0], mean, m2, norms])
+
+    def combine(self, moments, c, new):
+        if c not in moments:
+            moments[c] = new
+            return
+        n_a, mean_a, m2_a, norms_a = moments[c]
+        n_b, mean_b, m2_b, norms_b = new
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        moments[c] = [n, mean_a + delta * (n_b / n), m2_a + m2_b + delta ** 2 * (n_a * n_b / n), norms_a + norms_b]
+
+    def merge(self, other):
+        """
+        Adds the statistics of other, e.g. computed by another worker or in a previous session, to these ones.
+        """
+        for moments, other_moments in ((self.positives, other.positives), (self.negatives, other.negatives)):
+            for c, (n, mean, m2, norms) in other_moments.items():
+                self.combine(moments, c, [n, mean.to(self.device), m2.to(self.device), norms.to(self.device)])
+        return self
+
+    def compute(self, pos_fraction=1/10, device='cuda'):
+        """
+        Returns the mean, the std and the mean L2 norm of the features. With pos_fraction, they are those of a mixture
+        where each class has the same weight and the positives weigh pos_fraction of the class, as when the same
+        number of features is sampled from each class. Without it, they are those of all the features.
+        """
+        num_classes = len(self.classes())
+        components = []
+        for moments, fraction in ((self.positives, pos_fraction), (self.negatives, None if pos_fraction is None else 1 - pos_fraction)):
+            for n, mean, m2, norms in moments.values():
+                components.append((n if fraction is None else fraction / num_classes, n, mean, m2, norms))
+        total_weight = sum(c[0] for c in components)
+
+        mean = sum(weight * mean_k for weight, _, mean_k, _, _ in components) / total_weight
+        var = sum(weight * (m2_k / n + (mean_k - mean) ** 2) for weight, n, mean_k, m2_k, _ in components) / total_weight
+        mean_norm = sum(weight * norms_k / n for weight, n, _, _, norms_k in components) / total_weight
+        return {'mean': mean.to(device=device, dtype=torch.float32),
+                'std': torch.sqrt(var).to(device=device, dtype=torch.float32),
+                'mean_norm': mean_norm.to(device=device, dtype=torch.float32)}
+
+    def moments(self, c=None, positive=True):
+        """
+        Returns the mean and the std of the positives or the negatives of class c, or of all the classes when c is None.
+        Returns None when no such feature has been added.
+        """
+        moments = self.positives if positive else self.negatives
+        if c is None:
+            components = list(moments.values())
+        else:
+            components = [moments[int(c)]] if int(c) in moments else []
+        if not components:
+            return None
+        n = sum(n_k for n_k, _, _, _ in components)
+        mean = sum(n_k * mean_k for n_k, mean_k, _, _ in components) / n
+        var = sum(m2_k + n_k * (mean_k - mean) ** 2 for n_k, mean_k, m2_k, _ in components) / n
+        return mean.float(), torch.sqrt(var).float()
+
+    def to(self, device):
+        self.device = device
+        for moments in (self.positives, self.negatives):
+            for c in moments:
+                n, mean, m2, norms = moments[c]
+                moments[c] = [n, mean.to(device), m2.to(device), norms.to(device)]
+        return self
+
+    def save(self, path):
+        torch.save({'feat_size': self.feat_size, 'positives': self.positives, 'negatives': self.negatives}, path)
+
+    @staticmethod
+    def load(path, device='cpu'):
+        state = torch.load(path, map_location=device)
+        statistics = FeatureStatistics(state['feat_size'], device=device)
+        statistics.positives = state['positives']
+        statistics.negatives = state['negatives']
+        return statistics
@@ -0,0 +1,431 @@
+import json
+import os
+import queue
+import re
+import threading
+
+import numpy as np
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+CLASS_ENTRY_REGEX = re.compile(r'^(positives|negatives)_cl_(\d+)$')
+LEGACY_BATCH_REGEX = re.compile(r'^(positives_cl_\d+|negatives_cl_\d+|reg_x|reg_c|reg_y)_batch_(\d+)$')
+
+# Precisions available to store features on disk. Labels and regression targets are always kept in float32
+STORAGE_DTYPES = ('float32', 'float16', 'bfloat16', 'int8')
+FEATURE_ROLES = ('positives', 'negatives', 'reg_x')
+STORAGE_ITEMSIZE = {'float32': 4, 'float16': 2, 'bfloat16': 2, 'int8': 1}
+STORAGE_NUMPY_DTYPE = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16, 'int8': np.int8}
+# Standard deviations around the mean covered by the int8 range
+QUANTIZATION_STDS = 6
+
+
+def quantization_grid(array=None, moments=None):
+    """
+    Returns the [2, feat_dim] per-channel offset and scale used to store an entry in int8. The offset is the mean of
+    the features (as in computeFeatStatistics_torch) and the scale covers QUANTIZATION_STDS standard deviations around
+    it, both taken from the (mean, std) moments accumulated by the sampler for the role and class of the entry. Without
+    moments, they are taken from array, the first batch of the entry.
+    """
+    if moments is not None:
+        offset = moments[0].cpu().numpy()
+        scale = QUANTIZATION_STDS * moments[1].cpu().numpy() / 127
+    else:
+        offset = array.mean(axis=0)
+        scale = np.abs(array - offset).max(axis=0) / 127
+    scale[scale == 0] = 1
+    return np.stack((offset, scale)).astype(np.float32)
+
+
+def encode_features(array, storage_dtype, grid=None):
+    """
+    Converts a float32 [N, feat_dim] array to storage_dtype. int8 needs the [2, feat_dim] offset and scale of the
+    entry, values outside its range are clipped.
+    """
+    if storage_dtype == 'float32':
+        return array.astype(np.float32, copy=False)
+    elif storage_dtype == 'float16':
+        return array.astype(np.float16)
+    elif storage_dtype == 'bfloat16':
+        # Keep the upper 16 bits of the float32 representation, rounding to the nearest even
+        bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+        bits = bits + np.uint32(0x7FFF) + ((bits >> np.uint32(16)) & np.uint32(1))
+        return (bits >> np.uint32(16)).astype(np.uint16)
+    elif storage_dtype == 'int8':
+        return np.clip(np.rint((array - grid[0]) / grid[1]), -127, 127).astype(np.int8)
+    raise ValueError('Storage dtype {} is not supported. Choose among {}.'.format(storage_dtype, STORAGE_DTYPES))
+
+
+def decode_features(array, storage_dtype, grid=None):
+    if storage_dtype == 'float32':
+        return array
+    elif storage_dtype == 'float16':
+        return array.astype(np.float32)
+    elif storage_dtype == 'bfloat16':
+        return (array.astype(np.uint32) << np.uint32(16)).view(np.float32)
+    elif storage_dtype == 'int8':
+        return array.astype(np.float32) * grid[1] + grid[0]
+    raise ValueError('Storage dtype {} is not supported. Choose among {}.'.format(storage_dtype, STORAGE_DTYPES))
+
+
+def _new_entry(name, dtype, feat_dim, device):
+    entry = {'dtype': dtype,
+             'feat_dim': feat_dim,
+             'device': device,
+             'rows': 0,
+             'batches': []
+             }
+    match = CLASS_ENTRY_REGEX.match(name)
+    if match:
+        entry['role'] = match.group(1)
+        entry['class'] = int(match.group(2))
+    else:
+        entry['role'] = name
+    return entry
+
+
+class FeatureStoreWriter(object):
+    """
+    Writes feature batches to one contiguous, fixed-dtype file per entry (e.g. 'negatives_cl_3', 'reg_x'),
+    plus a small JSON index with per-class batch lists, row counts, dtype and feature dimension of each file.
+    With async_write, batches are serialized by a background thread while the extraction goes on. The writer takes
+    ownership of the appended tensors, which must not be modified afterwards, and at most max_pending_batches
+    batches wait in the queue, bounding the memory used by the batches still to be written.
+    Features can be stored with a reduced storage_dtype, they are converted back to float32 when loaded. int8 entries
+    are quantized with one offset and scale per entry, saved in the index and derived from feature_statistics, which
+    the sampler sets to the statistics of the features it is accumulating.
+    """
+
+    def __init__(self, features_dir, async_write=False, max_pending_batches=8, storage_dtype='float32'):
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError('Storage dtype {} is not supported. Choose among {}.'.format(storage_dtype, STORAGE_DTYPES))
+        self.features_dir = features_dir
+        self.entries = {}
+        self.storage_dtype = storage_dtype
+        self.feature_statistics = None
+        # int8 offset and scale of the entries
+        self.grids = {}
+        self.async_write = async_write
+        if self.async_write:
+            self.error = None
+            self.pending = queue.Queue(maxsize=max_pending_batches)
+            self.worker = threading.Thread(target=self._run, daemon=True)
+            self.worker.start()
+
+    def append(self, name, tensor):
+        # The int8 grid is fixed here, on the thread that updates the statistics, so that it does not depend on when
+        # the writer thread gets to the batch
+        self._set_grid(name, tensor)
+        if self.async_write:
+            self._raise_worker_error()
+            # Blocks when the queue is full
+            self.pending.put((name, tensor.detach()))
+        else:
+            self._write(name, tensor)
+
+    def _set_grid(self, name, tensor):
+        if self.storage_dtype != 'int8' or name in self.grids or tensor.dtype != torch.float32 or tensor.size()[0] == 0:
+            return
+        match = CLASS_ENTRY_REGEX.match(name)
+        role = match.group(1) if match else name
+        if role not in FEATURE_ROLES:
+            return
+        moments = None
+        if self.feature_statistics is not None:
+            # The grid is fixed at the first batch, when the statistics already include its features
+            moments = self.feature_statistics.moments(int(match.group(2)) if match else None, positive=(role != 'negatives'))
+        array = tensor.detach().cpu().numpy() if moments is None else None
+        self.grids[name] = quantization_grid(array, moments)
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def _raise_worker_error(self):
+        if self.error is not None:
+            raise RuntimeError('Feature store writer failed while saving features in {}.'.format(self.features_dir)) from self.error
+
+    def _write(self, name, tensor):
+        tensor = tensor.detach()
+        if tensor.dim() == 1:
+            tensor = tensor.view(-1, 1)
+        array = tensor.cpu().numpy()
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = _new_entry(name, str(array.dtype), int(array.shape[1]), tensor.device.type)
+            entry['file'] = name + '.bin'
+            if entry['role'] in FEATURE_ROLES and entry['dtype'] == 'float32':
+                entry['storage_dtype'] = self.storage_dtype
+            else:
+                entry['storage_dtype'] = entry['dtype']
+            self.entries[name] = entry
+            # Truncate the file left by a previous run in the same directory
+            open(os.path.join(self.features_dir, entry['file']), 'wb').close()
+        elif array.shape[1] != entry['feat_dim'] or str(array.dtype) != entry['dtype']:
+            raise ValueError('Batch of shape {} and dtype {} does not match entry {} of the feature store.'.format(tuple(array.shape), array.dtype, name))
+        if array.shape[0] == 0:
+            return
+        if entry['storage_dtype'] == 'int8' and 'offset' not in entry:
+            entry['offset'] = self.grids[name][0].tolist()
+            entry['scale'] = self.grids[name][1].tolist()
+        if entry['storage_dtype'] != entry['dtype']:
+            array = encode_features(array, entry['storage_dtype'], self.grids.get(name))
+        with open(os.path.join(self.features_dir, entry['file']), 'ab') as f:
+            np.ascontiguousarray(array).tofile(f)
+        entry['rows'] += int(array.shape[0])
+        entry['batches'].append(int(array.shape[0]))
+
+    def close(self):
+        if self.async_write:
+            # Flush the batches still in the queue and wait for the writer thread
+            self.pending.put(None)
+            self.worker.join()
+            self._raise_worker_error()
+        write_index(self.features_dir, self.entries)
+
+
+def write_index(features_dir, entries):
+    # Written to a temporary file and renamed, so that an interrupted write does not leave a truncated index
+    path = os.path.join(features_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'entries': entries}, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def build_index_from_batch_files(features_dir):
+    """
+    One-time conversion of a features directory saved with a torch.save call per batch
+    (e.g. 'negatives_cl_3_batch_0') into an index. Batch files are listed once and loaded once to count their rows,
+    then the index is saved in the directory, so that next readers open it without loading the batches again.
+    """
+    batch_files = {}
+    for file_name in os.listdir(features_dir):
+        match = LEGACY_BATCH_REGEX.match(file_name)
+        if match:
+            batch_files.setdefault(match.group(1), []).append((int(match.group(2)), file_name))
+    if not batch_files:
+        raise FileNotFoundError('No saved features found in {}.'.format(features_dir))
+
+    entries = {}
+    for name, files in batch_files.items():
+        entry = None
+        for _, file_name in sorted(files):
+            batch = torch.load(os.path.join(features_dir, file_name), map_location=None if torch.cuda.is_available() else 'cpu')
+            if batch.dim() == 1:
+                batch = batch.view(-1, 1)
+            if entry is None:
+                # Batches are loaded back on the device where they have been saved
+                entry = _new_entry(name, str(batch.cpu().numpy().dtype), int(batch.size()[1]), batch.device.type)
+                entry['files'] = []
+            if batch.size()[0] == 0:
+                continue
+            entry['files'].append(file_name)
+            entry['rows'] += int(batch.size()[0])
+            entry['batches'].append(int(batch.size()[0]))
+        entries[name] = entry
+    try:
+        write_index(features_dir, entries)
+    except OSError:
+        print('Could not write the index of the features in {}. It will be rebuilt the next time.'.format(features_dir))
+    return entries
+
+
+class FeatureStoreReader(object):
+    """
+    Opens a features directory through its index. Tensors of contiguous files are backed by np.memmap, so loading
+    them does not copy any data until they are moved to another device.
+    """
+
+    def __init__(self, features_dir):
+        self.features_dir = features_dir
+        if self.exists(features_dir):
+            with open(os.path.join(features_dir, MANIFEST_NAME), 'r') as f:
+                self.entries = json.load(f)['entries']
+        else:
+            self.entries = build_index_from_batch_files(features_dir)
+        # int8 offset and scale of the entries, parsed from the index when first needed
+        self.grids = {}
+        self.validate()
+        # First row of each batch in the file of its entry
+        self.batch_starts = {name: np.cumsum([0] + entry['batches'][:-1]) for name, entry in self.entries.items()}
+
+    @staticmethod
+    def exists(features_dir):
+        return os.path.exists(os.path.join(features_dir, MANIFEST_NAME))
+
+    def validate(self):
+        for name, entry in self.entries.items():
+            if sum(entry['batches']) != entry['rows']:
+                raise ValueError('Index of {} is corrupted: batches of entry {} sum to {} rows instead of {}.'.format(self.features_dir, name, sum(entry['batches']), entry['rows']))
+            files = [entry['file']] if 'file' in entry else entry['files']
+            for file_name in files:
+                if not os.path.exists(os.path.join(self.features_dir, file_name)):
+                    raise FileNotFoundError('File {} of entry {} is listed in the index of {} but it does not exist.'.format(file_name, name, self.features_dir))
+            if 'file' in entry:
+                sizes = [(entry['file'], entry['rows'] * entry['feat_dim'] * self._itemsize(name))]
+                if 'scales_file' in entry:
+                    # Stores saved with an offset and scale per batch
+                    sizes.append((entry['scales_file'], len(entry['batches']) * 2 * entry['feat_dim'] * 4))
+                elif self._storage_dtype(name) == 'int8' and entry['rows'] > 0 and len(entry.get('scale', [])) != entry['feat_dim']:
+                    raise ValueError('Index of {} is corrupted: int8 entry {} has no offset and scale for its {} channels.'.format(self.features_dir, name, entry['feat_dim']))
+                for file_name, expected_size in sizes:
+                    actual_size = os.path.getsize(os.path.join(self.features_dir, file_name))
+                    if actual_size != expected_size:
+                        raise ValueError('File {} has size {} bytes, while {} bytes are expected from the index of {}.'.format(file_name, actual_size, expected_size, self.features_dir))
+
+    def _storage_dtype(self, name):
+        return self.entries[name].get('storage_dtype', self.entries[name]['dtype'])
+
+    def _itemsize(self, name):
+        storage_dtype = self._storage_dtype(name)
+        return STORAGE_ITEMSIZE[storage_dtype] if storage_dtype in STORAGE_ITEMSIZE else np.dtype(storage_dtype).itemsize
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def num_classes(self):
+        classes = [entry['class'] for entry in self.entries.values() if 'class' in entry]
+        return max(classes) + 1 if classes else 0
+
+    def rows(self, name):
+        return self.entries[name]['rows']
+
+    def feat_dim(self, name):
+        return self.entries[name]['feat_dim']
+
+    def batch_rows(self, name):
+        return list(self.entries[name]['batches'])
+
+    def device(self, name):
+        return self.entries[name]['device']
+
+    def _memmap(self, name):
+        entry = self.entries[name]
+        storage_dtype = self._storage_dtype(name)
+        numpy_dtype = STORAGE_NUMPY_DTYPE.get(storage_dtype, storage_dtype)
+        if entry['rows'] == 0:
+            return np.empty((0, entry['feat_dim']), dtype=numpy_dtype)
+        # Copy-on-write mapping: tensors can be modified in place without touching the file
+        return np.memmap(os.path.join(self.features_dir, entry['file']), dtype=numpy_dtype, mode='c',
+                         shape=(entry['rows'], entry['feat_dim']))
+
+    def _batch_array(self, name, j):
+        # Features stored with reduced precision are converted back to float32, one batch at a time
+        entry = self.entries[name]
+        storage_dtype = self._storage_dtype(name)
+        start = int(self.batch_starts[name][j])
+        batch = self._memmap(name)[start:start + entry['batches'][j]]
+        if storage_dtype != entry['dtype']:
+            grid = None
+            if storage_dtype == 'int8' and 'scales_file' in entry:
+                grid = np.memmap(os.path.join(self.features_dir, entry['scales_file']), dtype=np.float32, mode='r',
+                                 offset=j * 2 * entry['feat_dim'] * 4, shape=(2, entry['feat_dim']))
+            elif storage_dtype == 'int8':
+                grid = self._grid(name)
+            batch = decode_features(batch, storage_dtype, grid)
+        return batch
+
+    def _grid(self, name):
+        if name not in self.grids:
+            self.grids[name] = np.array([self.entries[name]['offset'], self.entries[name]['scale']], dtype=np.float32)
+        return self.grids[name]
+
+    def _decoded_batches(self, name):
+        return [self._batch_array(name, j) for j in range(len(self.entries[name]['batches']))]
+
+    def get_batch(self, name, j, device=None):
+        entry = self.entries[name]
+        if 'file' in entry:
+            batch = torch.from_numpy(self._batch_array(name, j))
+        else:
+            batch = torch.load(os.path.join(self.features_dir, entry['files'][j]), map_location='cpu').view(-1, entry['feat_dim'])
+        if device is not None:
+            batch = batch.to(device)
+        return batch
+
+    def get_lazy_batches(self, name, device=None):
+        return LazyBatches(self, name, device=device)
+
+    def _load_batch_files(self, name):
+        return [torch.load(os.path.join(self.features_dir, file_name), map_location='cpu').view(-1, self.entries[name]['feat_dim'])
+                for file_name in self.entries[name]['files']]
+
+    def get(self, name, device=None):
+        entry = self.entries[name]
+        if 'file' in entry and self._storage_dtype(name) == entry['dtype']:
+            tensor = torch.from_numpy(self._memmap(name))
+        elif 'file' in entry:
+            batches = self._decoded_batches(name)
+            tensor = torch.from_numpy(np.concatenate(batches)) if batches else torch.empty((0, entry['feat_dim']))
+        elif entry['rows'] > 0:
+            tensor = torch.cat(self._load_batch_files(name))
+        else:
+            tensor = torch.empty((0, entry['feat_dim']), dtype=getattr(torch, entry['dtype']))
+        if device is not None:
+            tensor = tensor.to(device)
+        return tensor
+
+    def get_batches(self, name, device=None):
+        entry = self.entries[name]
+        if 'file' in entry:
+            batches = [torch.from_numpy(batch) for batch in self._decoded_batches(name)]
+        else:
+            batches = self._load_batch_files(name)
+        if device is not None:
+            batches = [batch.to(device) for batch in batches]
+        return batches
+
+
+class LazyBatches(object):
+    """
+    Sequence of the batches of a feature store entry. Each batch is read from disk, converted to float32, moved to
+    device and transformed only when it is accessed, and it is not retained afterwards.
+    """
+
+    def __init__(self, reader, name, device=None, transform=None):
+        self.reader = reader
+        self.name = name
+        self.device = torch.device(device if device is not None else 'cpu')
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.reader.entries[self.name]['batches'])
+
+    def __getitem__(self, j):
+        if j < 0:
+            j += len(self)
+        if not 0 <= j < len(self):
+            raise IndexError('Batch {} out of range for entry {} with {} batches.'.format(j, self.name, len(self)))
+        batch = self.reader.get_batch(self.name, j, device=self.device)
+        if self.transform is not None:
+            batch = self.transform(batch)
+        return batch
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
+    def batch_rows(self, j):
+        return self.reader.entries[self.name]['batches'][j]
+
+    def to(self, device):
+        # Returns the same sequence, with batches moved to device when they are read
+        return LazyBatches(self.reader, self.name, device=device, transform=self.transform)
+
+    def map(self, transform):
+        # Returns a new sequence whose batches are further transformed by transform
+        if self.transform is None:
+            composed = transform
+        else:
+            previous = self.transform
+            composed = lambda batch: transform(previous(batch))
+        return LazyBatches(self.reader, self.name, device=self.device, transform=composed)
@@ -0,0 +1,55 @@
+import torch
+
+
+class PackedRegressors(object):
+    """
+    RLS box regressors of all the classes packed into a single [feat_size, 4*num_classes] weight matrix and a
+    [4*num_classes] bias, with each class's T_inv and mu folded in, so that the refinements of all the classes are
+    computed with one matmul. Classes without a regressor are zero blocks, i.e. their boxes are not refined.
+    """
+
+    def __init__(self, regressors):
+        self.num_classes = len(regressors)
+        self.weights = None
+        self.bias = None
+
+        weights = []
+        bias = []
+        available = [r for r in regressors if r is not None and r['Beta'] is not None]
+        if not available:
+            return
+        reference = available[0]['Beta']['0']['weights']
+        feat_size = reference.numel() - 1
+        for r in regressors:
+            if r is None or r['Beta'] is None:
+                weights.append(torch.zeros((feat_size, 4), dtype=torch.float32, device=reference.device))
+                bias.append(torch.zeros((4,), dtype=torch.float32, device=reference.device))
+                continue
+            # [feat_size+1, 4] weights of the four targets, whose last row is the bias
+            beta = torch.stack([r['Beta'][str(k)]['weights'].view(-1).to(device=reference.device, dtype=torch.float32) for k in range(4)], dim=1)
+            T_inv = r['T_inv'].to(device=reference.device, dtype=torch.float32)
+            mu = r['mu'].to(device=reference.device, dtype=torch.float32).view(-1)
+            # ((x W + b) T_inv + mu) = x (W T_inv) + (b T_inv + mu)
+            weights.append(torch.matmul(beta[:-1], T_inv))
+            bias.append(torch.matmul(beta[-1], T_inv) + mu)
+        self.weights = torch.cat(weights, dim=1)
+        self.bias = torch.cat(bias)
+
+    def __len__(self):
+        return self.num_classes
+
+    def to(self, device):
+        if self.weights is not None and self.weights.device != torch.device(device):
+            self.weights = self.weights.to(device)
+            self.bias = self.bias.to(device)
+        return self
+
+    def predict(self, features):
+        """
+        Returns the [N, 4*num_classes] regression targets of the [N, feat_size] features, with the four targets of
+        class j in columns 4*j to 4*j+3.
+        """
+        if self.weights is None:
+            return torch.zeros((features.size()[0], 4 * self.num_classes), dtype=torch.float32, device=features.device)
+        self.to(features.device)
+        return torch.addmm(self.bias, features.to(torch.float32), self.weights)
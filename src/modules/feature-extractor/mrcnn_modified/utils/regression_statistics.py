@@ -0,0 +1,98 @@
+import torch
+
+# Name of the file where the statistics are saved, in the features directory of the regressors
+STATISTICS_FILE_NAME = 'regression_statistics.pth'
+
+
+def add_bias(X):
+    return torch.cat((X, torch.ones((X.size()[0], 1), dtype=X.dtype, device=X.device)), dim=1)
+
+
+class RegressionStatistics(object):
+    """
+    Per-class sufficient statistics of the box regression problem, accumulated in float64 instead of keeping the
+    regression features. With Xb = [X, 1] the features of a class with a bias column and Y its targets, the class
+    stores XX = Xb'Xb, XY = Xb'Y and YY = Y'Y. The last row of XX holds the feature sums and the number of examples,
+    the last row of XY holds the target sums.
+    """
+
+    def __init__(self, feat_size, device='cuda'):
+        self.feat_size = feat_size
+        self.device = device
+        self.XX = {}
+        self.XY = {}
+        self.YY = {}
+
+    def __contains__(self, c):
+        return c in self.XX
+
+    def classes(self):
+        return sorted(self.XX.keys())
+
+    def num_examples(self, c):
+        if c not in self.XX:
+            return 0
+        return int(round(self.XX[c][-1, -1].item()))
+
+    def update(self, X, Y, C):
+        """
+        Adds the [N, feat_size] features X, the [N, 4] targets Y and the N classes C of new examples.
+        """
+        if X.size()[0] == 0:
+            return
+        X = X.to(device=self.device, dtype=torch.float64)
+        Y = Y.to(device=self.device, dtype=torch.float64)
+        C = C.to(self.device).view(-1)
+        for c in torch.unique(C).tolist():
+            ids = C == c
+            self.update_class(int(c), X[ids], Y[ids])
+
+    def update_class(self, c, X, Y):
+        # Classes are keyed by int, a tensor class would hash by identity and add a new entry at every call
+        c = int(c)
+        X = add_bias(X.to(device=self.device, dtype=torch.float64))
+        Y = Y.to(device=self.device, dtype=torch.float64)
+        if c not in self.XX:
+            self.XX[c] = torch.zeros((self.feat_size + 1, self.feat_size + 1), dtype=torch.float64, device=self.device)
+            self.XY[c] = torch.zeros((self.feat_size + 1, 4), dtype=torch.float64, device=self.device)
+            self.YY[c] = torch.zeros((4, 4), dtype=torch.float64, device=self.device)
+        self.XX[c].addmm_(torch.t(X), X)
+        self.XY[c].addmm_(torch.t(X), Y)
+        self.YY[c].addmm_(torch.t(Y), Y)
+
+    def normalized(self, mean, scale):
+        """
+        Returns the statistics of the features normalized as (X - mean) * scale. The normalization is an affine map
+        Xb -> Xb A of the biased features, so that XX -> A'XX A and XY -> A'XY.
+        """
+        A = torch.eye(self.feat_size + 1, dtype=torch.float64, device=self.device)
+        A[:-1, :-1] *= scale
+        A[-1, :-1] = -scale * mean.to(device=self.device, dtype=torch.float64).view(-1)
+        normalized = RegressionStatistics(self.feat_size, device=self.device)
+        for c in self.XX:
+            normalized.XX[c] = torch.matmul(torch.t(A), torch.matmul(self.XX[c], A))
+            normalized.XY[c] = torch.matmul(torch.t(A), self.XY[c])
+            normalized.YY[c] = self.YY[c].clone()
+        return normalized
+
+    def to(self, device):
+        self.device = device
+        for stats in (self.XX, self.XY, self.YY):
+            for c in stats:
+                stats[c] = stats[c].to(device)
+        return self
+
+    def save(self, path):
+        torch.save({'feat_size': self.feat_size, 'XX': self.XX, 'XY': self.XY, 'YY': self.YY}, path)
+
+    @staticmethod
+    def load(path, device=None):
+        # Statistics are loaded back on the device where they have been saved, if device is not specified
+        state = torch.load(path, map_location=device)
+        if device is None:
+            device = next(iter(state['XX'].values())).device.type if state['XX'] else 'cpu'
+        statistics = RegressionStatistics(state['feat_size'], device=device)
+        statistics.XX = state['XX']
+        statistics.XY = state['XY']
+        statistics.YY = state['YY']
+        return statistics
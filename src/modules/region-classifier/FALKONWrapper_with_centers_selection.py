@@ -38,6 +38,8 @@ class FALKONWrapper(ca.ClassifierAbstract):
 
         self.kernel = None
         self.nyst_centers = opts['M']
+        # Set to train without the GPU, e.g. in processes forked from one that has initialized CUDA
+        self.use_cpu = False
 
     def train(self, X, y, sigma=None, lam=None):
         # Set sigma and lambda
@@ -50,7 +52,7 @@ class FALKONWrapper(ca.ClassifierAbstract):
         # Compute indices of nystrom centers
         indices = self.compute_indices_selection(y)
         center_selector = MyCenterSelector(indices)
-        opt = FalkonOptions(min_cuda_iter_size_32=0, min_cuda_iter_size_64=0,  keops_active="no")
+        opt = FalkonOptions(min_cuda_iter_size_32=0, min_cuda_iter_size_64=0,  keops_active="no", use_cpu=self.use_cpu)
         # Initialize FALKON model
         self.model = Falkon(
             kernel=self.kernel,
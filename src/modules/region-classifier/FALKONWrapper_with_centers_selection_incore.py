@@ -2,7 +2,7 @@ import sys
 import os
 basedir = os.path.dirname(__file__)
 sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir)))
-from falkon import InCoreFalkon, kernels
+from falkon import Falkon, InCoreFalkon, kernels
 import ClassifierAbstract as ca
 import torch
 import yaml
@@ -38,6 +38,8 @@ class FALKONWrapper(ca.ClassifierAbstract):
 
         self.kernel = None
         self.nyst_centers = opts['M']
+        # Set to train without the GPU, e.g. in processes forked from one that has initialized CUDA
+        self.use_cpu = False
 
     def train(self, X, y, sigma=None, lam=None):
         # Set sigma and lambda
@@ -50,9 +52,15 @@ class FALKONWrapper(ca.ClassifierAbstract):
         # Compute indices of nystrom centers
         indices = self.compute_indices_selection(y)
         center_selector = MyCenterSelector(indices)
-        opt = FalkonOptions(min_cuda_iter_size_32=0, min_cuda_iter_size_64=0,  keops_active="no", min_cuda_pc_size_32=0, min_cuda_pc_size_64=0)
+        if self.use_cpu:
+            # InCoreFalkon requires the GPU, the out-of-core model is trained in cpu instead
+            opt = FalkonOptions(keops_active="no", use_cpu=True)
+            falkon_model = Falkon
+        else:
+            opt = FalkonOptions(min_cuda_iter_size_32=0, min_cuda_iter_size_64=0,  keops_active="no", min_cuda_pc_size_32=0, min_cuda_pc_size_64=0)
+            falkon_model = InCoreFalkon
         # Initialize FALKON model
-        self.model = InCoreFalkon(
+        self.model = falkon_model(
             kernel=self.kernel,
             penalty=lam,
             M=len(indices),
@@ -14,6 +14,22 @@ import time
 
 import yaml
 import copy
+import multiprocessing
+
+# Positives, negatives and classifier shared with the forked workers of the parallel training
+_parallel_training_state = None
+
+
+def _init_training_worker(num_threads):
+    torch.set_num_threads(num_threads)
+    # CUDA cannot be used in a process forked after the parent has initialized it, so workers train FALKON in cpu
+    region_classifier, _, _ = _parallel_training_state
+    region_classifier.classifier.use_cpu = True
+
+
+def _train_class_in_worker(i):
+    region_classifier, negatives, positives = _parallel_training_state
+    return i, region_classifier.trainClass(i, negatives[i], positives[i])
 
 
 class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
@@ -35,6 +51,21 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                 self.sigma = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']['sigma']
                 self.hard_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['HARD_THRESH']
                 self.easy_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['EASY_THRESH']
+            try:
+                parallel_options = self.cfg['ONLINE_SEGMENTATION' if is_segmentation else 'ONLINE_REGION_CLASSIFIER']['PARALLEL']
+                self.num_workers = parallel_options['NUM_WORKERS']
+                self.threads_per_worker = parallel_options.get('THREADS_PER_WORKER')
+            except KeyError:
+                self.num_workers = 0
+                self.threads_per_worker = None
+            try:
+                self.test_chunk_size = self.cfg['ONLINE_SEGMENTATION' if is_segmentation else 'ONLINE_REGION_CLASSIFIER']['TEST_CHUNK_SIZE']
+            except KeyError:
+                self.test_chunk_size = 64
+            try:
+                self.normalize_in_place = self.cfg['ONLINE_SEGMENTATION' if is_segmentation else 'ONLINE_REGION_CLASSIFIER']['NORMALIZE_IN_PLACE']
+            except KeyError:
+                self.normalize_in_place = False
             self.mean = 0
             self.std = 0
             self.mean_norm = 0
@@ -76,6 +107,12 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
             self.lam = opts['lam']
         if 'sigma' in opts:
             self.sigma = opts['sigma']
+        if 'normalize_in_place' in opts:
+            self.normalize_in_place = opts['normalize_in_place']
+        if 'num_workers' in opts:
+            self.num_workers = opts['num_workers']
+        if 'threads_per_worker' in opts:
+            self.threads_per_worker = opts['threads_per_worker']
 
 
     def updateModel(self, cache):
@@ -93,53 +130,92 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
             print('Updating model with default lambda and sigma')
             return self.classifier.train(X, y)
 
+    def trainClass(self, i, negatives_i, positives_i):
+        if (len(positives_i) == 0) or (len(negatives_i) == 0):
+            return None
+        print('---------------------- Training Class number {} ----------------------'.format(i))
+        model = None
+        cache = None
+        # Batches are accessed one at a time, so that lazy sources of negatives only keep in memory the
+        # current batch and the hard negatives already selected
+        for j, negatives_j in enumerate(negatives_i):
+            t_iter = time.time()
+            if cache is None:
+                cache = {}
+                cache['pos'] = positives_i
+                cache['neg'] = negatives_j
+            else:
+                t_hard = time.time()
+                neg_pred = self.classifier.predict(model, negatives_j)
+                hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
+                cache['neg'] = torch.cat((cache['neg'], negatives_j[hard_idx]), 0)
+                print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
+                print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
+
+            print('Traning with {} positives and {} negatives'.format(len(cache['pos']), len(cache['neg'])))
+            t_update = time.time()
+            model = self.updateModel(cache)
+            print('Model updated in {} seconds'.format(time.time() - t_update))
+
+            t_easy = time.time()
+            if len(cache['neg']) != 0:
+                neg_pred = self.classifier.predict(model, cache['neg'])
+                keep_idx = torch.where(neg_pred >= self.easy_tresh)[0]
+                easy_idx = len(cache['neg']) - len(keep_idx)
+                cache['neg'] = cache['neg'][keep_idx]
+                print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
+                print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(cache['neg'])))
+                print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
+            del negatives_j
+        # Delete cache of the i-th classifier to free memory
+        del cache
+        torch.cuda.empty_cache()
+        return model
+
+    def classSize(self, negatives_i, positives_i):
+        if hasattr(negatives_i, 'batch_rows'):
+            num_negatives = sum(negatives_i.batch_rows(j) for j in range(len(negatives_i)))
+        else:
+            num_negatives = sum(len(negatives_ij) for negatives_ij in negatives_i)
+        return len(positives_i) + num_negatives
+
+    def trainClassesInParallel(self, negatives, positives):
+        # Worker processes are forked, so that they read positives, negatives and the classifier from the parent
+        # without pickling them. Only the trained models are sent back.
+        global _parallel_training_state
+        classes = list(range(self.num_classes-1))
+        # Largest classes are scheduled first to balance the load of the workers
+        classes.sort(key=lambda i: self.classSize(negatives[i], positives[i]), reverse=True)
+        threads_per_worker = self.threads_per_worker
+        if threads_per_worker is None:
+            threads_per_worker = max(1, multiprocessing.cpu_count() // self.num_workers)
+        print('Training {} classes with {} workers and {} threads per worker'.format(len(classes), self.num_workers, threads_per_worker))
+
+        _parallel_training_state = (self, negatives, positives)
+        model = [None] * (self.num_classes-1)
+        try:
+            pool = torch.multiprocessing.get_context('fork').Pool(self.num_workers, initializer=_init_training_worker, initargs=(threads_per_worker,))
+            try:
+                for i, model_i in pool.imap_unordered(_train_class_in_worker, classes):
+                    model[i] = model_i
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _parallel_training_state = None
+        return model
+
     def trainWithMinibootstrap(self, negatives, positives, output_dir=None):
-        caches = []
-        model = []
         t = time.time()
-        for i in range(self.num_classes-1):
-            if (len(positives[i]) != 0) & (len(negatives[i]) != 0):
-                print('---------------------- Training Class number {} ----------------------'.format(i))
-                first_time = True
-                for j in range(len(negatives[i])):
-                    t_iter = time.time()
-                    if first_time:
-                        dataset = {}
-                        dataset['pos'] = positives[i].cpu()
-                        dataset['neg'] = negatives[i][j].cpu()
-                        caches.append(dataset)
-                        model.append(None)
-                        first_time = False
-                    else:
-                        t_hard = time.time()
-                        neg_pred = self.classifier.predict(model[i], negatives[i][j].cpu())
-                        hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
-                        caches[i]['neg'] = torch.cat((caches[i]['neg'], negatives[i][j][hard_idx].cpu()), 0)
-                        print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
-                        print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
-
-                    print('Traning with {} positives and {} negatives'.format(len(caches[i]['pos']), len(caches[i]['neg'])))
-                    t_update = time.time()
-                    model[i] = self.updateModel(caches[i])
-                    print('Model updated in {} seconds'.format(time.time() - t_update))
-
-                    t_easy = time.time()
-                    if len(caches[i]['neg']) != 0:
-                        neg_pred = self.classifier.predict(model[i], caches[i]['neg'])
-                        keep_idx = torch.where(neg_pred >= self.easy_tresh)[0]
-                        easy_idx = len(caches[i]['neg']) - len(keep_idx)
-                        caches[i]['neg'] = caches[i]['neg'][keep_idx]
-                        print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
-                        print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(caches[i]['neg'])))
-                        print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
-                    # Delete cache of the i-th classifier if it is the last iteration to free memory
-                    if j == len(negatives[i]) - 1:
-                        caches[i] = None
-                        torch.cuda.empty_cache()
-            else:
-                model.append(None)
-                dataset = {}
-                caches.append(dataset)
+        in_cpu = all(positives_i.device.type == 'cpu' for positives_i in positives if hasattr(positives_i, 'device'))
+        if self.num_workers > 1 and in_cpu:
+            model = self.trainClassesInParallel(negatives, positives)
+        else:
+            if self.num_workers > 1:
+                print('Parallel training requires features in cpu, training classes sequentially')
+            model = []
+            for i in range(self.num_classes-1):
+                model.append(self.trainClass(i, negatives[i], positives[i]))
 
         training_time = time.time() - t
         print('Online Classifier trained in {} seconds'.format(training_time))
@@ -161,18 +237,30 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
         negatives = self.negatives
         positives = self.positives
 
-        # Convert stats to data device
-        self.mean = self.mean.to(negatives[0][0].device)
-        self.std = self.std.to(negatives[0][0].device)
-        self.mean_norm = self.mean_norm.to(negatives[0][0].device)
+        # Features and stats are moved to cpu once, before the minibootstrap
+        for i in range(self.num_classes-1):
+            positives[i] = positives[i].cpu()
+            if isinstance(negatives[i], list):
+                for j in range(len(negatives[i])):
+                    negatives[i][j] = negatives[i][j].cpu()
+            else:
+                negatives[i] = negatives[i].to('cpu')
+        self.mean = self.mean.cpu()
+        self.std = self.std.cpu()
+        self.mean_norm = self.mean_norm.cpu()
 
         if not self.normalized:
             for i in range(self.num_classes-1):
                 if len(positives[i]):
-                    positives[i] = self.zScores(positives[i])
-                for j in range(len(negatives[i])):
-                    if len(negatives[i][j]):
-                        negatives[i][j] = self.zScores(negatives[i][j])
+                    positives[i] = self.zScores(positives[i], in_place=self.normalize_in_place)
+                if isinstance(negatives[i], list):
+                    for j in range(len(negatives[i])):
+                        if len(negatives[i][j]):
+                            negatives[i][j] = self.zScores(negatives[i][j], in_place=self.normalize_in_place)
+                else:
+                    # Lazy sources of negatives are normalized when each batch is read, into a new tensor since the
+                    # batch may be backed by the memory-mapped file
+                    negatives[i] = negatives[i].map(self.zScores)
             self.normalized = True
 
         
@@ -189,29 +277,32 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                 model[c].alpha_ = model[c].alpha_.to('cuda')
         except:
             pass
+        # All the classifiers are evaluated with a single kernel evaluation per image
+        from mrcnn_modified.utils.falkon_bank import FusedFalkonBank
+        falkon_bank = FusedFalkonBank(model[:self.num_classes-1], fill_value=-2).to('cuda')
 
         # Convert stats to gpu tensors for inference
         self.mean = self.mean.to('cuda')
         self.std = self.std.to('cuda')
         self.mean_norm = self.mean_norm.to('cuda')
 
-        for i in range(len(test_boxes)):
-            l = test_boxes[i]
-            if l is not None:
-                I = np.nonzero(l['gt'] == 0)
-                boxes = l['boxes'][I, :][0]
-                X_test = torch.tensor(l['feat'][I, :][0], device='cuda')
-                t0 = time.time()
-                if self.mean_norm != 0:
-                   X_test = self.zScores(X_test)
-                scores = - torch.ones((len(boxes), self.num_classes))
-                for c in range(0, self.num_classes-1):
-                    pred = self.classifier.predict(model[c], X_test)
-                    scores[:, c+1] = torch.squeeze(pred)
-
-                total_testing_time = total_testing_time + time.time() - t0
-                b = BoxList(torch.from_numpy(boxes), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
-                b.add_field("scores", scores.to('cpu'))
+        # Non-gt features of groups of test_chunk_size images are scored together and split back per image
+        test_images = [l for l in test_boxes if l is not None]
+        for c in range(0, len(test_images), self.test_chunk_size):
+            chunk = test_images[c:c + self.test_chunk_size]
+            I = [np.nonzero(l['gt'] == 0)[0] for l in chunk]
+            boxes = [l['boxes'][I[j], :] for j, l in enumerate(chunk)]
+            X_test = torch.as_tensor(np.concatenate([l['feat'][I[j], :] for j, l in enumerate(chunk)]), dtype=torch.float32).to('cuda')
+            t0 = time.time()
+            if self.mean_norm != 0:
+               X_test = self.zScores(X_test)
+            scores = - torch.ones((X_test.size()[0], self.num_classes))
+            scores[:, 1:] = falkon_bank.predict(X_test)
+
+            total_testing_time = total_testing_time + time.time() - t0
+            for l, boxes_l, scores_l in zip(chunk, boxes, torch.split(scores, [len(b) for b in boxes])):
+                b = BoxList(torch.from_numpy(boxes_l), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
+                b.add_field("scores", scores_l)
                 predictions.append(b)
 
         avg_time = total_testing_time/len(test_boxes)
@@ -221,7 +312,10 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
     def predict(self, dataset) -> None:
         pass
 
-    def zScores(self, feat, target_norm=20):
+    def zScores(self, feat, target_norm=20, in_place=False):
+        if in_place and feat.dtype == self.mean.dtype:
+            # feat is overwritten, so that no temporary copy of it is allocated
+            return feat.sub_(self.mean).mul_(target_norm / self.mean_norm.item())
         feat = feat - self.mean
         feat = feat * (target_norm / self.mean_norm.item())
         return feat
@@ -35,6 +35,14 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                 self.sigma = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']['sigma']
                 self.hard_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['HARD_THRESH']
                 self.easy_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['EASY_THRESH']
+            try:
+                self.test_chunk_size = self.cfg['ONLINE_SEGMENTATION' if is_segmentation else 'ONLINE_REGION_CLASSIFIER']['TEST_CHUNK_SIZE']
+            except KeyError:
+                self.test_chunk_size = 64
+            try:
+                self.normalize_in_place = self.cfg['ONLINE_SEGMENTATION' if is_segmentation else 'ONLINE_REGION_CLASSIFIER']['NORMALIZE_IN_PLACE']
+            except KeyError:
+                self.normalize_in_place = False
             self.mean = 0
             self.std = 0
             self.mean_norm = 0
@@ -79,6 +87,8 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
             self.lam = opts['lam']
         if 'sigma' in opts:
             self.sigma = opts['sigma']
+        if 'normalize_in_place' in opts:
+            self.normalize_in_place = opts['normalize_in_place']
         if 'return_caches' in opts:
             self.return_caches = opts['return_caches']
         if 'normalized' in opts:
@@ -108,20 +118,22 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
             if (len(positives[i]) != 0) & (len(negatives[i]) != 0):
                 print('---------------------- Training Class number {} ----------------------'.format(i))
                 first_time = True
-                for j in range(len(negatives[i])):
+                # Batches are accessed one at a time, so that lazy sources of negatives only keep in memory the
+                # current batch and the hard negatives already selected
+                for j, negatives_j in enumerate(negatives[i]):
                     t_iter = time.time()
                     if first_time:
                         dataset = {}
                         dataset['pos'] = positives[i]
-                        dataset['neg'] = negatives[i][j]
+                        dataset['neg'] = negatives_j
                         caches.append(dataset)
                         model.append(None)
                         first_time = False
                     else:
                         t_hard = time.time()
-                        neg_pred = self.classifier.predict(model[i], negatives[i][j])
+                        neg_pred = self.classifier.predict(model[i], negatives_j)
                         hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
-                        caches[i]['neg'] = torch.cat((caches[i]['neg'], negatives[i][j][hard_idx]), 0)
+                        caches[i]['neg'] = torch.cat((caches[i]['neg'], negatives_j[hard_idx]), 0)
                         print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
                         print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
 
@@ -139,6 +151,7 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                         print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
                         print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(caches[i]['neg'])))
                         print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
+                    del negatives_j
                     # Delete cache of the i-th classifier if it is the last iteration to free memory
                     if j == len(negatives[i]) - 1 and not self.return_caches:
                         caches[i] = None
@@ -173,10 +186,15 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
         if not self.normalized:
             for i in range(self.num_classes-1):
                 if len(positives[i]):
-                    positives[i] = self.zScores(positives[i])
-                for j in range(len(negatives[i])):
-                    if len(negatives[i][j]):
-                        negatives[i][j] = self.zScores(negatives[i][j])
+                    positives[i] = self.zScores(positives[i], in_place=self.normalize_in_place)
+                if isinstance(negatives[i], list):
+                    for j in range(len(negatives[i])):
+                        if len(negatives[i][j]):
+                            negatives[i][j] = self.zScores(negatives[i][j], in_place=self.normalize_in_place)
+                else:
+                    # Lazy sources of negatives are normalized when each batch is read, into a new tensor since the
+                    # batch may be backed by the memory-mapped file
+                    negatives[i] = negatives[i].map(self.zScores)
             self.normalized = True
 
         model = self.trainWithMinibootstrap(negatives, positives, output_dir=output_dir)
@@ -195,23 +213,26 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                 model[c].alpha_ = model[c].alpha_.to('cuda')
         except:
             pass
-        for i in range(len(test_boxes)):
-            l = test_boxes[i]
-            if l is not None:
-                I = np.nonzero(l['gt'] == 0)
-                boxes = l['boxes'][I, :][0]
-                X_test = torch.tensor(l['feat'][I, :][0], device='cuda')
-                t0 = time.time()
-                if self.mean_norm != 0:
-                   X_test = self.zScores(X_test)
-                scores = - torch.ones((len(boxes), self.num_classes))
-                for c in range(0, self.num_classes-1):
-                    pred = self.classifier.predict(model[c], X_test)
-                    scores[:, c+1] = torch.squeeze(pred)
-
-                total_testing_time = total_testing_time + time.time() - t0
-                b = BoxList(torch.from_numpy(boxes), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
-                b.add_field("scores", scores.to('cpu'))
+        # All the classifiers are evaluated with a single kernel evaluation per image
+        from mrcnn_modified.utils.falkon_bank import FusedFalkonBank
+        falkon_bank = FusedFalkonBank(model[:self.num_classes-1], fill_value=-2).to('cuda')
+        # Non-gt features of groups of test_chunk_size images are scored together and split back per image
+        test_images = [l for l in test_boxes if l is not None]
+        for c in range(0, len(test_images), self.test_chunk_size):
+            chunk = test_images[c:c + self.test_chunk_size]
+            I = [np.nonzero(l['gt'] == 0)[0] for l in chunk]
+            boxes = [l['boxes'][I[j], :] for j, l in enumerate(chunk)]
+            X_test = torch.as_tensor(np.concatenate([l['feat'][I[j], :] for j, l in enumerate(chunk)]), dtype=torch.float32).to('cuda')
+            t0 = time.time()
+            if self.mean_norm != 0:
+               X_test = self.zScores(X_test)
+            scores = - torch.ones((X_test.size()[0], self.num_classes))
+            scores[:, 1:] = falkon_bank.predict(X_test)
+
+            total_testing_time = total_testing_time + time.time() - t0
+            for l, boxes_l, scores_l in zip(chunk, boxes, torch.split(scores, [len(b) for b in boxes])):
+                b = BoxList(torch.from_numpy(boxes_l), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
+                b.add_field("scores", scores_l)
                 predictions.append(b)
 
         avg_time = total_testing_time/len(test_boxes)
@@ -221,7 +242,10 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
     def predict(self, dataset) -> None:
         pass
 
-    def zScores(self, feat, target_norm=20):
+    def zScores(self, feat, target_norm=20, in_place=False):
+        if in_place and feat.dtype == self.mean.dtype:
+            # feat is overwritten, so that no temporary copy of it is allocated
+            return feat.sub_(self.mean).mul_(target_norm / self.mean_norm.item())
         feat = feat - self.mean
         feat = feat * (target_norm / self.mean_norm.item())
         return feat
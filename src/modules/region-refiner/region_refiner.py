@@ -20,8 +20,13 @@ class RegionRefiner(RegionRefinerAbstract):
         return
 
     def trainRegionRefiner(self, COXY, output_dir=None):
-        trainer = RegionRefinerTrainer(self.cfg, lmbd=self.cfg['REGION_REFINER']['opts']['lambda'], is_rpn=self.is_rpn)
-        self.models = trainer(COXY, output_dir=output_dir)
+        self.trainer = RegionRefinerTrainer(self.cfg, lmbd=self.cfg['REGION_REFINER']['opts']['lambda'], is_rpn=self.is_rpn)
+        self.models = self.trainer(COXY, output_dir=output_dir)
+        return self.models
+
+    def updateRegionRefiner(self, COXY):
+        # Update the trained regressors with the examples of new images, without retraining them
+        self.models = self.trainer.update(COXY)
         return self.models
 
     def testRegionRefiner(self):
@@ -16,12 +16,26 @@ class RegionRefinerTrainer():
         self.lambd = lmbd
         self.percentile = 0
         self.COXY = None
+        # Per-class sufficient statistics, used in place of COXY when the features have not been kept
+        self.statistics = None
         self.is_rpn = is_rpn
+        self.models = None
+        # Targets whitening and inverse regularized Gram matrices of the trained classes, for updates
+        self.whitenings = {}
+        self.inverse_grams = {}
 
     def __call__(self, COXY, output_dir=None):
-        self.COXY = COXY
-        models = self.train(output_dir=output_dir)
-        return models
+        from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+        if isinstance(COXY, RegressionStatistics):
+            self.statistics = COXY
+            self.COXY = None
+        else:
+            self.COXY = COXY
+            self.statistics = None
+        self.whitenings = {}
+        self.inverse_grams = {}
+        self.models = self.train(output_dir=output_dir)
+        return self.models
 
     def train(self, output_dir=None):
         chosen_classes = self.cfg['CHOSEN_CLASSES']
@@ -30,68 +44,17 @@ class RegionRefinerTrainer():
         if self.is_rpn:
             start_index = 0
         opts = self.cfg['REGION_REFINER']['opts']
+        # Number of classes whose systems are factorized together with a batched Cholesky decomposition
+        classes_per_batch = opts.get('classes_per_batch', 8)
 
         num_clss = len(chosen_classes)
 
         models = np.empty((0))
 
         start_time = time.time()
-        for i in range(start_index, num_clss):
-            print('Training regressor for class %s (%d/%d)' % (chosen_classes[i], i, num_clss - 1))
-            # Compute indices where bboxes of class i overlap with the ground truth
-            I = self.COXY['C'] == i
-            I = torch.where(I == True)[0]
-            print('Training with %i examples' %len(I))
-            if len(I) == 0:
-                models = np.append(models, {'mu': None,
-                                            'T': None,
-                                            'T_inv': None,
-                                            'Beta': None
-                                            })
-                print('No indices for class %s' % (chosen_classes[i]))
-                continue
-            # Extract the corresponding values in the X matrix
-            # Transpose is used to set the number of features as the number of columns (instead of the number of rows)
-            Xi = self.COXY['X'][I].type(torch.float64)
-            Yi = self.COXY['Y'][I].type(torch.float64)
-            # Add bias values to Xi
-            bias = torch.ones((Xi.size()[0], 1), dtype=torch.float64, device=Xi.device)
-            Xi = torch.cat((Xi, bias), dim=1)
-
-            # Center and decorrelate targets
-            mu = torch.mean(Yi, dim=0)
-            Yi -= mu
-            S = torch.matmul(torch.t(Yi), Yi) / Yi.size()[0]
-            D, W = torch.eig(S, eigenvectors=True)
-            D = D[:, 0]
-            T = torch.matmul(torch.matmul(W, torch.diag(torch.sqrt(D + 0.001).pow_(-1))), torch.t(W))
-            T_inv = torch.matmul(torch.matmul(W, torch.diag(torch.sqrt(D + 0.001))), torch.t(W))
-            Yi = torch.matmul(Yi, T)
-
-
-            Beta = self.solve(Xi, Yi, self.lambd)
-
-            if self.percentile > 0:
-                indices = []
-                for elem in Beta:
-                    losses_i = Beta[elem]['losses']
-                    threshold_i = np.percentile(losses_i.cpu(), self.percentile)
-                    indices_i = torch.where(losses_i > threshold_i)[0]
-                    indices.append(indices_i)
-                Beta = self.solve(Xi, Yi, self.lambd, Xi_test, Yi_test, indices)
-
-            models = np.append(models, {
-                'mu': mu.to("cuda").type(torch.float32),
-                'T': T.to("cuda").type(torch.float32),
-                'T_inv': T_inv.to("cuda").type(torch.float32),
-                'Beta': Beta
-            })
-
-            mean_losses = torch.empty(0, device=Xi.device, dtype=torch.float32)
-
-            for elem in models[i - start_index]['Beta']:
-                mean_losses = torch.cat((mean_losses, torch.mean(models[i - start_index]['Beta'][elem]['losses'], dim=0, keepdim=True)))
-            print('Mean losses:', mean_losses)
+        classes = list(range(start_index, num_clss))
+        for b in range(0, len(classes), classes_per_batch):
+            models = np.append(models, self.train_classes(classes[b:b+classes_per_batch]))
 
         end_time = time.time()
         training_time = end_time - start_time
@@ -106,26 +69,198 @@ class RegionRefinerTrainer():
 
         return models
 
+    def train_classes(self, classes):
+        chosen_classes = self.cfg['CHOSEN_CLASSES']
+        num_clss = len(chosen_classes)
+        # Build the regularized normal equations of each class
+        gram_matrices = []
+        XY_products = []
+        targets_stats = {}
+        # Biased examples of each class, gathered from COXY once and kept for the losses
+        examples = {}
+        for i in classes:
+            print('Training regressor for class %s (%d/%d)' % (chosen_classes[i], i, num_clss - 1))
+            XX, XY, YY, examples[i] = self.class_statistics(i)
+            n = 0 if XX is None else XX[-1, -1].item()
+            print('Training with %i examples' % n)
+            if n == 0:
+                print('No indices for class %s' % (chosen_classes[i]))
+                continue
+            mu, T, T_inv = self.whitening(XY[-1] / n, YY / n)
+            gram_matrices.append(XX + self.lambd * torch.eye(XX.size()[0], device=XX.device, dtype=torch.float64))
+            XY_products.append(self.whitened_XY(XX, XY, mu, T))
+            targets_stats[i] = (len(gram_matrices) - 1, mu, T, T_inv)
+            self.whitenings[i] = (mu, T, T_inv)
+
+        # Factorize all the systems at once and solve for the 4 targets together
+        if len(gram_matrices):
+            R = torch.cholesky(torch.stack(gram_matrices))
+            W = torch.cholesky_solve(torch.stack(XY_products), R)
+            del gram_matrices, XY_products, R
+
+        models = []
+        for i in classes:
+            if i not in targets_stats:
+                models.append({'mu': None,
+                               'T': None,
+                               'T_inv': None,
+                               'Beta': None
+                               })
+                continue
+            position, mu, T, T_inv = targets_stats[i]
+            if self.statistics is not None:
+                # Without the examples, only the mean losses are available
+                Beta = self.pack_mean_losses(i, W[position], mu, T)
+            else:
+                Xi, Yi = examples.pop(i)
+                Yi = torch.matmul(Yi - mu, T)
+                Beta = self.pack_targets(Xi, Yi, W[position])
+
+                if self.percentile > 0:
+                    indices = []
+                    for elem in Beta:
+                        losses_i = Beta[elem]['losses']
+                        threshold_i = np.percentile(losses_i.cpu(), self.percentile)
+                        indices_i = torch.where(losses_i > threshold_i)[0]
+                        indices.append(indices_i)
+                    Beta = self.solve(Xi, Yi, self.lambd, Xi_test, Yi_test, indices)
+
+            models.append(self.pack_model(mu, T, T_inv, Beta))
+
+            mean_losses = torch.stack([torch.mean(Beta[elem]['losses']) for elem in Beta])
+            print('Mean losses for class %s:' % (chosen_classes[i]), mean_losses)
+        return models
+
+    def update(self, COXY):
+        """
+        Updates the regressors with the new examples in COXY, without refitting them from scratch. The inverse of the
+        regularized Gram matrix of each class receives a rank-k update with the k new examples of the class (Woodbury
+        identity), while targets whitening is kept as computed at training time. Classes without a regressor yet are
+        trained from their accumulated statistics.
+        """
+        from mrcnn_modified.utils.regression_statistics import RegressionStatistics, add_bias
+        if self.statistics is None:
+            # Switch to sufficient statistics, the examples used for training are not needed anymore
+            self.statistics = RegressionStatistics(self.COXY['X'].size()[1], device=self.COXY['X'].device)
+            self.statistics.update(self.COXY['X'], self.COXY['Y'], self.COXY['C'])
+            self.COXY = None
+
+        start_index = 0 if self.is_rpn else 1
+        C = COXY['C'].to(self.statistics.device).view(-1)
+        to_retrain = []
+        for i in torch.unique(C).tolist():
+            i = int(i)
+            ids = torch.where(C == i)[0]
+            Xi = COXY['X'][ids].to(device=self.statistics.device, dtype=torch.float64)
+            Yi = COXY['Y'][ids].to(device=self.statistics.device, dtype=torch.float64)
+            if i not in self.whitenings:
+                self.statistics.update_class(i, Xi, Yi)
+                to_retrain.append(i)
+                continue
+            Xb = add_bias(Xi)
+            G_inv = self.inverse_grams.get(i)
+            if G_inv is None or Xb.size()[0] >= Xb.size()[1]:
+                self.statistics.update_class(i, Xi, Yi)
+                # Refactorizing is cheaper than updating with as many examples as features
+                XX = self.statistics.XX[i]
+                R = torch.cholesky(XX + self.lambd * torch.eye(XX.size()[0], device=XX.device, dtype=torch.float64))
+                G_inv = torch.cholesky_solve(torch.eye(XX.size()[0], device=XX.device, dtype=torch.float64), R)
+            else:
+                # (G + Xb'Xb)^-1 = G^-1 - U (I + Xb U)^-1 U', with U = G^-1 Xb'
+                U = torch.matmul(G_inv, torch.t(Xb))
+                S = torch.eye(Xb.size()[0], device=Xb.device, dtype=torch.float64) + torch.matmul(Xb, U)
+                G_inv = G_inv - torch.matmul(U, torch.cholesky_solve(torch.t(U), torch.cholesky(S)))
+                self.statistics.update_class(i, Xi, Yi)
+            self.inverse_grams[i] = G_inv
+
+            mu, T, T_inv = self.whitenings[i]
+            W = torch.matmul(G_inv, self.whitened_XY(self.statistics.XX[i], self.statistics.XY[i], mu, T))
+            self.models[i - start_index] = self.pack_model(mu, T, T_inv, self.pack_mean_losses(i, W, mu, T))
+
+        if to_retrain:
+            for i, model in zip(to_retrain, self.train_classes(to_retrain)):
+                self.models[i - start_index] = model
+        return self.models
+
+    def class_statistics(self, i):
+        # Normal equations terms of class i, with a bias column appended to the features, and the examples they are
+        # computed from, or None when they are taken from the sufficient statistics
+        if self.statistics is not None:
+            if i not in self.statistics:
+                return None, None, None, None
+            return self.statistics.XX[i], self.statistics.XY[i], self.statistics.YY[i], None
+        # Compute indices where bboxes of class i overlap with the ground truth
+        I = torch.where(self.COXY['C'] == i)[0]
+        if len(I) == 0:
+            return None, None, None, None
+        Xi, Yi = self.class_examples(I)
+        return torch.matmul(torch.t(Xi), Xi), torch.matmul(torch.t(Xi), Yi), torch.matmul(torch.t(Yi), Yi), (Xi, Yi)
+
+    def class_examples(self, I):
+        # Extract the corresponding values in the X matrix and add bias values to Xi
+        Xi = self.COXY['X'][I].type(torch.float64)
+        Yi = self.COXY['Y'][I].type(torch.float64)
+        bias = torch.ones((Xi.size()[0], 1), dtype=torch.float64, device=Xi.device)
+        Xi = torch.cat((Xi, bias), dim=1)
+        return Xi, Yi
+
+    def whitening(self, mu, YY_mean):
+        # Center and decorrelate targets. The covariance is symmetric, so its eigenvalues are real
+        S = YY_mean - torch.ger(mu, mu)
+        D, W = torch.symeig(S, eigenvectors=True)
+        D = torch.clamp(D, min=0)
+        T = torch.matmul(torch.matmul(W, torch.diag(torch.sqrt(D + 0.001).pow_(-1))), torch.t(W))
+        T_inv = torch.matmul(torch.matmul(W, torch.diag(torch.sqrt(D + 0.001))), torch.t(W))
+        return mu, T, T_inv
+
+    def whitened_XY(self, XX, XY, mu, T):
+        # Xb'((Y - mu) T), where the last column of XX is Xb'1
+        return torch.matmul(XY - torch.ger(XX[:, -1], mu), T)
+
+    def pack_mean_losses(self, i, W, mu, T):
+        # Mean of 0.5 * (Xb w - y)^2 from the statistics: 0.5 * (w'XX w - 2 w'Xb'y + y'y) / n
+        XX, XY, YY = self.statistics.XX[i], self.statistics.XY[i], self.statistics.YY[i]
+        n = XX[-1, -1]
+        mu_n = XY[-1] / n
+        YY_whitened = torch.matmul(torch.t(T), torch.matmul(YY - n * torch.ger(mu, mu_n) - n * torch.ger(mu_n, mu) + n * torch.ger(mu, mu), T))
+        losses = 0.5 * (torch.sum(W * torch.matmul(XX, W), dim=0) - 2 * torch.sum(W * self.whitened_XY(XX, XY, mu, T), dim=0) + torch.diag(YY_whitened)) / n
+        to_return = {}
+        for k in range(0, 4):
+            to_return[str(k)] = {'weights': W[:, k].to('cuda').type(torch.float32),
+                                 'losses': losses[k:k+1].type(torch.float32)}
+        return to_return
+
+    def pack_model(self, mu, T, T_inv, Beta):
+        return {
+            'mu': mu.to("cuda").type(torch.float32),
+            'T': T.to("cuda").type(torch.float32),
+            'T_inv': T_inv.to("cuda").type(torch.float32),
+            'Beta': Beta
+        }
+
+    def pack_targets(self, X, y, W):
+        to_return = {}
+        losses = 0.5 * torch.pow((torch.matmul(X, W) - y), 2)
+        for i in range(0, 4):
+            to_return[str(i)] = {'weights': W[:, i].to('cuda').type(torch.float32),
+                                 'losses': losses[:, i].type(torch.float32)}
+        return to_return
 
     def solve(self, X, y, lmbd, X_test=None, Y_test=None, indices=None):
         if indices is None:
+            # Factorize once and solve for the 4 targets together
             X_transposed_X = torch.matmul(torch.t(X), X) + lmbd * torch.eye(X.size()[1], device=X.device, dtype=torch.float64)
             R = torch.cholesky(X_transposed_X)
+            W = torch.cholesky_solve(torch.matmul(torch.t(X), y), R)
+            return self.pack_targets(X, y, W)
         to_return = {}
-        X_original = X.clone()
-        y_original = y.clone()
         for i in range(0, 4):
-            if indices is not None:
-                X = X_original[indices[i]]
-                y = y_original[indices[i]]
-                X_transposed_X = torch.matmul(torch.t(X), X) + lmbd * torch.eye(X.size()[1], device=X.device, dtype=torch.float64)
-                R = torch.cholesky(X_transposed_X)
-            y_torch_i = y[:, i]
-            z = torch.triangular_solve(torch.matmul(torch.t(X), y_torch_i).view(X.size()[1], 1), R, upper=False).solution
-            w = torch.triangular_solve(z, torch.t(R)).solution.view(X.size()[1])
-            losses = 0.5 * torch.pow((torch.matmul(X, w) - y_torch_i), 2)
+            X_i = X[indices[i]]
+            y_i = y[indices[i], i]
+            X_transposed_X = torch.matmul(torch.t(X_i), X_i) + lmbd * torch.eye(X_i.size()[1], device=X_i.device, dtype=torch.float64)
+            R = torch.cholesky(X_transposed_X)
+            w = torch.cholesky_solve(torch.matmul(torch.t(X_i), y_i).view(-1, 1), R).view(-1)
+            losses = 0.5 * torch.pow((torch.matmul(X_i, w) - y_i), 2)
             to_return[str(i)] = {'weights': w.to('cuda').type(torch.float32),
                                  'losses': losses.type(torch.float32)}
         return to_return
-
-
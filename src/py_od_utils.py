@@ -1,10 +1,22 @@
-import math
 import numpy as np
 import os
 import torch
-import glob
 
-def computeFeatStatistics(positives, negatives, feature_folder, is_rpn, num_samples=4000):
+def accumulateFeatStatistics(positives, negatives, features_dim=2048, device='cuda'):
+    from mrcnn_modified.utils.feature_statistics import FeatureStatistics
+    # Statistics are accumulated batch by batch over all the features, without concatenating them
+    feature_statistics = FeatureStatistics(features_dim, device=device)
+    for i in range(len(positives)):
+        feature_statistics.update(i, positives[i], positive=True)
+        if torch.is_tensor(negatives[i]):
+            feature_statistics.update(i, negatives[i], positive=False)
+        else:
+            for negatives_j in negatives[i]:
+                feature_statistics.update(i, negatives_j, positive=False)
+    return feature_statistics
+
+
+def computeFeatStatistics(positives, negatives, feature_folder, is_rpn):
     basedir = os.path.dirname(__file__)
     if not is_rpn:
         stats_path = os.path.join(basedir, '..', 'Data', 'feat_cache', feature_folder, 'stats')
@@ -17,76 +29,35 @@ def computeFeatStatistics(positives, negatives, feature_folder, is_rpn, num_samp
         mean_norm = torch.tensor(l['mean_norm'])
     except:
         print('Computing features statistics')
-        pos_fraction = 1/10
-        neg_fraction = 9/10
-        num_classes = len(positives)
-        take_from_pos = math.ceil((num_samples/num_classes)*pos_fraction)
-        take_from_neg = math.ceil(((num_samples/num_classes)*neg_fraction)/len(negatives[0]))
-
-        sampled_X = 0
-        ns = 0
-        for i in range(num_classes):
-            if len(positives[i]) != 0:
-                sampled_X = positives[i][0].cpu()
-                ns = np.transpose(np.linalg.norm(positives[i][0].cpu()))
-        for i in range(num_classes):
-            if len(positives[i]) != 0:
-                pos_idx = np.random.randint(len(positives[i]), size=take_from_pos)
-                pos_picked = positives[i][pos_idx]
-                sampled_X = np.vstack((sampled_X, pos_picked.cpu()))
-                ns = np.vstack((ns, np.transpose(np.linalg.norm(pos_picked.cpu(), axis=1)[np.newaxis])))
-            for j in range(len(negatives[i])):
-                if len(negatives[i][j]) != 0:
-                    neg_idx = np.random.choice(len(negatives[i][j]), size=take_from_neg)
-                    neg_picked = negatives[i][j][neg_idx]
-                    sampled_X = np.vstack((sampled_X, neg_picked.cpu()))
-                    ns = np.vstack((ns, np.transpose(np.linalg.norm(neg_picked.cpu(), axis=1)[np.newaxis])))
-
-        mean = np.mean(sampled_X, axis=0)
-        std = np.std(sampled_X, axis=0)
-        mean_norm = np.mean(ns)
-
-        mean = torch.tensor(mean)
-        std = torch.tensor(std)
-        mean_norm = torch.tensor(mean_norm)
+        features_dim = next(len(positives_i[0]) for positives_i in positives if len(positives_i) != 0)
+        stats = accumulateFeatStatistics(positives, negatives, features_dim=features_dim, device='cpu').compute(pos_fraction=1/10, device='cpu')
+        mean = stats['mean']
+        std = stats['std']
+        mean_norm = stats['mean_norm']
         l = {'mean': mean, 'std': std, 'mean_norm': mean_norm}
         torch.save(l, stats_path)
 
     return mean, std, mean_norm
 
 
-def computeFeatStatistics_torch(positives, negatives, num_samples=4000, features_dim=2048, cpu_tensor=False, pos_fraction=None):
-    device = 'cpu' if cpu_tensor else 'cuda'
-    print('Computing features statistics')
+def computeFeatStatistics_torch(positives, negatives, features_dim=2048, cpu_tensor=False, pos_fraction=None, feature_statistics=None):
+    # Statistics accumulated while the features were extracted are used if given, otherwise they are accumulated
+    # here over all the features
+    if feature_statistics is None:
+        print('Computing features statistics')
+        feature_statistics = accumulateFeatStatistics(positives, negatives, features_dim=features_dim, device='cpu' if cpu_tensor else 'cuda')
     if pos_fraction is None:
         pos_fraction = 1/10
-        neg_fraction = 9/10
-    else:
-        neg_fraction = 1 - pos_fraction
-    num_classes = len(positives)
-    take_from_pos = math.ceil((num_samples/num_classes)*pos_fraction)
-    take_from_neg = math.ceil(((num_samples/num_classes)*neg_fraction)/len(negatives[0]))
-    sampled_X = torch.empty((0, features_dim), device=device)
-    ns = torch.empty((0,1), device=device)
-    for i in range(num_classes):
-        if len(positives[i]) != 0:
-            pos_idx = torch.randint(len(positives[i]), (take_from_pos,))
-            pos_picked = positives[i][pos_idx]
-            sampled_X = torch.cat((sampled_X, pos_picked))
-            ns = torch.cat((ns, torch.norm(pos_picked.view(-1, features_dim) , dim=1).view(-1,1)), dim=0)
-        for j in range(len(negatives[i])):
-            if len(negatives[i][j]) != 0:
-                neg_idx = torch.randint(len(negatives[i][j]), (take_from_neg,))
-                neg_picked = negatives[i][j][neg_idx]
-                sampled_X = torch.cat((sampled_X, neg_picked))
-                ns = torch.cat((ns, torch.norm(neg_picked.view(-1, features_dim) , dim=1).view(-1,1)), dim=0)
+    return feature_statistics.compute(pos_fraction=pos_fraction, device='cuda')
 
-    mean = torch.mean(sampled_X, dim=0)
-    std = torch.std(sampled_X, dim=0)
-    mean_norm = torch.mean(ns)
-    stats = {'mean': mean.to('cuda'), 'std': std.to('cuda'), 'mean_norm': mean_norm.to('cuda')}
 
-    return stats
+def load_feature_statistics(features_dir):
+    from mrcnn_modified.utils.feature_statistics import FeatureStatistics, FEATURE_STATISTICS_FILE_NAME
+    # Features saved without their statistics return None
+    path = os.path.join(features_dir, FEATURE_STATISTICS_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+    return FeatureStatistics.load(path)
 
 
 def zScores(feat, mean, mean_norm, target_norm=20):
@@ -96,11 +67,18 @@ def zScores(feat, mean, mean_norm, target_norm=20):
     return feat
 
 
-def normalize_COXY(COXY, stats, cpu=False):
-    if cpu:
-        COXY['X'] = COXY['X'] - stats['mean'].to('cpu')
-    else:
-        COXY['X'] = COXY['X'] - stats['mean']
+def normalize_COXY(COXY, stats, cpu=False, in_place=False):
+    from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+    if isinstance(COXY, RegressionStatistics):
+        # Sufficient statistics are normalized through the equivalent affine map
+        return COXY.normalized(stats['mean'], 20 / stats['mean_norm'].item())
+    mean = stats['mean'].to('cpu') if cpu else stats['mean']
+    # Features kept in memory with reduced precision are upcast before normalization
+    if in_place:
+        # X is overwritten, so that no temporary copy of it is allocated (apart from the upcast)
+        COXY['X'] = COXY['X'].to(torch.float32).sub_(mean).mul_(20 / stats['mean_norm'].item())
+        return COXY
+    COXY['X'] = COXY['X'].to(torch.float32) - mean
     COXY['X'] = COXY['X'] * (20 / stats['mean_norm'].item())
     return COXY
 
@@ -111,86 +89,59 @@ def falkon_models_to_cuda(models):
             models[i].alpha_ = models[i].alpha_.to('cuda')
     return models
 
-def load_features_classifier(features_dir, is_segm=False, cpu_tensor=False, sample_ratio=1):
-    positives_to_load = len(glob.glob(os.path.join(features_dir, 'positives_*')))
-    positives_loaded = 0
-    negatives_to_load = len(glob.glob(os.path.join(features_dir, 'negatives_*')))
-    negatives_loaded = 0
+def load_features_classifier(features_dir, is_segm=False, cpu_tensor=False, sample_ratio=1, lazy_negatives=True):
+    from mrcnn_modified.utils.feature_store import FeatureStoreReader
+    # Only the index of the features directory is read here, features are memory-mapped and moved, without
+    # concatenating them, to the device where they have been extracted.
+    # With lazy_negatives, each batch of negatives is read only when the minibootstrap needs it
+    store = FeatureStoreReader(features_dir)
     positives = []
     negatives = []
-    clss_id = 0
-    while positives_loaded < positives_to_load or negatives_loaded < negatives_to_load:
-        # Load positives with class id clss_id
-        positives_to_load_i = len(glob.glob(os.path.join(features_dir, 'positives_cl_{}_*'.format(clss_id))))
-        positives_i = []
-        for batch in range(positives_to_load_i):
-            positives_i.append(torch.load(os.path.join(features_dir,'positives_cl_{}_batch_{}'.format(clss_id, batch))))
-            positives_loaded += 1
-        # If there are not positives for this class, add an empty tensor
-        try:
-            if not cpu_tensor:
-                to_append_pos_i = torch.cat(positives_i)
-                if sample_ratio < 1:
-                    #print(int(len(to_append_pos_i)*sample_ratio))
-                    indices = torch.randint(len(to_append_pos_i), (int(len(to_append_pos_i)*sample_ratio),))
-                    to_append_pos_i = to_append_pos_i[indices]
-                positives.append(to_append_pos_i)
-            else:
-                positives.append(torch.cat(positives_i).to('cpu'))
-        except:
-            positives.append(torch.empty((0)))
-        if is_segm:
-            negatives_to_load_i = len(glob.glob(os.path.join(features_dir, 'negatives_cl_{}_*'.format(clss_id))))
-            negatives_i = []
-            for batch in range(negatives_to_load_i):
-                negatives_i.append(torch.load(os.path.join(features_dir, 'negatives_cl_{}_batch_{}'.format(clss_id, batch))))
-                negatives_loaded += 1
-            # If there are not negatives for this class, add an empty tensor
-            try:
-                if not cpu_tensor:
-                    to_append_neg_i = torch.cat(negatives_i)
-                    if sample_ratio < 1:
-                        indices = torch.randint(len(to_append_neg_i), (int(len(to_append_neg_i) * sample_ratio),))
-                        to_append_neg_i = to_append_neg_i[indices]
-                    negatives.append(to_append_neg_i)
+    for clss_id in range(store.num_classes()):
+        for name, to_append in (('positives_cl_{}'.format(clss_id), positives), ('negatives_cl_{}'.format(clss_id), negatives)):
+            if name not in store:
+                # If there are not examples for this class, add an empty tensor (an empty list of batches for negatives)
+                to_append.append(torch.empty((0)) if name.startswith('positives') or is_segm else [])
+                continue
+            device = 'cpu' if cpu_tensor else store.device(name)
+            if name.startswith('negatives') and not is_segm:
+                if lazy_negatives:
+                    to_append.append(store.get_lazy_batches(name, device=device))
                 else:
-                    negatives.append(torch.cat(negatives_i).to('cpu'))
-            except:
-                negatives.append(torch.empty((0)))
-        else:
-            # Load negatives with class id clss_id
-            negatives_to_load_i = len(glob.glob(os.path.join(features_dir, 'negatives_cl_{}_*'.format(clss_id))))
-            negatives_i = []
-            for batch in range(negatives_to_load_i):
-                negatives_i.append(torch.load(os.path.join(features_dir,'negatives_cl_{}_batch_{}'.format(clss_id, batch))))
-                negatives_loaded += 1
-            negatives.append(negatives_i)
-        clss_id += 1
+                    to_append.append(store.get_batches(name, device=device))
+                continue
+            feat = store.get(name)
+            if sample_ratio < 1 and not cpu_tensor:
+                indices = torch.randint(len(feat), (int(len(feat)*sample_ratio),))
+                feat = feat[indices]
+            to_append.append(feat.to(device))
 
     return positives, negatives
 
-def load_features_regressor(features_dir, samples_fraction=1.0):
-    reg_num_batches = len(glob.glob(os.path.join(features_dir, 'reg_x_*')))
-    X_list = []
-    C_list = []
-    Y_list = []
-    for i in range(reg_num_batches):
-        if samples_fraction < 1.0:
-            C_i = torch.load(os.path.join(features_dir, 'reg_c_batch_{}'.format(i)))
-            ind_i = torch.randperm(len(C_i))[:int(len(C_i)*samples_fraction)]
-            X_list.append(torch.load(os.path.join(features_dir, 'reg_x_batch_{}'.format(i)))[ind_i])
-            C_list.append(C_i[ind_i])
-            Y_list.append(torch.load(os.path.join(features_dir, 'reg_y_batch_{}'.format(i)))[ind_i])
-        else:
-            X_list.append(torch.load(os.path.join(features_dir, 'reg_x_batch_{}'.format(i))))
-            C_list.append(torch.load(os.path.join(features_dir, 'reg_c_batch_{}'.format(i))))
-            Y_list.append(torch.load(os.path.join(features_dir, 'reg_y_batch_{}'.format(i))))
-
-    COXY = {'C': torch.cat(C_list),
+def load_features_regressor(features_dir, samples_fraction=1.0, device=None):
+    from mrcnn_modified.utils.feature_store import FeatureStoreReader
+    from mrcnn_modified.utils.regression_statistics import RegressionStatistics, STATISTICS_FILE_NAME
+    # Regressors extracted as sufficient statistics do not have features to load
+    if os.path.exists(os.path.join(features_dir, STATISTICS_FILE_NAME)):
+        return RegressionStatistics.load(os.path.join(features_dir, STATISTICS_FILE_NAME), device=device)
+    store = FeatureStoreReader(features_dir)
+    COXY = {'C': store.get('reg_c'),
             'O': None,
-            'X': torch.cat(X_list),
-            'Y': torch.cat(Y_list)
+            'X': store.get('reg_x'),
+            'Y': store.get('reg_y')
             }
+    if samples_fraction < 1.0:
+        # Sample the same fraction of examples from each batch
+        indices = []
+        start = 0
+        for batch_rows in store.batch_rows('reg_c'):
+            indices.append(torch.randperm(batch_rows)[:int(batch_rows*samples_fraction)] + start)
+            start += batch_rows
+        indices = torch.cat(indices)
+        for key in ('C', 'X', 'Y'):
+            COXY[key] = COXY[key][indices]
+    for key in ('C', 'X', 'Y'):
+        COXY[key] = COXY[key].to(device if device is not None else store.device('reg_' + key.lower()))
     return COXY
 
 def load_positives_from_COXY(COXY, del_COXY=False):
@@ -241,6 +192,31 @@ def decode_boxes_detector(boxes, bbox_pred):
 
     return pred_boxes
 
+def features_size(*features):
+    # Bytes of the cpu tensors in features, also inside lists, tuples and dicts. Lazy sources of negatives are not
+    # counted
+    size = 0
+    for feat in features:
+        if torch.is_tensor(feat) and feat.device.type == 'cpu':
+            size += feat.element_size() * feat.nelement()
+        elif isinstance(feat, (list, tuple)):
+            size += features_size(*feat)
+        elif isinstance(feat, dict):
+            size += features_size(*feat.values())
+    return size
+
+def log_peak_memory(stage, output_dir=None, features=None):
+    import resource
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+    log_str = 'Peak RSS after {}: {:.2f} GB'.format(stage, peak_rss)
+    if features is not None:
+        log_str += ' (features in cpu memory: {:.2f} GB)'.format(features_size(features) / 1024 ** 3)
+    print(log_str)
+    if output_dir:
+        with open(os.path.join(output_dir, "result.txt"), "a") as fid:
+            fid.write(log_str + " \n")
+
 def shuffle_negatives(negatives):
     print('Shuffling negatives')
     for i in range(len(negatives)):